@@ -15,27 +15,183 @@
 #
 # (c) 2014, Kevin Carter <kevin.carter@rackspace.com>
 
-import argparse
-import copy
-import datetime
+import binascii
+import bisect
+import contextlib
+import fnmatch
+import hashlib
 import json
-import netaddr
 import os
-import Queue
-import random
+import re
 import sys
-import tarfile
-import uuid
-import yaml
 
 
-USED_IPS = []
 INVENTORY_SKEL = {
     '_meta': {
         'hostvars': {}
     }
 }
 
+# Allocation bitmaps start with a fixed size header holding a magic string,
+# the checksum of the inventory file they were saved with and the network.
+IP_BITMAP_MAGIC = 'OSAIPBM1'
+IP_BITMAP_HEADER = len(IP_BITMAP_MAGIC) + 40 + 64
+
+# Networks larger than this are not tracked with an allocation bitmap.
+IP_BITMAP_MAX_SIZE = 2 ** 24
+
+# The output of the last run is cached next to the inventory file, keyed on a
+# fingerprint of everything it was generated from.
+INVENTORY_CACHE_FILE = 'openstack_inventory.cache'
+INVENTORY_OPTIONS_CACHE_FILE = 'openstack_inventory.%s.cache'
+
+# Hostvars of every host, with a hash table index on the host names so a
+# single host is looked up with a few seeks. The header holds the magic, the
+# stat signature and the fingerprint of the inputs of the inventory it was
+# saved for and the number of index slots. Each slot holds the hash of a host
+# name and the offset and length of its record.
+HOST_INDEX_FILE = 'openstack_inventory.hosts'
+HOST_INDEX_MAGIC = 'OSAHOST3'
+HOST_INDEX_HEADER = '<8s40s40sQ'
+HOST_INDEX_SLOT = '<QQQ'
+
+# Inventory of each shard and the manifest of the hosts and groups shared
+# between shards, written next to the inventory file when the
+# ``inventory_shard_key`` user config option is set.
+INVENTORY_SHARD_FILE = 'openstack_inventory.%s.json'
+INVENTORY_SHARD_MANIFEST_FILE = 'openstack_inventory_shards.json'
+INVENTORY_SHARD_NAME = re.compile(r'^[\w.-]+$')
+
+# SQLite copy of the inventory, kept up to date when the ``inventory_backend``
+# user config option is ``sqlite``. Each table is listed with its columns and
+# the number of leading columns that make up its primary key.
+INVENTORY_BACKENDS = ('json', 'sqlite')
+INVENTORY_DB_FILE = 'openstack_inventory.db'
+INVENTORY_DB_TABLES = (
+    ('meta', ('key', 'value'), 1),
+    ('hosts', ('name', 'physical_host'), 1),
+    ('groups', ('name', 'data', 'has_hosts', 'has_children'), 1),
+    ('membership', ('group_name', 'member_type', 'position', 'member'), 3),
+    ('hostvars', ('host', 'key', 'value'), 2),
+    ('allocations', ('host', 'network', 'family', 'address'), 3),
+)
+INVENTORY_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    name TEXT PRIMARY KEY,
+    physical_host TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hosts_physical_host ON hosts (physical_host);
+CREATE TABLE IF NOT EXISTS groups (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    has_hosts INTEGER NOT NULL,
+    has_children INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS membership (
+    group_name TEXT NOT NULL,
+    member_type TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    member TEXT NOT NULL,
+    PRIMARY KEY (group_name, member_type, position)
+);
+CREATE INDEX IF NOT EXISTS membership_member ON membership (member);
+CREATE TABLE IF NOT EXISTS hostvars (
+    host TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (host, key)
+);
+CREATE TABLE IF NOT EXISTS allocations (
+    host TEXT NOT NULL,
+    network TEXT NOT NULL,
+    family INTEGER NOT NULL,
+    address TEXT NOT NULL,
+    PRIMARY KEY (host, network, family)
+);
+CREATE INDEX IF NOT EXISTS allocations_address ON allocations (address);
+"""
+
+# Parsed YAML configuration files, saved next to the inventory file. The
+# file holds the magic, the SHA1 checksum of the data and the data.
+CONFIG_CACHE_FILE = 'openstack_config.cache'
+CONFIG_CACHE_MAGIC = 'OSACFG02'
+
+# Snapshots of the inventory files, each stored once per content in a gzip
+# file named by its SHA1 checksum. A snapshot is stored either in full, as a
+# checkpoint, or as the JSON patch from the snapshot before it, with at most
+# INVENTORY_BACKUP_CHECKPOINT - 1 patches in a row. The index holds the magic,
+# the number of base records and one record per stored content with the time
+# of the snapshot, its checksum and the checksum of the snapshot it is
+# patched from, if any. Base records come first and only keep the contents
+# that the snapshots still kept are patched from, they have no time.
+# By default the last 100 snapshots of at most 30 days ago are kept, the
+# ``inventory_backup_count`` and ``inventory_backup_max_age`` user config
+# options change these. Snapshots are only pruned once there are a quarter
+# more, or they are a quarter older, than that.
+INVENTORY_BACKUP_DIR = 'backup_openstack_inventory'
+INVENTORY_BACKUP_INDEX_FILE = 'index'
+INVENTORY_BACKUP_MAGIC = 'OSABAK02'
+INVENTORY_BACKUP_HEADER = '<I'
+INVENTORY_BACKUP_RECORD = '<d20s20s'
+INVENTORY_BACKUP_NO_BASE = '\0' * 20
+INVENTORY_BACKUP_FULL_FILE = '%s.json.gz'
+INVENTORY_BACKUP_DELTA_FILE = '%s.delta.gz'
+INVENTORY_BACKUP_COUNT = 100
+INVENTORY_BACKUP_MAX_AGE = 30
+INVENTORY_BACKUP_CHECKPOINT = 10
+
+# Lock file serializing runs that share a configuration directory.
+INVENTORY_LOCK_FILE = 'openstack_inventory.lock'
+
+# Unix socket, next to the inventory file, that ``--daemon`` answers on.
+INVENTORY_SOCKET_FILE = 'openstack_inventory.sock'
+
+# Seconds a client waits on the daemon before generating the inventory itself.
+INVENTORY_DAEMON_TIMEOUT = 30
+
+# inotify(7) flags and the events that make the daemon regenerate.
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = (
+    0x2 |    # IN_MODIFY
+    0x8 |    # IN_CLOSE_WRITE
+    0x40 |   # IN_MOVED_FROM
+    0x80 |   # IN_MOVED_TO
+    0x100 |  # IN_CREATE
+    0x200    # IN_DELETE
+)
+
+# Options changing the printed inventory, in the order used for the names of
+# their cache files, along with the environment variables turning them on by
+# default.
+OUTPUT_OPTIONS = ('compact', 'hoist_group_vars', 'limit_groups', 'shard')
+OUTPUT_VALUE_OPTIONS = ('limit_groups', 'shard')
+OUTPUT_OPTION_ENVS = {
+    'compact': 'OSA_INVENTORY_COMPACT',
+    'hoist_group_vars': 'OSA_INVENTORY_HOIST_GROUP_VARS',
+    'limit_groups': 'OSA_INVENTORY_LIMIT_GROUPS',
+    'shard': 'OSA_INVENTORY_SHARD'
+}
+
+# Groups used by the templates of group_vars files, as in groups['memcached'].
+GROUP_REFERENCE = re.compile(r'groups\[\s*[\'"]([^\'"]+)[\'"]\s*\]')
+
+# JSON modules to use, fastest first, for pretty and for compact output. The
+# pretty output is written to disk and is the same with every module.
+JSON_BACKENDS = {
+    False: ('simplejson', 'json'),
+    True: ('ujson', 'simplejson', 'json')
+}
+_JSON_BACKEND_MODULES = dict()
+
+# Supported values of the ``ip_allocation_mode`` user config option.
+IP_ALLOCATION_MODES = ('random', 'hash')
+
 # This is a list of items that all hosts should have at all times.
 # Any new item added to inventory that will used as a default argument in the
 # inventory setup should be added to this list.
@@ -51,6 +207,1068 @@ REQUIRED_HOSTVARS = [
 ]
 
 
+class GroupMembers(list):
+    """A list of group members that doubles as an insertion ordered set.
+
+    Group ``hosts`` and ``children`` are kept in this type so that membership
+    tests, and with them ``append_if``, are a set lookup instead of a scan of
+    the whole group. It is still a ``list`` so it is written out to JSON
+    exactly as before. Every method that changes the list keeps the
+    companion set in step. Those that change more than a single item
+    rebuild it from the list.
+    """
+    def __init__(self, iterable=()):
+        super(GroupMembers, self).__init__()
+        self._members = set()
+        self.extend(iterable)
+
+    def _forget(self, item):
+        """Drop an item from the set once it is no longer in the list."""
+        if not super(GroupMembers, self).__contains__(item):
+            self._members.discard(item)
+
+    def _sync(self):
+        self._members = set(super(GroupMembers, self).__iter__())
+
+    def __contains__(self, item):
+        return item in self._members
+
+    def append(self, item):
+        super(GroupMembers, self).append(item)
+        self._members.add(item)
+
+    def extend(self, iterable):
+        for item in iterable:
+            self.append(item)
+
+    def insert(self, index, item):
+        super(GroupMembers, self).insert(index, item)
+        self._members.add(item)
+
+    def remove(self, item):
+        super(GroupMembers, self).remove(item)
+        self._forget(item)
+
+    def pop(self, index=-1):
+        item = super(GroupMembers, self).pop(index)
+        self._forget(item)
+        return item
+
+    def __setitem__(self, index, value):
+        super(GroupMembers, self).__setitem__(index, value)
+        self._sync()
+
+    def __delitem__(self, index):
+        super(GroupMembers, self).__delitem__(index)
+        self._sync()
+
+    def __setslice__(self, start, stop, iterable):
+        super(GroupMembers, self).__setslice__(start, stop, iterable)
+        self._sync()
+
+    def __delslice__(self, start, stop):
+        super(GroupMembers, self).__delslice__(start, stop)
+        self._sync()
+
+    def __iadd__(self, iterable):
+        self.extend(iterable)
+        return self
+
+    def __imul__(self, count):
+        super(GroupMembers, self).__imul__(count)
+        self._sync()
+        return self
+
+
+def _inet_pton(ip):
+    """Return the version and integer value of an IP address or ``None``.
+
+    Only the standard notations understood by ``socket.inet_pton`` are
+    accepted, which avoids loading netaddr for the common case.
+
+    :param ip: ``str`` IP address
+    """
+    import socket
+    import struct
+
+    ip = str(ip)
+    try:
+        return 4, struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0]
+    except socket.error:
+        pass
+    try:
+        high, low = struct.unpack(
+            '!QQ', socket.inet_pton(socket.AF_INET6, ip)
+        )
+        return 6, high << 64 | low
+    except socket.error:
+        return None
+
+
+def _ip_to_int(ip):
+    """Return the version and integer value of an IP address.
+
+    Addresses in a notation ``socket.inet_pton`` does not accept are parsed
+    with netaddr.
+
+    :param ip: ``str`` IP address
+    :raises: ``ValueError`` if the address is not valid
+    """
+    parsed = _inet_pton(ip)
+    if parsed is not None:
+        return parsed
+
+    import netaddr
+    try:
+        address = netaddr.IPAddress(ip)
+    except netaddr.AddrFormatError as e:
+        raise ValueError(str(e))
+    return address.version, int(address)
+
+
+def _int_to_ip(value, version):
+    """Return the string form of an IP address from its integer value.
+
+    :param value: ``int`` integer value of the address
+    :param version: ``int`` IP version of the address
+    """
+    import socket
+    import struct
+
+    if version == 4:
+        return socket.inet_ntop(socket.AF_INET, struct.pack('!I', value))
+    return socket.inet_ntop(
+        socket.AF_INET6,
+        struct.pack('!QQ', value >> 64, value & 0xffffffffffffffff)
+    )
+
+
+class CIDRNetwork(object):
+    """The parts of ``netaddr.IPNetwork`` used by the inventory.
+
+    Networks in ``address/prefix`` notation are parsed with the standard
+    library. Anything else, along with invalid networks, is handed to
+    netaddr so the same networks are accepted and the same errors raised.
+    """
+    def __init__(self, cidr):
+        address, _, prefixlen = str(cidr).partition('/')
+        parsed = _inet_pton(address)
+        bits = {4: 32, 6: 128}.get(parsed and parsed[0])
+        if parsed is not None and prefixlen.isdigit():
+            if int(prefixlen) <= bits:
+                self.version, self._value = parsed
+                self.prefixlen = int(prefixlen)
+            else:
+                parsed = None
+        else:
+            parsed = None
+
+        if parsed is None:
+            import netaddr
+            network = netaddr.IPNetwork(cidr)
+            self.version = network.version
+            self._value = int(network.ip)
+            self.prefixlen = network.prefixlen
+            bits = {4: 32, 6: 128}[self.version]
+
+        self._bits = bits
+        self.size = 1 << (bits - self.prefixlen)
+        self.first = self._value & ~(self.size - 1)
+        self.last = self.first + self.size - 1
+
+    def __str__(self):
+        return '%s/%d' % (_int_to_ip(self._value, self.version),
+                          self.prefixlen)
+
+    @property
+    def network(self):
+        return _int_to_ip(self.first, self.version)
+
+    @property
+    def broadcast(self):
+        if self.prefixlen >= self._bits - 1:
+            return None
+        return _int_to_ip(self.last, self.version)
+
+    @property
+    def netmask(self):
+        mask = ((1 << self._bits) - 1) ^ (self.size - 1)
+        return _int_to_ip(mask, self.version)
+
+
+class IPRangeSet(object):
+    """A set of IP addresses stored as sorted, non-overlapping ranges.
+
+    Ranges are kept per IP version as two parallel sorted lists of integer
+    start and end values. Adding a range merges it with any range it overlaps
+    or touches and membership is a binary search, so a ``used_ips`` range of
+    any size costs a single entry instead of one string per address.
+    """
+    def __init__(self):
+        self._starts = {}
+        self._ends = {}
+
+    @staticmethod
+    def _to_int(ip):
+        return _ip_to_int(ip)
+
+    def add_values(self, version, first, last):
+        """Add a range of addresses given as integers.
+
+        :param version: ``int`` IP version of the addresses
+        :param first: ``int`` First address as an integer
+        :param last: ``int`` Last address as an integer
+        """
+        starts = self._starts.setdefault(version, [])
+        ends = self._ends.setdefault(version, [])
+
+        # Every range between lo and hi overlaps or is adjacent to the new
+        # one, so they all collapse into a single entry.
+        lo = bisect.bisect_left(ends, first - 1)
+        hi = bisect.bisect_right(starts, last + 1)
+        if lo < hi:
+            first = min(first, starts[lo])
+            last = max(last, ends[hi - 1])
+        starts[lo:hi] = [first]
+        ends[lo:hi] = [last]
+
+    def add(self, ip):
+        """Add a single address to the set.
+
+        :param ip: ``str`` IP address
+        """
+        version, value = self._to_int(ip)
+        self.add_values(version, value, value)
+
+    def add_range(self, start, end):
+        """Add every address from ``start`` to ``end`` inclusive.
+
+        :param start: ``str`` First IP address of the range
+        :param end: ``str`` Last IP address of the range
+        """
+        start_version, first = self._to_int(start)
+        end_version, last = self._to_int(end)
+        if start_version != end_version:
+            raise ValueError(
+                'IP range %s,%s mixes address families' % (start, end)
+            )
+        if first <= last:
+            self.add_values(start_version, first, last)
+
+    def ranges(self, version, first, last):
+        """Yield the ranges that overlap ``first`` to ``last``, clipped to it.
+
+        :param version: ``int`` IP version of the ranges
+        :param first: ``int`` First address as an integer
+        :param last: ``int`` Last address as an integer
+        """
+        starts = self._starts.get(version, list())
+        ends = self._ends.get(version, list())
+        idx = bisect.bisect_left(ends, first)
+        while idx < len(starts) and starts[idx] <= last:
+            yield max(starts[idx], first), min(ends[idx], last)
+            idx += 1
+
+    def __contains__(self, ip):
+        try:
+            version, value = self._to_int(ip)
+        except (TypeError, ValueError):
+            return False
+        return self.has_value(version, value)
+
+    def has_value(self, version, value):
+        """Return whether an address given as an integer is in the set.
+
+        :param version: ``int`` IP version of the address
+        :param value: ``int`` integer value of the address
+        """
+        starts = self._starts.get(version)
+        if not starts:
+            return False
+
+        idx = bisect.bisect_right(starts, value) - 1
+        return idx >= 0 and value <= self._ends[version][idx]
+
+    def size(self, version=None, first=0, last=(1 << 128) - 1):
+        """Return how many addresses are in the set.
+
+        The set has no ``len``, which is limited to ``sys.maxsize``, as the
+        IPv6 ranges it holds can be larger than that.
+
+        :param version: ``int`` only count addresses of this IP version
+        :param first: ``int`` only count from this address as an integer
+        :param last: ``int`` only count up to this address as an integer
+        :returns: ``long`` number of addresses
+        """
+        total = 0L
+        for ip_version in self._starts:
+            if version not in (None, ip_version):
+                continue
+            total += sum(
+                range_last - range_first + 1
+                for range_first, range_last in self.ranges(ip_version,
+                                                           first, last)
+            )
+        return total
+
+    def __nonzero__(self):
+        return any(self._starts.values())
+
+
+USED_IPS = IPRangeSet()
+
+
+class IPBitmap(object):
+    """Memory-mapped record of the used addresses within one network.
+
+    The bitmap file holds one bit per address of a ``cidr_networks`` entry and
+    is saved next to ``openstack_inventory.json`` with the checksum of the
+    inventory it matches. The stored checksum is blanked before the first
+    change to the bitmap, so a run that never completes can not leave behind
+    a changed bitmap that looks valid. A bitmap that is not changed is not
+    written to at all.
+    """
+    def __init__(self, path, cidr, checksum=None):
+        import mmap
+
+        network = CIDRNetwork(cidr)
+        self.cidr = str(network)
+        self.version = network.version
+        self.first = network.first
+        self.size = network.size
+
+        length = IP_BITMAP_HEADER + (self.size + 7) // 8
+        if os.path.isfile(path) and os.path.getsize(path) == length:
+            self._file = open(path, 'r+b')
+        else:
+            self._file = open(path, 'w+b')
+            self._file.truncate(length)
+        self._map = mmap.mmap(self._file.fileno(), length)
+
+        self._blanked = False
+        magic, saved_checksum, saved_cidr = self._read_header()
+        if magic != IP_BITMAP_MAGIC or saved_cidr != self.cidr:
+            self.reset()
+            saved_checksum = None
+
+        self._saved_checksum = saved_checksum
+        self.valid = checksum is not None and saved_checksum == checksum
+
+    @staticmethod
+    def _parse_header(header):
+        magic_len = len(IP_BITMAP_MAGIC)
+        return (
+            header[:magic_len],
+            header[magic_len:magic_len + 40].strip('\0'),
+            header[magic_len + 40:].strip('\0')
+        )
+
+    def _read_header(self):
+        return self._parse_header(self._map[:IP_BITMAP_HEADER])
+
+    @classmethod
+    def matches(cls, path, cidr, checksum):
+        """Return whether a saved bitmap matches an inventory file.
+
+        The bitmap file is only read, so it is left as it is either way.
+
+        :param path: ``str`` path of the bitmap file
+        :param cidr: ``str`` network the bitmap is for
+        :param checksum: ``str`` Checksum of the current inventory file
+        """
+        network = CIDRNetwork(cidr)
+        length = IP_BITMAP_HEADER + (network.size + 7) // 8
+        try:
+            if os.path.getsize(path) != length:
+                return False
+            with open(path, 'rb') as f:
+                header = f.read(IP_BITMAP_HEADER)
+        except (IOError, OSError):
+            return False
+        return cls._parse_header(header) == (
+            IP_BITMAP_MAGIC, checksum, str(network)
+        )
+
+    def _write_header(self, checksum):
+        header = '%s%s%s' % (
+            IP_BITMAP_MAGIC,
+            checksum.ljust(40, '\0'),
+            self.cidr.ljust(64, '\0')
+        )
+        self._map[:IP_BITMAP_HEADER] = header
+
+    def _blank(self):
+        """Blank the stored checksum ahead of the first change."""
+        if not self._blanked:
+            self._write_header(checksum='')
+            self._blanked = True
+
+    def offset(self, address):
+        """Return the offset of an address or ``None`` if outside the network.
+
+        :param address: ``str`` IP address
+        """
+        version, value = _ip_to_int(address)
+        if version == self.version:
+            offset = value - self.first
+            if 0 <= offset < self.size:
+                return offset
+        return None
+
+    def is_set(self, offset):
+        byte = ord(self._map[IP_BITMAP_HEADER + (offset >> 3)])
+        return bool(byte & (1 << (offset & 7)))
+
+    def set(self, offset):
+        self._blank()
+        idx = IP_BITMAP_HEADER + (offset >> 3)
+        self._map[idx] = chr(ord(self._map[idx]) | (1 << (offset & 7)))
+
+    def count(self, first=0, last=None):
+        """Return how many addresses are marked between two offsets.
+
+        :param first: ``int`` First offset to count from
+        :param last: ``int`` Last offset to count to, inclusive
+        """
+        if last is None:
+            last = self.size - 1
+        if first > last:
+            return 0
+
+        data = self._map[IP_BITMAP_HEADER + (first >> 3):
+                         IP_BITMAP_HEADER + (last >> 3) + 1]
+        total = bin(int(binascii.hexlify(data), 16)).count('1')
+
+        # Leave out the bits before first and after last in the edge bytes.
+        head = ord(data[0]) & ((1 << (first & 7)) - 1)
+        tail = ord(data[-1]) & (0xff << ((last & 7) + 1)) & 0xff
+        return total - bin(head).count('1') - bin(tail).count('1')
+
+    def reset(self):
+        """Mark every address of the network as free."""
+        self._blank()
+        self._map[IP_BITMAP_HEADER:] = '\0' * (
+            len(self._map) - IP_BITMAP_HEADER
+        )
+        self.valid = False
+
+    def save(self, checksum):
+        """Record the inventory checksum and close the bitmap.
+
+        :param checksum: ``str`` Checksum of the saved inventory file
+        """
+        if self._blanked or checksum != self._saved_checksum:
+            self._write_header(checksum=checksum)
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+
+class IPQueue(object):
+    """Hand out the free addresses of a network in pseudo-random order.
+
+    Rather than building and shuffling a list of every address in the
+    network, the queue walks a full-cycle linear congruential generator over
+    the next power of two above the network size and skips any value outside
+    the network. Each offset is visited exactly once, so addresses are only
+    generated as containers ask for them, used addresses are skipped and the
+    queue is exhausted after a single pass.
+
+    When an ``IPBitmap`` is given, addresses marked in it are skipped as well
+    and every address handed out is marked.
+
+    A ``stable`` queue instead derives the address from a hash of the key
+    passed to ``get`` and probes linearly from there on collisions, so the
+    same keys always get the same addresses.
+    """
+    def __init__(self, cidr, bitmap=None, stable=False):
+        import random
+
+        network = CIDRNetwork(cidr)
+        self.bitmap = bitmap
+        self.stable = stable
+        self.version = network.version
+        self.first = network.first
+        self.size = network.size
+
+        # An LCG modulo a power of two has a full period when the increment
+        # is odd and the multiplier is one more than a multiple of four.
+        self._modulus = 1 << max((self.size - 1).bit_length(), 2)
+        self._multiplier = 4 * random.randrange(
+            1, max(self._modulus >> 2, 2)
+        ) + 1
+        self._increment = random.randrange(1, self._modulus, 2)
+        self._state = random.randrange(self._modulus)
+        self._remaining = self._modulus
+
+    def _claim(self, offset):
+        """Mark the address at an offset as used if it is free."""
+        if self.bitmap is not None and self.bitmap.is_set(offset):
+            return None
+
+        value = self.first + offset
+        if USED_IPS.has_value(self.version, value):
+            return None
+
+        USED_IPS.add_values(self.version, value, value)
+        if self.bitmap is not None:
+            self.bitmap.set(offset)
+        return _int_to_ip(value, self.version)
+
+    def _get_stable(self, key):
+        offset = int(hashlib.sha1(key).hexdigest(), 16) % self.size
+        probes = self.size
+        while probes:
+            probes -= 1
+            address = self._claim(offset)
+            if address:
+                return address
+            offset = (offset + 1) % self.size
+        return None
+
+    def get(self, key=None):
+        """Return the next free address or ``None`` once exhausted.
+
+        :param key: ``str`` Key to derive the address from on a stable queue
+        """
+        if self.stable and key is not None:
+            return self._get_stable(key)
+
+        while self._remaining:
+            self._remaining -= 1
+            self._state = (
+                self._multiplier * self._state + self._increment
+            ) % self._modulus
+            if self._state < self.size:
+                address = self._claim(self._state)
+                if address:
+                    return address
+        return None
+
+
+class InventoryWatch(object):
+    """Watch the inputs of the inventory for changes with inotify.
+
+    The configuration directory is watched for changes to
+    ``openstack_user_config.yml`` and ``openstack_inventory.json``, along
+    with every directory below ``conf.d``, ``env.d`` and the ``group_vars``
+    directories. inotify is used
+    through ``ctypes``, so this only works on Linux. ``OSError`` or
+    ``AttributeError`` is raised when it is not available.
+    """
+    def __init__(self, config_path):
+        import ctypes
+        import ctypes.util
+
+        self.config_path = config_path
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True
+        )
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = dict()
+        self.add_watches()
+
+    def add_watches(self):
+        """Watch the configuration directory and all of its extra dirs."""
+        watch_dirs = [self.config_path]
+        extra_paths = [
+            os.path.join(self.config_path, extra_dir)
+            for extra_dir in ('conf.d', 'env.d')
+        ]
+        for extra_path in extra_paths + _group_vars_dirs(self.config_path):
+            watch_dirs.extend(
+                root_dir for root_dir, _, _ in os.walk(extra_path)
+            )
+
+        for watch_dir in watch_dirs:
+            wd = self._libc.inotify_add_watch(
+                self.fd, watch_dir, IN_WATCH_MASK
+            )
+            if wd >= 0:
+                self.watches[wd] = watch_dir
+
+    def read(self):
+        """Read all pending events.
+
+        :returns: ``bol`` True if an input of the inventory has changed
+        """
+        import errno
+        import struct
+
+        data = ''
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not chunk:
+                break
+            data += chunk
+
+        changed = False
+        offset = 0
+        header_size = struct.calcsize('iIII')
+        while offset + header_size <= len(data):
+            wd, mask, _, name_len = struct.unpack_from('iIII', data, offset)
+            offset += header_size
+            name = data[offset:offset + name_len].rstrip('\0')
+            offset += name_len
+
+            watch_dir = self.watches.get(wd)
+            if watch_dir is None:
+                continue
+            if watch_dir != self.config_path:
+                changed = True
+            elif name in ('openstack_user_config.yml',
+                          'openstack_inventory.json', 'conf.d', 'env.d',
+                          'group_vars'):
+                changed = True
+
+            if mask & IN_ISDIR:
+                self.add_watches()
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ParsedConfigCache(object):
+    """Cache of the parsed content of YAML configuration files.
+
+    Entries are keyed on the path of a file and are only used while the
+    mtime, size and SHA1 checksum of the file match. The parsed content is
+    kept marshalled, so every load returns a fresh copy that callers may
+    change. All entries are saved as a single file in the configuration
+    directory. Marshal can only build plain data, and the data is only
+    loaded when its checksum matches, so the cache can't run any code.
+    Content that marshal can't store, such as dates, is not cached.
+    """
+    def __init__(self, config_path):
+        import marshal
+
+        self.cache_file = os.path.join(config_path, CONFIG_CACHE_FILE)
+        self.entries = dict()
+        self.dirty = False
+
+        content = _read_file(self.cache_file) or ''
+        header_len = len(CONFIG_CACHE_MAGIC) + 40
+        magic = content[:len(CONFIG_CACHE_MAGIC)]
+        checksum = content[len(CONFIG_CACHE_MAGIC):header_len]
+        data = content[header_len:]
+        if (magic != CONFIG_CACHE_MAGIC or
+                hashlib.sha1(data).hexdigest() != checksum):
+            return
+        try:
+            entries = marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            return
+        if isinstance(entries, dict):
+            self.entries = entries
+
+    def load(self, file_path):
+        """Return the parsed content of a YAML file.
+
+        :param file_path: ``str`` path of the YAML file
+        """
+        import marshal
+
+        with open(file_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            content = f.read()
+        key = (stat.st_mtime, stat.st_size, hashlib.sha1(content).hexdigest())
+
+        entry = self.entries.get(file_path)
+        if entry is not None and entry[:3] == key:
+            return marshal.loads(entry[3])
+
+        data = _parse_yaml(content)
+        try:
+            self.entries[file_path] = key + (marshal.dumps(data),)
+        except ValueError:
+            if self.entries.pop(file_path, None) is None:
+                return data
+        self.dirty = True
+        return data
+
+    def save(self):
+        """Save the cache if it changed, ignoring an unwritable directory."""
+        import marshal
+
+        for file_path in self.entries.keys():
+            if not os.path.isfile(file_path):
+                del self.entries[file_path]
+                self.dirty = True
+        if not self.dirty:
+            return
+
+        data = marshal.dumps(self.entries)
+        try:
+            _write_file(
+                self.cache_file,
+                CONFIG_CACHE_MAGIC + hashlib.sha1(data).hexdigest() + data
+            )
+        except (IOError, OSError):
+            return
+        self.dirty = False
+
+
+class InventoryBackupStore(object):
+    """Deduplicated and compressed snapshots of the inventory file.
+
+    Snapshots are appended to a fixed size record index, so adding one only
+    reads the header and the first and last records of the index and the
+    number of snapshots is known from its size. A snapshot equal to the last
+    one is not added, and each content is only stored once. The content is
+    stored as the JSON patch from the last snapshot when that patch rebuilds
+    it exactly, and in full every ``checkpoint`` snapshots, so any snapshot
+    is rebuilt from at most that many files. Each record holds the snapshot
+    it is patched from, so the contents still needed are known from the
+    index alone. The index is only rewritten once snapshots go a quarter
+    beyond the retention, and the content no longer needed by any snapshot
+    is then removed. The last snapshot is always kept.
+    """
+    def __init__(self, config_path, max_count=INVENTORY_BACKUP_COUNT,
+                 max_age=INVENTORY_BACKUP_MAX_AGE,
+                 checkpoint=INVENTORY_BACKUP_CHECKPOINT):
+        """
+        :param config_path: ``str`` path where the configuration files are
+                            kept
+        :param max_count: ``int`` number of snapshots to keep
+        :param max_age: ``int`` days to keep snapshots for, forever if 0
+        :param checkpoint: ``int`` store every this many snapshots in full
+        """
+        self.path = os.path.join(config_path, INVENTORY_BACKUP_DIR)
+        self.index_file = os.path.join(self.path, INVENTORY_BACKUP_INDEX_FILE)
+        self.max_count = max_count
+        self.max_age = max_age
+        self.checkpoint = checkpoint
+
+    def _object_file(self, checksum, delta=False):
+        if delta:
+            return os.path.join(self.path,
+                                INVENTORY_BACKUP_DELTA_FILE % checksum)
+        return os.path.join(self.path, INVENTORY_BACKUP_FULL_FILE % checksum)
+
+    def _read_object(self, checksum, delta=False):
+        import gzip
+
+        with gzip.open(self._object_file(checksum, delta), 'rb') as f:
+            return f.read()
+
+    def _write_object(self, checksum, content, delta=False):
+        import gzip
+        import io
+
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+            f.write(content)
+        _write_file(self._object_file(checksum, delta), compressed.getvalue())
+
+    def _read_delta(self, checksum):
+        """Return the delta of a snapshot, or ``None`` if stored in full.
+
+        :param checksum: ``str`` SHA1 checksum of the snapshot
+        :returns: ``dict`` with the ``base`` checksum, the ``depth`` of
+                  patches since the last checkpoint and the ``patch``
+        """
+        if os.path.isfile(self._object_file(checksum)):
+            return None
+        return json.loads(self._read_object(checksum, delta=True))
+
+    def _make_delta(self, base, content):
+        """Return the delta of a content from a snapshot.
+
+        :param base: ``str`` SHA1 checksum of the snapshot
+        :param content: ``str`` content of the inventory file
+        :returns: ``dict`` delta, or ``None`` if the content has to be
+                  stored in full
+        """
+        try:
+            base_delta = self._read_delta(base)
+            depth = base_delta['depth'] + 1 if base_delta else 1
+            if depth >= self.checkpoint:
+                return None
+            data = self.load(base)
+            patch = json_diff(data, json.loads(content))
+        except (IOError, OSError, ValueError):
+            return None
+
+        # The patch is only kept if the file is rebuilt byte for byte
+        if dump_json(json_patch(data, patch)) != content:
+            return None
+        return {'base': base, 'depth': depth, 'patch': patch}
+
+    def is_checkpoint(self, checksum):
+        """Return True if a snapshot is stored in full.
+
+        :param checksum: ``str`` SHA1 checksum of the snapshot
+        """
+        return os.path.isfile(self._object_file(checksum))
+
+    def _open_index(self):
+        """Return the open index file, its number of records and of bases.
+
+        A record left incomplete by an interrupted run is not counted.
+        """
+        import struct
+
+        try:
+            index_file = open(self.index_file, 'r+b')
+        except IOError:
+            return None, 0, 0
+        header_size = struct.calcsize(INVENTORY_BACKUP_HEADER)
+        magic = index_file.read(len(INVENTORY_BACKUP_MAGIC))
+        header = index_file.read(header_size)
+        if magic != INVENTORY_BACKUP_MAGIC or len(header) != header_size:
+            index_file.close()
+            return None, 0, 0
+        bases = struct.unpack(INVENTORY_BACKUP_HEADER, header)[0]
+        index_file.seek(0, os.SEEK_END)
+        count = (
+            (index_file.tell() - self._records_offset()) //
+            struct.calcsize(INVENTORY_BACKUP_RECORD)
+        )
+        return index_file, count, min(bases, count)
+
+    @staticmethod
+    def _records_offset():
+        import struct
+
+        return (
+            len(INVENTORY_BACKUP_MAGIC) +
+            struct.calcsize(INVENTORY_BACKUP_HEADER)
+        )
+
+    @staticmethod
+    def _pack_index(records, bases):
+        """Return the content of an index.
+
+        :param records: ``list`` of ``(time, checksum, base)`` records
+        :param bases: ``int`` number of base records at the start
+        """
+        import struct
+
+        return INVENTORY_BACKUP_MAGIC + struct.pack(
+            INVENTORY_BACKUP_HEADER, bases
+        ) + ''.join(
+            struct.pack(
+                INVENTORY_BACKUP_RECORD, timestamp,
+                binascii.unhexlify(checksum),
+                binascii.unhexlify(base) if base else INVENTORY_BACKUP_NO_BASE
+            )
+            for timestamp, checksum, base in records
+        )
+
+    def _read_records(self, index_file, start, count):
+        import struct
+
+        record_size = struct.calcsize(INVENTORY_BACKUP_RECORD)
+        index_file.seek(self._records_offset() + start * record_size)
+        data = index_file.read(count * record_size)
+        return [
+            (
+                timestamp,
+                binascii.hexlify(digest),
+                None if base == INVENTORY_BACKUP_NO_BASE
+                else binascii.hexlify(base)
+            )
+            for timestamp, digest, base in (
+                struct.unpack_from(INVENTORY_BACKUP_RECORD, data, offset)
+                for offset in xrange(0, len(data), record_size)
+            )
+        ]
+
+    def snapshots(self):
+        """Return the ``(time, checksum)`` of every snapshot, oldest first."""
+        index_file, count, bases = self._open_index()
+        if index_file is None:
+            return list()
+        with index_file:
+            return [
+                (timestamp, checksum) for timestamp, checksum, _ in
+                self._read_records(index_file, bases, count - bases)
+            ]
+
+    def _stored_base(self, checksum):
+        """Return the snapshot a stored content is patched from, if any.
+
+        :param checksum: ``str`` SHA1 checksum of the snapshot
+        """
+        try:
+            delta = self._read_delta(checksum)
+        except (IOError, ValueError):
+            return None
+        return delta and delta['base']
+
+    def load(self, checksum):
+        """Return the inventory of a snapshot.
+
+        The patches since the last checkpoint are applied to it in order.
+
+        :param checksum: ``str`` SHA1 checksum of the snapshot
+        :returns: ``dict`` inventory
+        """
+        patches = list()
+        delta = self._read_delta(checksum)
+        while delta is not None:
+            patches.append(delta['patch'])
+            checksum = delta['base']
+            delta = self._read_delta(checksum)
+
+        data = json.loads(self._read_object(checksum))
+        for patch in reversed(patches):
+            data = json_patch(data, patch)
+        return data
+
+    def read(self, checksum):
+        """Return the content of a snapshot.
+
+        :param checksum: ``str`` SHA1 checksum of the snapshot
+        :raises: ``ValueError`` if the snapshot can not be rebuilt
+        """
+        if self.is_checkpoint(checksum):
+            return self._read_object(checksum)
+
+        content = dump_json(self.load(checksum))
+        if hashlib.sha1(content).hexdigest() != checksum:
+            raise ValueError('Snapshot %s can not be rebuilt' % checksum)
+        return content
+
+    def add(self, content, timestamp=None):
+        """Add a snapshot, unless it is the same as the last one.
+
+        :param content: ``str`` content of the inventory file
+        :param timestamp: ``float`` time of the snapshot, now by default
+        :returns: ``bol`` True if the snapshot was added
+        """
+        import struct
+        import time
+
+        if timestamp is None:
+            timestamp = time.time()
+        checksum = hashlib.sha1(content).hexdigest()
+
+        index_file, count, bases = self._open_index()
+        if index_file is None:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            _write_file(self.index_file, self._pack_index(list(), 0))
+            index_file, count, bases = self._open_index()
+
+        with index_file:
+            last = None
+            if count > bases:
+                last = self._read_records(index_file, count - 1, 1)[0][1]
+            if last == checksum:
+                return False
+
+            if os.path.isfile(self._object_file(checksum)):
+                base = None
+            elif os.path.isfile(self._object_file(checksum, True)):
+                base = self._stored_base(checksum)
+            else:
+                delta = last and self._make_delta(last, content)
+                if delta:
+                    self._write_object(checksum, _db_value(delta), True)
+                    base = last
+                else:
+                    self._write_object(checksum, content)
+                    base = None
+
+            index_file.seek(
+                self._records_offset() +
+                count * struct.calcsize(INVENTORY_BACKUP_RECORD)
+            )
+            index_file.truncate()
+            index_file.write(self._pack_index(
+                [(timestamp, checksum, base)], 0
+            )[self._records_offset():])
+            count += 1
+
+            oldest = self._read_records(index_file, bases, 1)[0][0]
+
+        # Pruning rewrites the index, so it is only done once the snapshots
+        # are well beyond the retention.
+        max_count = self.max_count + max(1, self.max_count // 4)
+        max_age = self.max_age * 86400 * 5 // 4
+        if count - bases > max_count or (
+                max_age and oldest < timestamp - max_age):
+            self.prune(timestamp)
+        return True
+
+    def restore(self, checksum, inventory_file_path):
+        """Write a snapshot to the inventory file.
+
+        The current inventory file and the restored one are both added as
+        snapshots, so a restore can be undone.
+
+        :param checksum: ``str`` SHA1 checksum of the snapshot
+        :param inventory_file_path: ``str`` path of the inventory file
+        """
+        content = self.read(checksum)
+        current = _read_file(inventory_file_path)
+        if current is not None:
+            self.add(current)
+        _write_file(inventory_file_path, content)
+        self.add(content)
+
+    def prune(self, now=None):
+        """Remove the snapshots beyond the retention.
+
+        The contents still needed are found from the bases in the index, so
+        no stored content is read. Only the contents of the removed
+        snapshots can be removed.
+
+        :param now: ``float`` time the age of the snapshots is counted from
+        """
+        import time
+
+        if now is None:
+            now = time.time()
+        index_file, count, bases = self._open_index()
+        if index_file is None:
+            return
+        with index_file:
+            records = self._read_records(index_file, 0, count)
+        snapshots = records[bases:]
+        kept = snapshots[-self.max_count:]
+        if self.max_age:
+            kept = [
+                s for s in kept[:-1] if s[0] >= now - self.max_age * 86400
+            ] + kept[-1:]
+        if len(kept) == len(snapshots):
+            return
+
+        # The snapshots patched into the kept ones are still needed
+        record_bases = dict((c, b) for _, c, b in records)
+        kept_checksums = set(c for _, c, _ in kept)
+        needed = set()
+        for checksum in kept_checksums:
+            while checksum is not None and checksum not in needed:
+                needed.add(checksum)
+                checksum = record_bases.get(checksum)
+        base_records = [
+            (0.0, checksum, record_bases.get(checksum))
+            for checksum in sorted(needed - kept_checksums)
+        ]
+
+        _write_file(
+            self.index_file,
+            self._pack_index(base_records + kept, len(base_records))
+        )
+
+        for checksum in set(record_bases) - needed:
+            for delta in (False, True):
+                try:
+                    os.remove(self._object_file(checksum, delta))
+                except OSError:
+                    pass
+
+
 class MultipleHostsWithOneIPError(Exception):
     def __init__(self, ip, assigned_host, new_host):
         self.ip = ip
@@ -101,8 +1319,18 @@ class MissingStaticRouteInfo(Exception):
         return self.message
 
 
+def _env_flag(name):
+    """Return True if an environment variable is set to a true value.
+
+    :param name: ``str`` name of the environment variable
+    """
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes')
+
+
 def args(arg_list):
     """Setup argument Parsing."""
+    import argparse
+
     parser = argparse.ArgumentParser(
         usage='%(prog)s',
         description='OpenStack Inventory Generator',
@@ -119,42 +1347,98 @@ def args(arg_list):
         help='List all entries',
         action='store_true'
     )
+    parser.add_argument(
+        '--host',
+        help='Print the variables of a single host as JSON, looked up in'
+             ' the host index saved along with the inventory.',
+        default=None
+    )
+    parser.add_argument(
+        '--capacity-report',
+        help='Print the address capacity of each network in cidr_networks'
+             ' as JSON instead of the inventory. Only the shared lock is'
+             ' taken and the inventory, its caches and the allocation'
+             ' bitmaps are left as they are.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--daemon',
+        help='Stay in the foreground, keep the inventory in memory and serve'
+             ' it to --list on a unix socket in the config directory. The'
+             ' inventory is regenerated when the configuration changes.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--compact',
+        help='Print the inventory as compact JSON, without indentation. This'
+             ' is the default when %s is set to true.'
+             % OUTPUT_OPTION_ENVS['compact'],
+        action='store_true',
+        default=_env_flag(OUTPUT_OPTION_ENVS['compact'])
+    )
+    parser.add_argument(
+        '--hoist-group-vars',
+        help='Print host variables shared by all hosts of a group as group'
+             ' variables instead. This is the default when %s is set to true.'
+             % OUTPUT_OPTION_ENVS['hoist_group_vars'],
+        action='store_true',
+        default=_env_flag(OUTPUT_OPTION_ENVS['hoist_group_vars'])
+    )
+    parser.add_argument(
+        '--limit-groups',
+        help='Only print the groups matching these colon separated shell'
+             ' style patterns, with their parent and child groups, the groups'
+             ' used by their group_vars and the hostvars of their hosts.'
+             ' Defaults to the value of %s.'
+             % OUTPUT_OPTION_ENVS['limit_groups'],
+        default=os.environ.get(OUTPUT_OPTION_ENVS['limit_groups']) or None
+    )
+    parser.add_argument(
+        '--shard',
+        help='Only print the inventory of this shard of the hosts, as split'
+             ' by the inventory_shard_key user config option. Defaults to the'
+             ' value of %s.' % OUTPUT_OPTION_ENVS['shard'],
+        default=os.environ.get(OUTPUT_OPTION_ENVS['shard']) or None
+    )
 
     return vars(parser.parse_args(arg_list))
 
 
-def get_ip_address(name, ip_q):
-    """Return an IP address from our IP Address queue."""
+def get_ip_address(name, ip_q, key=None):
+    """Return an IP address from our IP Address queue.
+
+    :param name: ``str`` Name of the network the queue belongs to
+    :param ip_q: ``object`` ``IPQueue`` to take the address from
+    :param key: ``str`` Name of the host the address is for
+    """
+    if key is not None:
+        key = '%s:%s' % (key, name)
+
     try:
-        ip_addr = ip_q.get(timeout=1)
-        while ip_addr in USED_IPS:
-            ip_addr = ip_q.get(timeout=1)
-        else:
-            append_if(array=USED_IPS, item=ip_addr)
-            return str(ip_addr)
+        ip_addr = ip_q.get(key=key)
     except AttributeError:
         return None
-    except Queue.Empty:
+
+    if ip_addr is None:
         raise SystemExit(
             'Cannot retrieve requested amount of IP addresses. Increase the %s'
             ' range in your openstack_user_config.yml.' % name
         )
+    return ip_addr
 
 
-def _load_ip_q(cidr, ip_q):
-    """Load the IP queue with all IP address from a given cidr.
+def _load_ip_q(cidr, bitmap=None, stable=False):
+    """Return a queue of the free IP addresses within a given cidr.
 
     :param cidr: ``str``  IP address with cidr notation
+    :param bitmap: ``object`` ``IPBitmap`` of the network, if any
+    :param stable: ``bol`` derive addresses from a hash of the host name
     """
-    _all_ips = [str(i) for i in list(netaddr.IPNetwork(cidr))]
-    base_exclude = [
-        str(netaddr.IPNetwork(cidr).network),
-        str(netaddr.IPNetwork(cidr).broadcast)
-    ]
-    USED_IPS.extend(base_exclude)
-    for ip in random.sample(_all_ips, len(_all_ips)):
-        if ip not in USED_IPS:
-            ip_q.put(ip)
+    network = CIDRNetwork(cidr)
+    USED_IPS.add(network.network)
+    if network.version == 4 and network.broadcast is not None:
+        USED_IPS.add(network.broadcast)
+    return IPQueue(cidr, bitmap=bitmap, stable=stable)
 
 
 def _parse_belongs_to(key, belongs_to, inventory):
@@ -165,14 +1449,76 @@ def _parse_belongs_to(key, belongs_to, inventory):
     :param inventory: ``dict``  Living dictionary of inventory
     """
     for item in belongs_to:
-        if key not in inventory[item]['children']:
-            append_if(array=inventory[item]['children'], item=key)
+        append_if(array=inventory[item]['children'], item=key)
+
+
+def _container_host_name(type_and_name, index, hostvars, config):
+    """Return the name for a new container.
+
+    Container names are suffixed with a random string unless the user config
+    sets ``ip_allocation_mode`` to ``hash``, in which case the suffix is
+    derived from the host, the container type and the container's index so
+    the same names are produced when the inventory is rebuilt.
+
+    :param type_and_name: ``str`` Combined name of host and container name
+    :param index: ``int`` Number of existing containers of this type on the
+                  host
+    :param hostvars: ``dict`` Hostvars of the inventory
+    :param config: ``dict``  User defined information
+    """
+    import uuid
+
+    while True:
+        if config.get('ip_allocation_mode') == 'hash':
+            cuuid = hashlib.sha1('%s-%d' % (type_and_name, index)).hexdigest()
+            index += 1
+        else:
+            cuuid = '%s' % uuid.uuid4()
+        container_host_name = '%s-%s' % (type_and_name, cuuid[:8])
+        if container_host_name not in hostvars:
+            return container_host_name
+
+
+def _index_host(index, hname, hdata):
+    """Add a single hostvars entry to a hostvars index.
+
+    :param index: ``dict`` Index as returned by ``_index_hostvars``
+    :param hname: ``str`` Name of the host or container
+    :param hdata: ``dict`` Hostvars of the host or container
+    """
+    physical_host = hdata.get('physical_host') or hname
+    index['physical_host'].setdefault(physical_host, []).append(hname)
+    if hname != physical_host and '-' in hname:
+        type_and_name = hname.rsplit('-', 1)[0]
+        index['type_and_name'].setdefault(type_and_name, []).append(hname)
+
+
+def _index_hostvars(inventory):
+    """Index all hostvars by physical host and by container type and name.
+
+    The index is built once per run and kept up to date as containers are
+    created so that each physical host only has to look at its own entries
+    instead of scanning every host in the inventory.
+
+    :param inventory: ``dict``  Living dictionary of inventory
+    :returns: ``dict`` with ``physical_host`` and ``type_and_name`` mappings
+              and the per run ``container_vars`` state
+    """
+    index = {
+        'physical_host': {},
+        'type_and_name': {},
+        'container_vars': {},
+        'container_vars_applied': set()
+    }
+    for hname, hdata in inventory['_meta']['hostvars'].iteritems():
+        _index_host(index, hname, hdata)
+    return index
 
 
 def _build_container_hosts(container_affinity, container_hosts, type_and_name,
                            inventory, host_type, container_type,
                            container_host_type, physical_host_type, config,
-                           properties, assignment):
+                           properties, assignment, index):
     """Add in all of the host associations into inventory.
 
     This will add in all of the hosts into the inventory based on the given
@@ -189,31 +1535,27 @@ def _build_container_hosts(container_affinity, container_hosts, type_and_name,
     :param config: ``dict``  User defined information
     :param properties: ``dict``  Container properties
     :param assignment: ``str`` Name of container component target
+    :param index: ``dict`` Hostvars index as returned by ``_index_hostvars``
     """
-    container_list = []
     is_metal = False
     if properties:
         is_metal = properties.get('is_metal', False)
 
     for make_container in range(container_affinity):
-        for i in container_hosts:
-            if '%s-' % type_and_name in i:
-                append_if(array=container_list, item=i)
-
-        existing_count = len(list(set(container_list)))
+        existing_count = len(index['type_and_name'].get(type_and_name, []))
         if existing_count < container_affinity:
             hostvars = inventory['_meta']['hostvars']
             container_mapping = inventory[container_type]['children']
             address = None
 
             if is_metal is False:
-                cuuid = '%s' % uuid.uuid4()
-                cuuid = cuuid.split('-')[0]
-                container_host_name = '%s-%s' % (type_and_name, cuuid)
+                container_host_name = _container_host_name(
+                    type_and_name, existing_count, hostvars, config
+                )
                 hostvars_options = hostvars[container_host_name] = {}
                 if container_host_type not in inventory:
                     inventory[container_host_type] = {
-                        "hosts": [],
+                        "hosts": GroupMembers(),
                     }
 
                 append_if(
@@ -221,9 +1563,12 @@ def _build_container_hosts(container_affinity, container_hosts, type_and_name,
                     item=container_host_name
                 )
                 append_if(array=container_hosts, item=container_host_name)
+                hostvars_options['physical_host'] = host_type
+                _index_host(index, container_host_name, hostvars_options)
             else:
                 if host_type not in hostvars:
                     hostvars[host_type] = {}
+                    _index_host(index, host_type, hostvars[host_type])
 
                 hostvars_options = hostvars[host_type]
                 container_host_name = host_type
@@ -245,38 +1590,114 @@ def _build_container_hosts(container_affinity, container_hosts, type_and_name,
             })
 
 
-def _append_container_types(inventory, host_type):
-    """Append the "physical_host" type to all containers.
+def _host_group_entries(host_type, type_and_name, index):
+    """Return the hostvars entries handled for a container type of a host.
+
+    These are the physical host itself, which is also the container of
+    components on metal, and its containers of the type.
+
+    :param host_type: ``str``  Name of the host type
+    :param type_and_name: ``str`` Combined name of host and container name
+    :param index: ``dict`` Hostvars index as returned by ``_index_hostvars``
+    """
+    return [host_type] + index['type_and_name'].get(type_and_name, [])
+
+
+def _append_container_types(inventory, host_type, type_and_name, index):
+    """Append the "physical_host" type to the containers of a type.
 
     :param inventory: ``dict``  Living dictionary of inventory
     :param host_type: ``str``  Name of the host type
+    :param type_and_name: ``str`` Combined name of host and container name
+    :param index: ``dict`` Hostvars index as returned by ``_index_hostvars``
     """
-    for _host in inventory['_meta']['hostvars'].keys():
-        hdata = inventory['_meta']['hostvars'][_host]
+    hostvars = inventory['_meta']['hostvars']
+    for _host in _host_group_entries(host_type, type_and_name, index):
+        hdata = hostvars[_host]
         if 'container_name' in hdata:
             if hdata['container_name'].startswith(host_type):
                 if 'physical_host' not in hdata:
                     hdata['physical_host'] = host_type
 
 
+def _compile_container_vars(container_vars):
+    """Compile the ``container_vars`` of a host for repeated lookups.
+
+    Each variable becomes a rule with the ``limit_container_types`` filter
+    split off, so the user config is only copied once per host.
+
+    :param container_vars: ``dict`` ``container_vars`` of a host, if any
+    :returns: ``dict`` with the ``rules`` and a cache of resolved
+              ``components``
+    """
+    rules = list()
+    if isinstance(container_vars, dict):
+        for _keys, _vars in container_vars.items():
+            limit = None
+            # If a limit is set use the limit string as a filter for the
+            # component of the container.
+            if isinstance(_vars, dict) and 'limit_container_types' in _vars:
+                _vars = _vars.copy()
+                limit = _vars.pop('limit_container_types', None)
+            rules.append((_keys, limit, _vars))
+    return {'rules': rules, 'components': dict()}
+
+
+def _resolve_container_vars(compiled_vars, component):
+    """Return the container vars that apply to a component.
+
+    :param compiled_vars: ``dict`` as returned by ``_compile_container_vars``
+    :param component: ``str`` Component of the container, if any
+    """
+    components = compiled_vars['components']
+    if component not in components:
+        components[component] = dict(
+            (_keys, _vars) for _keys, limit, _vars in compiled_vars['rules']
+            if limit is None or (component and limit in component)
+        )
+    return components[component]
+
+
 def _append_to_host_groups(inventory, container_type, assignment, host_type,
-                           type_and_name, host_options):
+                           type_and_name, host_options, index):
     """Append all containers to physical (logical) groups based on host types.
 
+    Only the physical host and its containers of the type are looked at.
+    The ``container_vars`` of each ``*_hosts`` group are applied once to
+    each container, and once per component to a physical host holding
+    components on metal.
+
     :param inventory: ``dict``  Living dictionary of inventory
 
     :param container_type: ``str``  Type of container
     :param assignment: ``str`` Name of container component target
     :param host_type: ``str``  Name of the host type
     :param type_and_name: ``str`` Combined name of host and container name
+    :param host_options: ``dict`` Options of the host from the user config
+    :param index: ``dict`` Hostvars index as returned by ``_index_hostvars``
     """
     physical_group_type = '%s_all' % container_type.split('_')[0]
     if physical_group_type not in inventory:
-        inventory[physical_group_type] = {'hosts': []}
+        inventory[physical_group_type] = {'hosts': GroupMembers()}
 
     iph = inventory[physical_group_type]['hosts']
     iah = inventory[assignment]['hosts']
-    for hname, hdata in inventory['_meta']['hostvars'].iteritems():
+    hostvars = inventory['_meta']['hostvars']
+
+    physical_host_type = '%s_hosts' % container_type.split('_')[0]
+    compiled_key = (physical_host_type, host_type)
+    compiled_vars = index['container_vars'].get(compiled_key)
+    if compiled_vars is None:
+        compiled_vars = index['container_vars'][compiled_key] = (
+            _compile_container_vars(host_options.get('container_vars'))
+        )
+
+    applied = index['container_vars_applied']
+    for hname in _host_group_entries(host_type, type_and_name, index):
+        hdata = hostvars[hname]
+        if hname != host_type and hdata.get('physical_host') != host_type:
+            continue
+
         is_metal = False
         properties = hdata.get('properties')
         if properties:
@@ -305,31 +1726,21 @@ def _append_to_host_groups(inventory, container_type, assignment, host_type,
                     if container.startswith(host_type):
                         append_if(array=iph, item=container)
 
-                # Append any options in config to the host_vars of a container
-                container_vars = host_options.get('container_vars')
-                if isinstance(container_vars, dict):
-                    for _keys, _vars in container_vars.items():
-                        # Copy the options dictionary for manipulation
-                        if isinstance(_vars, dict):
-                            options = _vars.copy()
-                        else:
-                            options = _vars
-
-                        limit = None
-                        # If a limit is set use the limit string as a filter
-                        # for the container name and see if it matches.
-                        if isinstance(options, (str, dict, list)):
-                            if 'limit_container_types' in options:
-                                limit = options.pop(
-                                    'limit_container_types', None
-                                )
-
-                        if limit is None or (component and limit in component):
-                            hdata[_keys] = options
+                # Append any options in config to the host_vars of a
+                # container, copying them so containers never share them.
+                applied_key = (physical_host_type, hname, component)
+                if applied_key in applied:
+                    continue
+                applied.add(applied_key)
+                resolved = _resolve_container_vars(compiled_vars, component)
+                for _keys, _vars in resolved.iteritems():
+                    if isinstance(_vars, dict):
+                        _vars = _vars.copy()
+                    hdata[_keys] = _vars
 
 
 def _add_container_hosts(assignment, config, container_name, container_type,
-                         inventory, properties):
+                         inventory, properties, index, changed_hosts=None):
     """Add a given container name and type to the hosts.
 
     :param assignment: ``str`` Name of container component target
@@ -338,6 +1749,8 @@ def _add_container_hosts(assignment, config, container_name, container_type,
     :param container_type: ``str``  Type of container
     :param inventory: ``dict``  Living dictionary of inventory
     :param properties: ``dict``  Dict of container properties
+    :param index: ``dict`` Hostvars index as returned by ``_index_hostvars``
+    :param changed_hosts: ``set`` Physical hosts to process, all if ``None``
     """
     physical_host_type = '%s_hosts' % container_type.split('_')[0]
     # If the physical host type is not in config return
@@ -351,6 +1764,10 @@ def _add_container_hosts(assignment, config, container_name, container_type,
         if host_type not in config[physical_host_type]:
             continue
 
+        # Containers of unchanged hosts are already in the inventory
+        if changed_hosts is not None and host_type not in changed_hosts:
+            continue
+
         # Get any set host options
         host_options = config[physical_host_type][host_type]
         affinity = host_options.get('affinity', {})
@@ -392,36 +1809,46 @@ def _add_container_hosts(assignment, config, container_name, container_type,
             config,
             properties,
             assignment,
+            index,
         )
 
         # Add the physical host type to all containers from the built inventory
-        _append_container_types(inventory, host_type)
+        _append_container_types(inventory, host_type, type_and_name, index)
         _append_to_host_groups(
             inventory,
             container_type,
             assignment,
             host_type,
             type_and_name,
-            host_options
+            host_options,
+            index
         )
 
 
-def user_defined_setup(config, inventory):
+def user_defined_setup(config, inventory, changed_hosts=None):
     """Apply user defined entries from config into inventory.
 
     :param config: ``dict``  User defined information
     :param inventory: ``dict``  Living dictionary of inventory
+    :param changed_hosts: ``set`` Physical hosts whose hostvars are updated,
+                          all if ``None``
     """
     hvs = inventory['_meta']['hostvars']
     for key, value in config.iteritems():
         if key.endswith('hosts'):
             if key not in inventory:
-                inventory[key] = {'hosts': []}
+                inventory[key] = {'hosts': GroupMembers()}
 
             if value is None:
                 return
 
             for _key, _value in value.iteritems():
+                USED_IPS.add(_value['ip'])
+                append_if(array=inventory[key]['hosts'], item=_key)
+
+                if changed_hosts is not None and _key not in changed_hosts:
+                    continue
+
                 if _key not in hvs:
                     hvs[_key] = {}
 
@@ -443,9 +1870,6 @@ def user_defined_setup(config, inventory):
                     for _k, _v in _value['host_vars'].items():
                         hvs[_key][_k] = _v
 
-                append_if(array=USED_IPS, item=_value['ip'])
-                append_if(array=inventory[key]['hosts'], item=_key)
-
 
 def skel_setup(environment, inventory):
     """Build out the main inventory skeleton as needed.
@@ -461,21 +1885,21 @@ def skel_setup(environment, inventory):
                 inventory[_key] = {}
                 if _key.endswith('container'):
                     if 'hosts' not in inventory[_key]:
-                        inventory[_key]['hosts'] = []
+                        inventory[_key]['hosts'] = GroupMembers()
                 else:
                     if 'children' not in inventory[_key]:
-                        inventory[_key]['children'] = []
+                        inventory[_key]['children'] = GroupMembers()
                     if 'hosts' not in inventory[_key]:
-                        inventory[_key]['hosts'] = []
+                        inventory[_key]['hosts'] = GroupMembers()
 
             if 'belongs_to' in _value:
                 for assignment in _value['belongs_to']:
                     if assignment not in inventory:
                         inventory[assignment] = {}
                         if 'children' not in inventory[assignment]:
-                            inventory[assignment]['children'] = []
+                            inventory[assignment]['children'] = GroupMembers()
                         if 'hosts' not in inventory[assignment]:
-                            inventory[assignment]['hosts'] = []
+                            inventory[assignment]['hosts'] = GroupMembers()
 
 
 def skel_load(skeleton, inventory):
@@ -492,30 +1916,33 @@ def skel_load(skeleton, inventory):
         )
 
 
-def _load_optional_q(config, cidr_name):
+def _load_optional_q(config, cidr_name, bitmap=None, stable=False):
     """Load optional queue with ip addresses.
 
     :param config: ``dict``  User defined information
     :param cidr_name: ``str``  Name of the cidr name
+    :param bitmap: ``object`` ``IPBitmap`` of the network, if any
+    :param stable: ``bol`` derive addresses from a hash of the host name
     """
     cidr = config.get(cidr_name)
     ip_q = None
     if cidr is not None:
-        ip_q = Queue.Queue()
-        _load_ip_q(cidr=cidr, ip_q=ip_q)
+        ip_q = _load_ip_q(cidr=cidr, bitmap=bitmap, stable=stable)
     return ip_q
 
 
-def _add_additional_networks(key, inventory, ip_q, q_name, netmask, interface,
-                             bridge, net_type, net_mtu, user_config,
+def _add_additional_networks(hosts, inventory, ip_q, q_name, netmask,
+                             interface, bridge, net_type, net_mtu, user_config,
                              is_ssh_address, is_container_address,
-                             static_routes):
+                             static_routes, ipv6_q=None, ipv6_q_name=None,
+                             ipv6_netmask=None):
     """Process additional ip adds and append then to hosts as needed.
 
     If the host is found to be "is_metal" it will be marked as "on_metal"
     and will not have an additionally assigned IP address.
 
-    :param key: ``str`` Component key name.
+    :param hosts: ``list`` Hosts bound to the network, as from
+                  ``_get_bound_hosts``.
     :param inventory: ``dict``  Living dictionary of inventory.
     :param ip_q: ``object`` build queue of IP addresses.
     :param q_name: ``str`` key to use in host vars for storage.
@@ -525,6 +1952,9 @@ def _add_additional_networks(key, inventory, ip_q, q_name, netmask, interface,
     :param is_ssh_address: ``bol`` set this address as ansible_ssh_host.
     :param is_container_address: ``bol`` set this address to container_address.
     :param static_routes: ``list`` List containing static route dicts.
+    :param ipv6_q: ``object`` build queue of IPv6 addresses for dual-stack.
+    :param ipv6_q_name: ``str`` name of the IPv6 network in cidr_networks.
+    :param ipv6_netmask: ``str`` IPv6 netmask to use.
     """
     def network_entry():
         """Return a network entry for a container."""
@@ -561,32 +1991,7 @@ def _add_additional_networks(key, inventory, ip_q, q_name, netmask, interface,
             return netmask
 
     base_hosts = inventory['_meta']['hostvars']
-    lookup = inventory.get(key, list())
-
-    if 'children' in lookup and lookup['children']:
-        for group in lookup['children']:
-            _add_additional_networks(
-                group,
-                inventory,
-                ip_q,
-                q_name,
-                netmask,
-                interface,
-                bridge,
-                net_type,
-                net_mtu,
-                user_config,
-                is_ssh_address,
-                is_container_address,
-                static_routes
-            )
-
-    # Make sure the lookup object has a value.
-    if lookup:
-        hosts = lookup.get('hosts')
-        if not hosts:
-            return
-    else:
+    if not hosts:
         return
 
     # TODO(cloudnull) after a few releases this should be removed.
@@ -620,7 +2025,9 @@ def _add_additional_networks(key, inventory, ip_q, q_name, netmask, interface,
             if old_address in container and container[old_address]:
                 network['address'] = container.pop(old_address)
             elif not is_metal:
-                address = get_ip_address(name=q_name, ip_q=ip_q)
+                address = get_ip_address(
+                    name=q_name, ip_q=ip_q, key=container_host
+                )
                 if address:
                     network['address'] = address
 
@@ -642,6 +2049,15 @@ def _add_additional_networks(key, inventory, ip_q, q_name, netmask, interface,
                     phg = user_config[cphg][container_host]
                     network['address'] = phg['ip']
 
+        # Dual-stack networks get an IPv6 address next to the IPv4 one.
+        if ipv6_q and not is_metal:
+            network = networks[old_address]
+            if not network.get('ipv6_address'):
+                network['ipv6_address'] = get_ip_address(
+                    name=ipv6_q_name, ip_q=ipv6_q, key=container_host
+                )
+            network['ipv6_netmask'] = ipv6_netmask
+
         if is_ssh_address is True:
             container['ansible_ssh_host'] = networks[old_address]['address']
 
@@ -686,13 +2102,16 @@ def _net_address_search(provider_networks, main_network, key):
     return provider_networks
 
 
-def container_skel_load(container_skel, inventory, config):
+def container_skel_load(container_skel, inventory, config,
+                        changed_hosts=None):
     """Build out all containers as defined in the environment file.
 
     :param container_skel: ``dict`` container skeleton for all known containers
     :param inventory: ``dict``  Living dictionary of inventory
     :param config: ``dict``  User defined information
+    :param changed_hosts: ``set`` Physical hosts to process, all if ``None``
     """
+    index = _index_hostvars(inventory)
     for key, value in container_skel.iteritems():
         for assignment in value['contains']:
             for container_type in value['belongs_to']:
@@ -702,82 +2121,303 @@ def container_skel_load(container_skel, inventory, config):
                     key,
                     container_type,
                     inventory,
-                    value.get('properties')
+                    value.get('properties'),
+                    index,
+                    changed_hosts
                 )
-    else:
-        cidr_networks = config.get('cidr_networks')
-        provider_queues = {}
-        for net_name in cidr_networks:
-            ip_q = _load_optional_q(
-                cidr_networks, cidr_name=net_name
-            )
-            provider_queues[net_name] = ip_q
-            if ip_q is not None:
-                net = netaddr.IPNetwork(cidr_networks.get(net_name))
-                provider_queues['%s_netmask' % net_name] = str(net.netmask)
-
-        overrides = config['global_overrides']
-        # iterate over a list of provider_networks, var=pn
-        pns = overrides.get('provider_networks', list())
-        pns = _net_address_search(
-            provider_networks=pns,
-            main_network=config['global_overrides']['management_bridge'],
-            key='is_ssh_address'
-        )
 
-        pns = _net_address_search(
-            provider_networks=pns,
-            main_network=config['global_overrides']['management_bridge'],
-            key='is_container_address'
+
+def provider_networks_load(inventory, config, ip_bitmaps=None,
+                           group_hosts=None, changed_hosts=None):
+    """Add the provider networks and their addresses to all hosts.
+
+    :param inventory: ``dict``  Living dictionary of inventory
+    :param config: ``dict``  User defined information
+    :param ip_bitmaps: ``dict`` ``IPBitmap`` objects keyed on network name
+    :param group_hosts: ``dict`` Memoised hosts of groups, as filled in by
+                        ``_get_group_hosts``
+    :param changed_hosts: ``set`` Physical hosts whose containers are
+                          processed, all if ``None``
+    """
+    if ip_bitmaps is None:
+        ip_bitmaps = dict()
+    if group_hosts is None:
+        group_hosts = dict()
+
+    cidr_networks = config.get('cidr_networks')
+    provider_queues = {}
+    for net_name in cidr_networks:
+        ip_q = _load_optional_q(
+            cidr_networks,
+            cidr_name=net_name,
+            bitmap=ip_bitmaps.get(net_name),
+            stable=config.get('ip_allocation_mode') == 'hash'
         )
+        provider_queues[net_name] = ip_q
+        if ip_q is not None:
+            net = CIDRNetwork(cidr_networks.get(net_name))
+            provider_queues['%s_netmask' % net_name] = str(net.netmask)
+
+    overrides = config['global_overrides']
+    # iterate over a list of provider_networks, var=pn
+    pns = overrides.get('provider_networks', list())
+    pns = _net_address_search(
+        provider_networks=pns,
+        main_network=config['global_overrides']['management_bridge'],
+        key='is_ssh_address'
+    )
 
-        for pn in pns:
-            # p_net are the provider_network values
-            p_net = pn.get('network')
-            if not p_net:
-                continue
+    pns = _net_address_search(
+        provider_networks=pns,
+        main_network=config['global_overrides']['management_bridge'],
+        key='is_container_address'
+    )
 
-            q_name = p_net.get('ip_from_q')
-            ip_from_q = provider_queues.get(q_name)
-            if ip_from_q:
-                netmask = provider_queues['%s_netmask' % q_name]
-            else:
-                netmask = None
-
-            for group in p_net.get('group_binds', list()):
-                _add_additional_networks(
-                    key=group,
-                    inventory=inventory,
-                    ip_q=ip_from_q,
-                    q_name=q_name,
-                    netmask=netmask,
-                    interface=p_net['container_interface'],
-                    bridge=p_net['container_bridge'],
-                    net_type=p_net.get('container_type'),
-                    net_mtu=p_net.get('container_mtu'),
-                    user_config=config,
-                    is_ssh_address=p_net.get('is_ssh_address'),
-                    is_container_address=p_net.get('is_container_address'),
-                    static_routes=p_net.get('static_routes')
-                )
+    for pn in pns:
+        # p_net are the provider_network values
+        p_net = pn.get('network')
+        if not p_net:
+            continue
 
+        q_name = p_net.get('ip_from_q')
+        ip_from_q = provider_queues.get(q_name)
+        if ip_from_q:
+            netmask = provider_queues['%s_netmask' % q_name]
+        else:
+            netmask = None
 
-def find_config_path(user_config_path=None):
-    """Return the path to the user configuration files.
+        ipv6_q_name = p_net.get('ipv6_from_q')
+        ipv6_from_q = provider_queues.get(ipv6_q_name)
+        if ipv6_from_q:
+            ipv6_netmask = provider_queues['%s_netmask' % ipv6_q_name]
+        else:
+            ipv6_netmask = None
 
-    If no directory is found the system will exit.
-    The lookup will be done in the following directories:
-      $(user_config_path)/
-      /etc/openstack_deploy/
+        hosts = _get_bound_hosts(inventory, p_net, group_hosts)
+        if changed_hosts is not None:
+            hostvars = inventory['_meta']['hostvars']
+            hosts = [
+                h for h in hosts
+                if (hostvars[h].get('physical_host') or h) in changed_hosts
+            ]
+
+        _add_additional_networks(
+            hosts=hosts,
+            inventory=inventory,
+            ip_q=ip_from_q,
+            q_name=q_name,
+            netmask=netmask,
+            interface=p_net['container_interface'],
+            bridge=p_net['container_bridge'],
+            net_type=p_net.get('container_type'),
+            net_mtu=p_net.get('container_mtu'),
+            user_config=config,
+            is_ssh_address=p_net.get('is_ssh_address'),
+            is_container_address=p_net.get('is_container_address'),
+            static_routes=p_net.get('static_routes'),
+            ipv6_q=ipv6_from_q,
+            ipv6_q_name=ipv6_q_name,
+            ipv6_netmask=ipv6_netmask
+        )
 
-    :param user_config_path: ``str`` Location to look in FIRST for a file
-    """
-    path_check = [
-        os.path.join('/etc', 'openstack_deploy'),
-    ]
 
-    if user_config_path is not None:
-        path_check.insert(0, os.path.expanduser(user_config_path))
+def _get_group_hosts(inventory, group, group_hosts, seen=None):
+    """Return all hosts of a group, including the hosts of its children.
+
+    Hosts of children come before the group's own hosts and every host is
+    listed once. The result of each group is memoised in ``group_hosts`` so
+    a group bound by several provider networks, or reached through several
+    parents, is only resolved once per run. The returned list is shared and
+    must not be modified.
+
+    :param inventory: ``dict``  Living dictionary of inventory
+    :param group: ``str`` Name of the group
+    :param group_hosts: ``dict`` Memoised hosts of groups
+    :param seen: ``set`` Groups already visited
+    """
+    if group in group_hosts:
+        return group_hosts[group]
+
+    if seen is None:
+        seen = set()
+
+    hosts = GroupMembers()
+    if group in seen:
+        return hosts
+    seen.add(group)
+
+    lookup = inventory.get(group) or dict()
+    for child in lookup.get('children') or list():
+        for host in _get_group_hosts(inventory, child, group_hosts, seen):
+            append_if(array=hosts, item=host)
+    for host in lookup.get('hosts') or list():
+        append_if(array=hosts, item=host)
+
+    group_hosts[group] = hosts
+    return hosts
+
+
+def _get_bound_hosts(inventory, p_net, group_hosts):
+    """Return all hosts bound to a provider network by its ``group_binds``.
+
+    :param inventory: ``dict``  Living dictionary of inventory
+    :param p_net: ``dict`` Provider network definition
+    :param group_hosts: ``dict`` Memoised hosts of groups
+    """
+    hosts = GroupMembers()
+    for group in p_net.get('group_binds', list()):
+        for host in _get_group_hosts(inventory, group, group_hosts):
+            append_if(array=hosts, item=host)
+    return hosts
+
+
+def _count_used_ips(network, bitmap=None):
+    """Return how many addresses of a network are unavailable.
+
+    :param network: ``object`` ``CIDRNetwork`` to count within
+    :param bitmap: ``object`` ``IPBitmap`` of the network, if any
+    """
+    first = network.first
+    used = USED_IPS.size(network.version, first, network.last)
+
+    if bitmap is not None:
+        used += bitmap.count() - sum(
+            bitmap.count(start - first, last - first)
+            for start, last in USED_IPS.ranges(network.version, first,
+                                               network.last)
+        )
+
+    excluded = [network.first]
+    if network.version == 4 and network.broadcast is not None:
+        excluded.append(network.last)
+    for value in excluded:
+        if USED_IPS.has_value(network.version, value):
+            continue
+        if bitmap is not None and bitmap.is_set(value - first):
+            continue
+        used += 1
+
+    return used
+
+
+def network_capacity(inventory, config, ip_bitmaps=None, group_hosts=None):
+    """Return the address capacity of every ``cidr_networks`` entry.
+
+    For each network, the addresses still needed by the hosts bound to it
+    through the ``group_binds`` of the provider networks are compared to the
+    addresses left after ``used_ips`` and all assigned addresses. A host
+    needs a single address from a network however many provider networks
+    take their addresses from it.
+
+    :param inventory: ``dict``  Living dictionary of inventory
+    :param config: ``dict``  User defined information
+    :param ip_bitmaps: ``dict`` ``IPBitmap`` objects keyed on network name
+    :param group_hosts: ``dict`` Memoised hosts of groups, as filled in by
+                        ``_get_group_hosts``
+    :returns: ``list`` of ``dict`` with the capacity of each network
+    """
+    if ip_bitmaps is None:
+        ip_bitmaps = dict()
+    if group_hosts is None:
+        group_hosts = dict()
+
+    cidr_networks = config.get('cidr_networks') or dict()
+    needed = dict((net_name, 0) for net_name in cidr_networks)
+    needed_addresses = set()
+    hostvars = inventory['_meta']['hostvars']
+
+    overrides = config.get('global_overrides') or dict()
+    for pn in overrides.get('provider_networks', list()):
+        p_net = pn.get('network')
+        if not p_net:
+            continue
+
+        q_name = p_net.get('ip_from_q')
+        ipv6_q_name = p_net.get('ipv6_from_q')
+        if q_name:
+            network_key = '%s_address' % q_name
+        else:
+            network_key = '%s_address' % p_net.get('container_interface')
+
+        for host in _get_bound_hosts(inventory, p_net, group_hosts):
+            container = hostvars[host]
+            properties = container.get('properties') or dict()
+            if properties.get('is_metal', False):
+                continue
+
+            networks = container.get('container_networks') or dict()
+            network = networks.get(network_key) or dict()
+            if q_name in needed and not network.get('address'):
+                if not container.get(network_key):
+                    needed_addresses.add((host, q_name))
+            if ipv6_q_name in needed and not network.get('ipv6_address'):
+                needed_addresses.add((host, ipv6_q_name))
+
+    for _, net_name in needed_addresses:
+        needed[net_name] += 1
+
+    capacity = list()
+    for net_name, cidr in sorted(cidr_networks.items()):
+        network = CIDRNetwork(cidr)
+        available = network.size - _count_used_ips(
+            network, ip_bitmaps.get(net_name)
+        )
+        capacity.append({
+            'network': net_name,
+            'cidr': str(network),
+            'needed': needed[net_name],
+            'available': available,
+            'headroom': available - needed[net_name]
+        })
+    return capacity
+
+
+def _check_network_capacity(capacity):
+    """Exit with a capacity table if any network is too small.
+
+    :param capacity: ``list`` Network capacity as from ``network_capacity``
+    """
+    short = [net['network'] for net in capacity if net['headroom'] < 0]
+    if not short:
+        return
+
+    columns = ['network', 'cidr', 'needed', 'available', 'headroom']
+    rows = [columns]
+    for net in capacity:
+        rows.append([str(net[column]) for column in columns])
+    widths = [
+        max(len(row[idx]) for row in rows) for idx in range(len(columns))
+    ]
+    table = '\n'.join(
+        '  '.join(
+            value.ljust(width) for value, width in zip(row, widths)
+        ).rstrip()
+        for row in rows
+    )
+
+    raise SystemExit(
+        'Not enough IP addresses available for the requested containers.'
+        ' Increase the %s range in your openstack_user_config.yml.\n\n%s'
+        % (', '.join(short), table)
+    )
+
+
+def find_config_path(user_config_path=None):
+    """Return the path to the user configuration files.
+
+    If no directory is found the system will exit.
+    The lookup will be done in the following directories:
+      $(user_config_path)/
+      /etc/openstack_deploy/
+
+    :param user_config_path: ``str`` Location to look in FIRST for a file
+    """
+    path_check = [
+        os.path.join('/etc', 'openstack_deploy'),
+    ]
+
+    if user_config_path is not None:
+        path_check.insert(0, os.path.expanduser(user_config_path))
 
     for f in path_check:
         if os.path.isdir(f):
@@ -786,46 +2426,119 @@ def find_config_path(user_config_path=None):
         raise SystemExit('No config found at: %s' % path_check)
 
 
-def _set_used_ips(user_defined_config, inventory):
-    """Set all of the used ips into a global list.
+def load_ip_bitmaps(config_path, cidr_networks, checksum, valid_only=False):
+    """Open the allocation bitmap of every ``cidr_networks`` entry.
+
+    :param config_path: ``str`` path where the inventory files are kept
+    :param cidr_networks: ``dict`` cidr_networks from config
+    :param checksum: ``str`` Checksum of the current inventory file
+    :param valid_only: ``bol`` only open the bitmaps that match the inventory
+                       file, so no bitmap file is created or reset
+    """
+    ip_bitmaps = dict()
+    for net_name, cidr in cidr_networks.items():
+        if CIDRNetwork(cidr).size > IP_BITMAP_MAX_SIZE:
+            continue
+
+        bitmap_file = os.path.join(
+            config_path, 'openstack_inventory.%s.bitmap' % net_name
+        )
+        if valid_only and not IPBitmap.matches(bitmap_file, cidr, checksum):
+            continue
+        ip_bitmaps[net_name] = IPBitmap(bitmap_file, cidr, checksum)
+    return ip_bitmaps
+
+
+def _assigned_addresses(inventory):
+    """Yield every address assigned in the hostvars.
+
+    :param inventory: ``dict`` Living inventory of containers and hosts
+    """
+    for host_entry in inventory['_meta']['hostvars'].values():
+        networks = host_entry.get('container_networks', dict())
+        for network_entry in networks.values():
+            for address_key in ('address', 'ipv6_address'):
+                address = network_entry.get(address_key)
+                if address:
+                    yield address
+
+
+def _rebuild_ip_bitmaps(inventory, ip_bitmaps):
+    """Mark the addresses assigned in the hostvars in fresh bitmaps.
+
+    :param inventory: ``dict`` Living inventory of containers and hosts
+    :param ip_bitmaps: ``dict`` ``IPBitmap`` objects keyed on network name
+    """
+    if not ip_bitmaps:
+        return
+    for bitmap in ip_bitmaps.values():
+        bitmap.reset()
+    for address in _assigned_addresses(inventory):
+        for bitmap in ip_bitmaps.values():
+            offset = bitmap.offset(address)
+            if offset is not None:
+                bitmap.set(offset)
+
+
+def _set_used_ips(user_defined_config, inventory, ip_bitmaps=None):
+    """Set all of the used ips into the global range set.
+
+    When every ``cidr_networks`` entry has an allocation bitmap that matches
+    the loaded inventory, the addresses already assigned to hosts are taken
+    from the bitmaps and the hostvars are not scanned. Otherwise the bitmaps
+    are rebuilt from the hostvars.
 
     :param user_defined_config: ``dict`` User defined configuration
     :param inventory: ``dict`` Living inventory of containers and hosts
+    :param ip_bitmaps: ``dict`` ``IPBitmap`` objects keyed on network name
     """
+    if ip_bitmaps is None:
+        ip_bitmaps = dict()
+
     used_ips = user_defined_config.get('used_ips')
     if isinstance(used_ips, list):
         for ip in used_ips:
             split_ip = ip.split(',')
             if len(split_ip) >= 2:
-                ip_range = list(
-                    netaddr.iter_iprange(
-                        split_ip[0],
-                        split_ip[-1]
-                    )
-                )
-                USED_IPS.extend([str(i) for i in ip_range])
+                USED_IPS.add_range(split_ip[0], split_ip[-1])
             else:
-                append_if(array=USED_IPS, item=split_ip[0])
+                USED_IPS.add(split_ip[0])
+
+    # Networks too large for a bitmap, such as IPv6 networks, always need the
+    # hostvars scan but any valid bitmap is left as it is.
+    cidr_networks = user_defined_config.get('cidr_networks') or dict()
+    invalid_bitmaps = [b for b in ip_bitmaps.values() if not b.valid]
+    if not invalid_bitmaps and set(ip_bitmaps) == set(cidr_networks):
+        return
+
+    for bitmap in invalid_bitmaps:
+        bitmap.reset()
 
     # Find all used IP addresses and ensure that they are not used again
-    for host_entry in inventory['_meta']['hostvars'].values():
-        networks = host_entry.get('container_networks', dict())
-        for network_entry in networks.values():
-            address = network_entry.get('address')
-            if address:
-                append_if(array=USED_IPS, item=address)
+    for address in _assigned_addresses(inventory):
+        USED_IPS.add(address)
+        for bitmap in invalid_bitmaps:
+            offset = bitmap.offset(address)
+            if offset is not None:
+                bitmap.set(offset)
 
 
-def _ensure_inventory_uptodate(inventory, container_skel):
+def _ensure_inventory_uptodate(inventory, container_skel, changed_hosts=None):
     """Update inventory if needed.
 
     Inspect the current inventory and ensure that all host items have all of
     the required entries.
 
     :param inventory: ``dict`` Living inventory of containers and hosts
+    :param changed_hosts: ``set`` Physical hosts whose entries are updated,
+                          all if ``None``
     """
     host_vars = inventory['_meta']['hostvars']
     for hostname, _vars in host_vars.items():
+        if changed_hosts is not None:
+            if (_vars.get('physical_host') or hostname) not in changed_hosts:
+                continue
+
         if 'container_name' not in _vars:
             _vars['container_name'] = hostname
 
@@ -845,10 +2558,500 @@ def _ensure_inventory_uptodate(inventory, container_skel):
         if hosts:
             for host in hosts:
                 container = host_vars[host]
+                if changed_hosts is not None:
+                    physical_host = container.get('physical_host') or host
+                    if physical_host not in changed_hosts:
+                        continue
                 if 'properties' in type_vars:
                     container['properties'] = type_vars['properties']
 
 
+def _host_config_fingerprints(user_defined_config, environment):
+    """Return a fingerprint of the configuration of each physical host.
+
+    The fingerprint of a host covers its entries in every ``*_hosts`` group,
+    such as its address, affinity and ``container_vars``, along with the
+    environment and the rest of the user configuration that apply to all
+    hosts.
+
+    :param user_defined_config: ``dict`` User defined configuration
+    :param environment: ``dict`` Known environment information
+    :returns: ``dict`` of ``str`` fingerprints keyed on host name
+    """
+    shared_config = dict(
+        (key, value) for key, value in user_defined_config.iteritems()
+        if not key.endswith('hosts')
+    )
+    shared_fingerprint = hashlib.sha1(
+        json.dumps([shared_config, environment], sort_keys=True)
+    ).hexdigest()
+
+    host_config = dict()
+    for key, value in user_defined_config.iteritems():
+        if key.endswith('hosts') and isinstance(value, dict):
+            for host, entry in value.iteritems():
+                host_config.setdefault(host, dict())[key] = entry
+
+    return dict(
+        (host, hashlib.sha1(
+            json.dumps([shared_fingerprint, entries], sort_keys=True)
+        ).hexdigest())
+        for host, entries in host_config.iteritems()
+    )
+
+
+def _host_fingerprints(inventory, config_fingerprints):
+    """Return a fingerprint of each physical host of the inventory.
+
+    The configuration fingerprint of a host is combined with the hostvars of
+    the host and of its containers, so hand made changes to the inventory are
+    picked up as well.
+
+    :param inventory: ``dict`` Living inventory of containers and hosts
+    :param config_fingerprints: ``dict`` as returned by
+                                ``_host_config_fingerprints``
+    :returns: ``dict`` of ``str`` fingerprints keyed on physical host name
+    """
+    host_members = dict((host, dict()) for host in config_fingerprints)
+    for hname, hdata in inventory['_meta']['hostvars'].iteritems():
+        physical_host = hdata.get('physical_host') or hname
+        host_members.setdefault(physical_host, dict())[hname] = hdata
+
+    return dict(
+        (host, hashlib.sha1(
+            json.dumps(
+                [config_fingerprints.get(host), members], sort_keys=True
+            )
+        ).hexdigest())
+        for host, members in host_members.iteritems()
+    )
+
+
+def _get_changed_hosts(inventory, config_fingerprints):
+    """Return the physical hosts that have to be processed again.
+
+    A host is unchanged when its fingerprint matches the one saved in the
+    inventory by the previous run.
+
+    :param inventory: ``dict`` Living inventory of containers and hosts
+    :param config_fingerprints: ``dict`` as returned by
+                                ``_host_config_fingerprints``
+    :returns: ``set`` of physical host names
+    """
+    saved_fingerprints = inventory['_meta'].get('fingerprints') or dict()
+    return set(
+        host for host, fingerprint in _host_fingerprints(
+            inventory, config_fingerprints
+        ).iteritems()
+        if saved_fingerprints.get(host) != fingerprint
+    )
+
+
+def _group_vars_dirs(config_path):
+    """Return the ``group_vars`` directories used along with the inventory.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    """
+    return [
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'group_vars'),
+        os.path.join(config_path, 'group_vars')
+    ]
+
+
+def _group_vars_files(config_path):
+    """Return the ``group_vars`` files and the groups they apply to.
+
+    Files are either named after their group or kept in a directory named
+    after it.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :returns: ``list`` of ``tuple`` of the group name and the file path
+    """
+    group_vars_files = list()
+    for group_vars_dir in _group_vars_dirs(config_path):
+        for root_dir, _, files in os.walk(group_vars_dir):
+            for name in sorted(files):
+                if not name.endswith(('.yml', '.yaml')):
+                    continue
+                if root_dir == group_vars_dir:
+                    group = os.path.splitext(name)[0]
+                else:
+                    group = os.path.relpath(
+                        root_dir, group_vars_dir
+                    ).split(os.sep)[0]
+                group_vars_files.append((group, os.path.join(root_dir, name)))
+    return group_vars_files
+
+
+def _group_vars_file_keys(config_path, parsed_cache):
+    """Return the variables set in ``group_vars`` files.
+
+    Variables of ``group_vars`` files next to the inventory take precedence
+    over the group variables of the inventory itself, so these variables
+    can not be moved out of the hostvars.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param parsed_cache: ``object`` ``ParsedConfigCache`` to parse files with
+    :returns: ``set`` of variable names
+    """
+    keys = set()
+    for _, file_path in _group_vars_files(config_path):
+        group_vars = parsed_cache.load(file_path)
+        if isinstance(group_vars, dict):
+            keys.update(group_vars)
+    return keys
+
+
+def _group_vars_references(config_path):
+    """Return the groups used by the templates of ``group_vars`` files.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :returns: ``dict`` of ``set`` of referenced groups, keyed on the group
+              the ``group_vars`` file applies to
+    """
+    references = dict()
+    for group, file_path in _group_vars_files(config_path):
+        with open(file_path, 'rb') as f:
+            references.setdefault(group, set()).update(
+                GROUP_REFERENCE.findall(f.read())
+            )
+    return references
+
+
+def _parse_group_patterns(limit_groups):
+    """Split a ``--limit-groups`` value into its group patterns.
+
+    :param limit_groups: ``str`` patterns separated by colons or commas
+    :returns: ``list`` of ``str`` patterns
+    """
+    return [
+        pattern for pattern in re.split(r'[:,\s]+', limit_groups or '')
+        if pattern
+    ]
+
+
+def _limit_groups(inventory, patterns, group_vars_references):
+    """Limit the inventory to the groups matching a list of patterns.
+
+    The groups matching the patterns are kept along with their child groups
+    and their parent groups. Groups used by the ``group_vars`` files of any of
+    these groups are kept as well, in the same way. The hosts of the kept
+    groups are limited to the hosts of the matching and used groups, and
+    only the hostvars of those hosts are kept.
+
+    :param inventory: ``dict`` Living inventory of containers and hosts
+    :param patterns: ``list`` of shell style patterns of group names
+    :param group_vars_references: ``dict`` as returned by
+                                  ``_group_vars_references``
+    """
+    groups = set(
+        key for key, value in inventory.iteritems()
+        if key != '_meta' and isinstance(value, dict)
+    )
+    parents = dict()
+    for group in groups:
+        for child in inventory[group].get('children') or list():
+            parents.setdefault(child, set()).add(group)
+
+    selected = set(
+        group for group in groups
+        if any(fnmatch.fnmatchcase(group, pattern) for pattern in patterns)
+    )
+    if not selected:
+        raise SystemExit(
+            'No inventory groups match "%s"' % ':'.join(patterns)
+        )
+
+    while True:
+        # Child groups provide the hosts of the selected groups
+        members = set()
+        pending = list(selected)
+        while pending:
+            group = pending.pop()
+            if group in members or group not in groups:
+                continue
+            members.add(group)
+            pending.extend(inventory[group].get('children') or list())
+
+        # Parent groups provide group variables to the hosts
+        kept = set(['all'])
+        pending = list(members)
+        while pending:
+            group = pending.pop()
+            if group in kept:
+                continue
+            kept.add(group)
+            pending.extend(parents.get(group, set()))
+
+        referenced = set()
+        for group in kept:
+            referenced.update(group_vars_references.get(group, set()))
+        referenced &= groups
+        if referenced <= selected:
+            break
+        selected |= referenced
+
+    hosts = set()
+    group_hosts = dict()
+    for group in members:
+        hosts.update(_get_group_hosts(inventory, group, group_hosts))
+
+    for group in groups - kept:
+        del inventory[group]
+    for group in kept & groups:
+        for member_type, allowed in (('hosts', hosts), ('children', kept)):
+            if member_type in inventory[group]:
+                inventory[group][member_type] = [
+                    m for m in inventory[group][member_type] if m in allowed
+                ]
+
+    hostvars = inventory['_meta']['hostvars']
+    for host in hostvars.keys():
+        if host not in hosts:
+            del hostvars[host]
+
+
+def _hoist_group_vars(inventory, excluded_keys=()):
+    """Move hostvars shared by all hosts of a group into its group vars.
+
+    A top level hostvar is moved when every host of a group, including the
+    hosts of its child groups, has the same value for it. Groups are handled
+    from the largest to the smallest and a group only gets the variable when
+    it covers a host that no larger group covered yet. Each host keeps the
+    same value of every variable, as the moved value is the host's own value
+    in every group that gets it. The ``all`` group and groups of a single
+    host are left alone, as are variables already set as group vars.
+
+    :param inventory: ``dict`` Living inventory of containers and hosts
+    :param excluded_keys: ``set`` variables that are never moved
+    """
+    hostvars = inventory['_meta']['hostvars']
+    groups = [
+        key for key, value in inventory.iteritems()
+        if key not in ('_meta', 'all') and isinstance(value, dict)
+    ]
+
+    excluded_keys = set(excluded_keys)
+    for group in groups:
+        excluded_keys.update(inventory[group].get('vars') or dict())
+
+    group_hosts = dict()
+    sized_groups = list()
+    for group in groups:
+        hosts = _get_group_hosts(inventory, group, group_hosts)
+        if len(hosts) > 1:
+            sized_groups.append((-len(hosts), group, hosts))
+    sized_groups.sort()
+
+    missing = object()
+    hoisted = set()
+    for _, group, hosts in sized_groups:
+        if any(h not in hostvars for h in hosts):
+            continue
+
+        first_vars = hostvars[hosts[0]]
+        for key, value in first_vars.iteritems():
+            if key in excluded_keys:
+                continue
+            if any(hostvars[h].get(key, missing) != value for h in hosts[1:]):
+                continue
+            if all((h, key) in hoisted for h in hosts):
+                continue
+
+            inventory[group].setdefault('vars', dict())[key] = value
+            hoisted.update((h, key) for h in hosts)
+
+    for host, key in hoisted:
+        del hostvars[host][key]
+
+
+def _host_addresses(host_vars):
+    """Return the address hostvars of a host.
+
+    :param host_vars: ``dict`` hostvars of the host
+    """
+    return dict(
+        (key, value) for key, value in host_vars.iteritems()
+        if key.endswith('address') or key == 'ansible_ssh_host'
+    )
+
+
+def _host_shards(inventory, shard_key):
+    """Return the shard of every host.
+
+    A container is in the shard named by the ``shard_key`` hostvar of its
+    physical host, or else by its own. Other hosts are in the shard named
+    by their own ``shard_key`` hostvar. With ``physical_host_group`` as the
+    shard key, a physical host listed under several ``*_hosts`` groups has
+    no single shard, so this is refused.
+
+    :param inventory: ``dict`` inventory as generated
+    :param shard_key: ``str`` hostvar naming the shard of a host
+    :returns: ``dict`` of shard names keyed on the host names, ``None``
+              for the hosts in no shard
+    """
+    hostvars = inventory['_meta']['hostvars']
+
+    host_groups = dict()
+    if shard_key == 'physical_host_group':
+        for name, group in inventory.iteritems():
+            if name.endswith('_hosts') and isinstance(group, dict):
+                for host in group.get('hosts') or list():
+                    host_groups.setdefault(host, list()).append(name)
+
+    host_shards = dict()
+    for host, host_vars in hostvars.iteritems():
+        physical_host = host_vars.get('physical_host')
+        if physical_host in (None, host) or physical_host not in hostvars:
+            if len(host_groups.get(host, ())) > 1:
+                raise SystemExit(
+                    "%s is listed under several groups, it can't be sharded"
+                    " on physical_host_group: %s"
+                    % (host, ', '.join(sorted(host_groups[host])))
+                )
+            shard = host_vars.get(shard_key)
+        else:
+            shard = hostvars[physical_host].get(shard_key)
+            if shard is None:
+                shard = host_vars.get(shard_key)
+
+        if shard is not None:
+            shard = str(shard)
+            if not INVENTORY_SHARD_NAME.match(shard):
+                raise SystemExit(
+                    "%s of %s is not a valid shard name: %s"
+                    % (shard_key, host, shard)
+                )
+        host_shards[host] = shard
+    return host_shards
+
+
+def _shard_inventories(inventory, shard_key):
+    """Split the inventory into shards.
+
+    Every shard has all of the groups, but only the hosts of the shard and
+    the hosts in no shard. The groups with hosts in more than one shard are
+    listed in the manifest, along with the addresses of the hosts of these
+    groups. The manifest is also set as the ``inventory_shard_manifest``
+    variable of every shard, so the hosts of other shards can be used.
+
+    :param inventory: ``dict`` inventory as generated
+    :param shard_key: ``str`` hostvar naming the shard of a host
+    :returns: ``tuple`` of the inventory of each shard, keyed on the shard
+              name, and the manifest
+    """
+    host_shards = _host_shards(inventory, shard_key)
+    hostvars = inventory['_meta']['hostvars']
+    groups = dict(
+        (name, group) for name, group in inventory.iteritems()
+        if name != '_meta' and isinstance(group, dict)
+    )
+
+    shared_groups = dict()
+    shared_hosts = dict()
+    for name, group in groups.iteritems():
+        hosts = group.get('hosts') or list()
+        group_shards = set(host_shards.get(h) for h in hosts)
+        group_shards.discard(None)
+        if len(group_shards) < 2:
+            continue
+        shared_groups[name] = list(hosts)
+        for host in hosts:
+            if host_shards.get(host) is not None:
+                shared_hosts[host] = _host_addresses(hostvars[host])
+                shared_hosts[host]['inventory_shard'] = host_shards[host]
+
+    shard_names = sorted(set(host_shards.values()) - set([None]))
+    manifest = {
+        'shard_key': shard_key,
+        'shards': dict((n, INVENTORY_SHARD_FILE % n) for n in shard_names),
+        'groups': shared_groups,
+        'hosts': shared_hosts
+    }
+
+    shards = dict()
+    for shard in shard_names:
+        members = set(
+            host for host, host_shard in host_shards.iteritems()
+            if host_shard in (shard, None)
+        )
+        shard_inventory = shards[shard] = {
+            '_meta': {
+                'hostvars': dict((h, hostvars[h]) for h in members)
+            }
+        }
+        for name, group in groups.iteritems():
+            shard_group = shard_inventory[name] = dict(group)
+            if 'hosts' in group:
+                shard_group['hosts'] = [
+                    h for h in group['hosts'] if h in members
+                ]
+
+        all_group = shard_inventory['all'] = dict(groups.get('all', dict()))
+        all_group['vars'] = dict(
+            all_group.get('vars') or dict(),
+            inventory_shard=shard,
+            inventory_shard_manifest={
+                'groups': shared_groups,
+                'hosts': shared_hosts
+            }
+        )
+    return shards, manifest
+
+
+def save_inventory_shards(config_path, inventory, shard_key):
+    """Save the inventory of every shard and the shard manifest.
+
+    The files of the shards that no longer have any host are removed.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param inventory: ``dict`` inventory as generated
+    :param shard_key: ``str`` hostvar naming the shard of a host
+    :returns: ``dict`` of the inventory of each shard, keyed on the shard
+              name
+    """
+    shards, manifest = _shard_inventories(inventory, shard_key)
+    remove_inventory_shards(config_path, manifest['shards'].values())
+
+    for shard, shard_inventory in shards.iteritems():
+        _write_file(
+            os.path.join(config_path, INVENTORY_SHARD_FILE % shard),
+            dump_json(shard_inventory)
+        )
+    _write_file(
+        os.path.join(config_path, INVENTORY_SHARD_MANIFEST_FILE),
+        dump_json(manifest)
+    )
+    return shards
+
+
+def remove_inventory_shards(config_path, kept_files=None):
+    """Remove the shard files listed in the saved shard manifest.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param kept_files: ``list`` names of the shard files to keep. The
+                       manifest itself is also removed if ``None``.
+    """
+    manifest_file_path = os.path.join(
+        config_path, INVENTORY_SHARD_MANIFEST_FILE
+    )
+    try:
+        saved = json.loads(_read_file(manifest_file_path) or '{}')
+    except ValueError:
+        saved = dict()
+
+    removed = set(saved.get('shards', dict()).values())
+    removed.difference_update(kept_files or ())
+    removed = [os.path.basename(shard_file) for shard_file in removed]
+    if kept_files is None:
+        removed.append(INVENTORY_SHARD_MANIFEST_FILE)
+    for file_name in removed:
+        try:
+            os.remove(os.path.join(config_path, file_name))
+        except OSError:
+            pass
+
+
 def _parse_global_variables(user_cidr, inventory, user_defined_config):
     """Add any extra variables that may have been set in config.
 
@@ -900,20 +3103,31 @@ def _merge_dict(base_items, new_items):
     return base_items
 
 
-def _extra_config(user_defined_config, base_dir):
+def _parse_yaml(content):
+    """Parse YAML safely, with the libyaml based loader when available.
+
+    :param content: ``str`` YAML document
+    """
+    import yaml
+
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(content, Loader=loader)
+
+
+def _extra_config(user_defined_config, base_dir, parsed_cache):
     """Discover new items in any extra directories and add the new values.
 
     :param user_defined_config: ``dict``
     :param base_dir: ``str``
+    :param parsed_cache: ``object`` ``ParsedConfigCache`` to parse files with
     """
     for root_dir, _, files in os.walk(base_dir):
         for name in files:
             if name.endswith(('.yml', '.yaml')):
-                with open(os.path.join(root_dir, name), 'rb') as f:
-                    _merge_dict(
-                        user_defined_config,
-                        yaml.safe_load(f.read()) or {}
-                    )
+                _merge_dict(
+                    user_defined_config,
+                    parsed_cache.load(os.path.join(root_dir, name)) or {}
+                )
 
 
 def _check_same_ip_to_multiple_host(config):
@@ -999,17 +3213,64 @@ def _check_config_settings(cidr_networks, config, container_skel):
                     raise SystemExit(
                         "can't find " + q_name + " in cidr_networks"
                     )
+
+                ipv6_q_name = p_net.get('ipv6_from_q')
+                if ipv6_q_name:
+                    if ipv6_q_name not in cidr_networks:
+                        raise SystemExit(
+                            "can't find " + ipv6_q_name + " in cidr_networks"
+                        )
+                    cidr = cidr_networks[ipv6_q_name]
+                    if CIDRNetwork(cidr).version != 6:
+                        raise SystemExit(
+                            ipv6_q_name + " in cidr_networks is not an IPv6"
+                            " network"
+                        )
+    ip_allocation_mode = config.get('ip_allocation_mode', 'random')
+    if ip_allocation_mode not in IP_ALLOCATION_MODES:
+        raise SystemExit(
+            "ip_allocation_mode must be one of: %s"
+            % ', '.join(IP_ALLOCATION_MODES)
+        )
+
+    shard_key = config.get('inventory_shard_key')
+    if shard_key is not None and not isinstance(shard_key, basestring):
+        raise SystemExit("inventory_shard_key must be the name of a host var")
+
+    backup_options = (
+        ('inventory_backup_count', 1),
+        ('inventory_backup_max_age', 0)
+    )
+    for option, minimum in backup_options:
+        value = config.get(option, minimum)
+        if not isinstance(value, int) or isinstance(value, bool) or \
+                value < minimum:
+            raise SystemExit(
+                "%s must be an integer of at least %d" % (option, minimum)
+            )
+
+    if config.get('inventory_backend', 'json') not in INVENTORY_BACKENDS:
+        raise SystemExit(
+            "inventory_backend must be one of: %s"
+            % ', '.join(INVENTORY_BACKENDS)
+        )
+
     # look for same ip address assigned to different hosts
     _check_same_ip_to_multiple_host(config)
 
     _check_multiple_ips_to_host(config)
 
 
-def load_environment(config_path):
+def load_environment(config_path, parsed_cache=None):
     """Create an environment dictionary from config files
 
     :param config_path: ``str``path where the environment files are kept
+    :param parsed_cache: ``object`` ``ParsedConfigCache`` to use, a new one
+                         is loaded and saved if ``None``
     """
+    save_cache = parsed_cache is None
+    if save_cache:
+        parsed_cache = ParsedConfigCache(config_path)
 
     environment = dict()
 
@@ -1017,29 +3278,42 @@ def load_environment(config_path):
     env_plugins = os.path.join(config_path, 'env.d')
 
     if os.path.isdir(env_plugins):
-        _extra_config(user_defined_config=environment, base_dir=env_plugins)
+        _extra_config(
+            user_defined_config=environment,
+            base_dir=env_plugins,
+            parsed_cache=parsed_cache
+        )
 
+    if save_cache:
+        parsed_cache.save()
     return environment
 
 
-def load_user_configuration(config_path):
+def load_user_configuration(config_path, parsed_cache=None):
     """Create a user configuration dictionary from config files
 
     :param config_path: ``str`` path where the configuration files are kept
+    :param parsed_cache: ``object`` ``ParsedConfigCache`` to use, a new one
+                         is loaded and saved if ``None``
     """
+    save_cache = parsed_cache is None
+    if save_cache:
+        parsed_cache = ParsedConfigCache(config_path)
 
     user_defined_config = dict()
 
     # Load the user defined configuration file
     user_config_file = os.path.join(config_path, 'openstack_user_config.yml')
     if os.path.isfile(user_config_file):
-        with open(user_config_file, 'rb') as f:
-            user_defined_config.update(yaml.safe_load(f.read()) or {})
+        user_defined_config.update(parsed_cache.load(user_config_file) or {})
 
     # Load anything in a conf.d directory if found
     base_dir = os.path.join(config_path, 'conf.d')
     if os.path.isdir(base_dir):
-        _extra_config(user_defined_config, base_dir)
+        _extra_config(user_defined_config, base_dir, parsed_cache)
+
+    if save_cache:
+        parsed_cache.save()
 
     # Exit if no user_config was found and loaded
     if not user_defined_config:
@@ -1051,36 +3325,1142 @@ def load_user_configuration(config_path):
     return user_defined_config
 
 
-def make_backup(config_path, inventory_file_path):
-    # Create a backup of all previous inventory files as a tar archive
-    inventory_backup_file = os.path.join(
-        config_path,
-        'backup_openstack_inventory.tar'
+def _json_pointer(path, key):
+    """Return the JSON pointer to a key of the value at a JSON pointer."""
+    return '%s/%s' % (
+        path, unicode(key).replace('~', '~0').replace('/', '~1')
     )
-    with tarfile.open(inventory_backup_file, 'a') as tar:
-        basename = os.path.basename(inventory_file_path)
-        backup_name = get_backup_name(basename)
-        tar.add(inventory_file_path, arcname=backup_name)
 
 
-def get_backup_name(basename):
-    utctime = datetime.datetime.utcnow()
-    utctime = utctime.strftime("%Y%m%d_%H%M%S")
-    return '%s-%s.json' % (basename, utctime)
+def _json_type(value):
+    """Return the JSON type of a value.
 
+    :param value: value to look at
+    """
+    for json_type in (bool, (int, long), float, basestring, dict, list):
+        if isinstance(value, json_type):
+            return json_type
+    return type(value)
 
-def get_inventory(config_path, inventory_file_path):
-    if os.path.isfile(inventory_file_path):
-        with open(inventory_file_path, 'rb') as f:
-            dynamic_inventory = json.loads(f.read())
 
-        make_backup(config_path, inventory_file_path)
-    else:
-        dynamic_inventory = copy.deepcopy(INVENTORY_SKEL)
+def _json_equal(old, new):
+    """Return whether two values are the same JSON value.
+
+    Unlike ``==``, ``1``, ``1.0`` and ``True`` are all told apart, at any
+    depth.
+
+    :param old: value to compare
+    :param new: value to compare with
+    """
+    if _json_type(old) != _json_type(new):
+        return False
+    if isinstance(old, dict):
+        return len(old) == len(new) and all(
+            key in new and _json_equal(value, new[key])
+            for key, value in old.iteritems()
+        )
+    if isinstance(old, list):
+        return len(old) == len(new) and all(
+            _json_equal(old_value, new_value)
+            for old_value, new_value in zip(old, new)
+        )
+    return old == new
+
+
+def json_diff(old, new, path=''):
+    """Return the JSON patch (RFC 6902) that turns one value into another.
+
+    Mappings are compared key by key. Lists that only had items appended
+    get ``add`` operations for these, other changed lists are replaced.
+
+    :param old: value to change
+    :param new: value to change it into
+    :param path: ``str`` JSON pointer to the value
+    :returns: ``list`` of operations
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        patch = list()
+        for key in sorted(set(old) - set(new)):
+            patch.append({'op': 'remove', 'path': _json_pointer(path, key)})
+        for key in sorted(new):
+            key_path = _json_pointer(path, key)
+            if key not in old:
+                patch.append({'op': 'add', 'path': key_path,
+                              'value': new[key]})
+            else:
+                patch.extend(json_diff(old[key], new[key], key_path))
+        return patch
+
+    # ``==`` is a quick first check, but it takes 1 and True for the same
+    if isinstance(old, list) and isinstance(new, list) and \
+            len(old) < len(new) and new[:len(old)] == old and \
+            _json_equal(new[:len(old)], old):
+        return [
+            {'op': 'add', 'path': path + '/-', 'value': value}
+            for value in new[len(old):]
+        ]
+
+    if old == new and _json_equal(old, new):
+        return list()
+    return [{'op': 'replace', 'path': path, 'value': new}]
+
+
+def json_patch(data, patch):
+    """Apply a JSON patch from ``json_diff`` to a value.
+
+    The value is changed in place, except when it is replaced as a whole.
+
+    :param data: value to change
+    :param patch: ``list`` of operations
+    :returns: the changed value
+    """
+    for operation in patch:
+        keys = [
+            key.replace('~1', '/').replace('~0', '~')
+            for key in operation['path'].split('/')[1:]
+        ]
+        if not keys:
+            data = operation['value']
+            continue
+
+        parent = data
+        for key in keys[:-1]:
+            parent = parent[int(key) if isinstance(parent, list) else key]
+        key = keys[-1]
+        if isinstance(parent, list):
+            if key == '-':
+                parent.append(operation['value'])
+                continue
+            key = int(key)
+
+        if operation['op'] == 'remove':
+            del parent[key]
+        else:
+            parent[key] = operation['value']
+    return data
+
+
+def make_backup(config_path, inventory_file_path,
+                max_count=INVENTORY_BACKUP_COUNT,
+                max_age=INVENTORY_BACKUP_MAX_AGE):
+    """Add a snapshot of the inventory file to the backup store.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param inventory_file_path: ``str`` path of the inventory file
+    :param max_count: ``int`` number of snapshots to keep
+    :param max_age: ``int`` days to keep snapshots for, forever if 0
+    :returns: ``bol`` True if the snapshot was added
+    """
+    with open(inventory_file_path, 'rb') as f:
+        content = f.read()
+    store = InventoryBackupStore(config_path, max_count, max_age)
+    return store.add(content)
+
+
+def get_file_checksum(file_path):
+    """Return the sha1 checksum of a file or ``None`` if it does not exist.
+
+    :param file_path: ``str`` path of the file to checksum
+    """
+    if not os.path.isfile(file_path):
+        return None
+
+    checksum = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def _host_hash(host):
+    """Return the 64 bit hash of a host name used by the host index.
+
+    :param host: ``str`` name of the host
+    """
+    import struct
+
+    return struct.unpack('<Q', hashlib.sha1(host).digest()[:8])[0]
+
+
+def _inventory_signature(inventory_file_path):
+    """Return the mtime, size and inode of the inventory file.
+
+    :param inventory_file_path: ``str`` path of the inventory file
+    :returns: ``tuple`` or ``None`` if the file does not exist
+    """
+    try:
+        stat = os.stat(inventory_file_path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size, stat.st_ino
+
+
+def _read_host_index_header(index_file):
+    """Return the inventory signatures and slot count of a host index.
+
+    :param index_file: ``object`` open host index file
+    :returns: ``tuple`` of the stat signature, the fingerprint and the
+              number of slots, or ``None`` if the file is not a host index
+    """
+    import struct
+
+    header = index_file.read(struct.calcsize(HOST_INDEX_HEADER))
+    if len(header) != struct.calcsize(HOST_INDEX_HEADER):
+        return None
+    magic, signature, fingerprint, slots = struct.unpack(
+        HOST_INDEX_HEADER, header
+    )
+    if magic != HOST_INDEX_MAGIC:
+        return None
+    return signature, fingerprint, slots
+
+
+def save_host_index(config_path, signature, fingerprint, hostvars):
+    """Save the hostvars of every host along with an index on the host name.
+
+    Nothing is written if the saved index already matches the signature and
+    the fingerprint.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param signature: ``str`` stat signature of the inputs of the inventory,
+                      as from ``get_inventory_stat_signature``
+    :param fingerprint: ``str`` fingerprint of the inputs of the inventory,
+                        as from ``get_inventory_fingerprint``
+    :param hostvars: ``dict`` hostvars of the inventory
+    :returns: ``bol`` True if the host index was written
+    """
+    import struct
+
+    index_file_path = os.path.join(config_path, HOST_INDEX_FILE)
+    try:
+        with open(index_file_path, 'rb') as f:
+            header = _read_host_index_header(f)
+    except IOError:
+        header = None
+    if header and header[:2] == (signature, fingerprint):
+        return False
+
+    # Open addressing with linear probing, at most half of the slots are used
+    slots = 1
+    while slots < 2 * len(hostvars):
+        slots *= 2
+    table = [(0, 0, 0)] * slots
+    records = list()
+    offset = (
+        struct.calcsize(HOST_INDEX_HEADER) +
+        slots * struct.calcsize(HOST_INDEX_SLOT)
+    )
+    for host in sorted(hostvars):
+        name = host.encode('utf-8') if isinstance(host, unicode) else host
+        record = '%s\0%s' % (name, dump_json(hostvars[host], compact=True))
+        host_hash = _host_hash(name)
+        slot = host_hash & (slots - 1)
+        while table[slot][2]:
+            slot = (slot + 1) & (slots - 1)
+        table[slot] = (host_hash, offset, len(record))
+        records.append(record)
+        offset += len(record)
+
+    _write_file(
+        index_file_path,
+        ''.join(
+            [struct.pack(HOST_INDEX_HEADER, HOST_INDEX_MAGIC, signature,
+                         fingerprint, slots)] +
+            [struct.pack(HOST_INDEX_SLOT, *entry) for entry in table] +
+            records
+        )
+    )
+    return True
+
+
+def load_host_vars(config_path, host, verify=False):
+    """Return the hostvars of a single host from the host index.
+
+    Only the header, the slots probed for the host and its record are read,
+    however large the inventory is. The index is used when the stat
+    signature of the inputs of the inventory is the one it was saved with.
+    Otherwise, with ``verify`` set, the inputs are hashed and the index is
+    still used if their fingerprint is unchanged. Its stat signature is then
+    updated, so the caller must hold the exclusive lock.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param host: ``str`` name of the host
+    :param verify: ``bol`` compare the fingerprint of the inputs when their
+                   stat signature has changed
+    :returns: ``str`` JSON of the hostvars, ``{}`` for an unknown host, or
+              ``None`` if the host index does not match the inputs
+    """
+    import struct
+
+    index_file_path = os.path.join(config_path, HOST_INDEX_FILE)
+    try:
+        f = open(index_file_path, 'rb')
+    except IOError:
+        return None
+
+    with f:
+        header = _read_host_index_header(f)
+        if header is None:
+            return None
+        signature = get_inventory_stat_signature(config_path)
+        if header[0] != signature:
+            if not verify:
+                return None
+            if header[1] != get_inventory_fingerprint(config_path):
+                return None
+            try:
+                with open(index_file_path, 'r+b') as index_file:
+                    index_file.seek(len(HOST_INDEX_MAGIC))
+                    index_file.write(signature)
+            except IOError:
+                pass
+
+        slots = header[2]
+        header_size = struct.calcsize(HOST_INDEX_HEADER)
+        slot_size = struct.calcsize(HOST_INDEX_SLOT)
+        host_hash = _host_hash(host)
+        slot = host_hash & (slots - 1)
+        for _ in xrange(slots):
+            f.seek(header_size + slot * slot_size)
+            entry_hash, offset, length = struct.unpack(
+                HOST_INDEX_SLOT, f.read(slot_size)
+            )
+            if not length:
+                break
+            if entry_hash == host_hash:
+                f.seek(offset)
+                name, _, host_vars = f.read(length).partition('\0')
+                if name == host:
+                    return host_vars
+            slot = (slot + 1) & (slots - 1)
+    return '{}'
+
+
+def get_host_vars(config_path, host):
+    """Return the hostvars of a single host as JSON.
+
+    The host index is used as long as it was saved for the current
+    configuration and inventory file. That is first checked on the stat of
+    the inputs alone, so no input is read. Only when it has changed are the
+    inputs hashed, as for the cached output, and if their content has
+    changed too the inventory is generated again first.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param host: ``str`` name of the host
+    """
+    with inventory_lock(config_path):
+        host_vars = load_host_vars(config_path, host)
+    if host_vars is not None:
+        return host_vars
+
+    with inventory_lock(config_path, exclusive=True):
+        host_vars = load_host_vars(config_path, host, verify=True)
+        if host_vars is None:
+            inventory = generate(config_path, dict())[0]
+            host_vars = load_host_vars(config_path, host)
+            # The host index can not be written, for instance on a read-only
+            # configuration directory.
+            if host_vars is None:
+                host_vars = dump_json(
+                    inventory['_meta']['hostvars'].get(host, dict()),
+                    compact=True
+                )
+    return host_vars
+
+
+def _db_value(value):
+    """Return the JSON stored in the inventory database for a value.
+
+    Keys are sorted so equal values are always stored the same way.
+
+    :param value: ``object`` value to store
+    """
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def _inventory_db_rows(inventory, signature):
+    """Return the rows of every inventory database table.
+
+    :param inventory: ``dict`` inventory as generated
+    :param signature: ``tuple`` signature of the inventory file
+    :returns: ``dict`` of ``set`` of rows, keyed on the table name
+    """
+    rows = dict((table, set()) for table, _, _ in INVENTORY_DB_TABLES)
+
+    rows['meta'].add(('signature', _db_value(list(signature))))
+    for key, value in inventory.get('_meta', dict()).iteritems():
+        if key != 'hostvars':
+            rows['meta'].add(('_meta.%s' % key, _db_value(value)))
+
+    for name, group in inventory.iteritems():
+        if name == '_meta' or not isinstance(group, dict):
+            continue
+        data = dict(
+            (key, value) for key, value in group.iteritems()
+            if key not in ('hosts', 'children')
+        )
+        rows['groups'].add((
+            name, _db_value(data), int('hosts' in group),
+            int('children' in group)
+        ))
+        for member_type in ('hosts', 'children'):
+            for position, member in enumerate(group.get(member_type) or []):
+                rows['membership'].add((name, member_type, position, member))
+
+    hostvars = inventory.get('_meta', dict()).get('hostvars', dict())
+    for host, host_vars in hostvars.iteritems():
+        rows['hosts'].add((host, host_vars.get('physical_host') or host))
+        for key, value in host_vars.iteritems():
+            rows['hostvars'].add((host, key, _db_value(value)))
+
+        networks = host_vars.get('container_networks') or dict()
+        for network, network_vars in networks.iteritems():
+            if not isinstance(network_vars, dict):
+                continue
+            for family, key in ((4, 'address'), (6, 'ipv6_address')):
+                if network_vars.get(key):
+                    rows['allocations'].add(
+                        (host, network, family, network_vars[key])
+                    )
+    return rows
+
+
+def _connect_inventory_db(db_file_path):
+    """Open the inventory database, creating any missing table.
+
+    :param db_file_path: ``str`` path of the inventory database
+    :returns: ``object`` sqlite3 connection
+    """
+    import sqlite3
+
+    conn = sqlite3.connect(db_file_path)
+    conn.executescript(INVENTORY_DB_SCHEMA)
+    return conn
+
+
+def _inventory_db_signature(conn):
+    """Return the signature of the inventory file the database matches.
+
+    :param conn: ``object`` sqlite3 connection to the inventory database
+    :returns: ``tuple`` or ``None`` if no inventory has been saved yet
+    """
+    row = conn.execute(
+        "SELECT value FROM meta WHERE key = 'signature'"
+    ).fetchone()
+    if row is None:
+        return None
+    return tuple(json.loads(row[0]))
+
+
+def save_inventory_db(config_path, inventory_file_path, inventory,
+                      previous=None):
+    """Save the inventory into the inventory database.
+
+    Only the rows that changed since the last save are deleted and
+    inserted, all within a single transaction. When the database matches
+    the inventory file replaced, the rows are diffed against that inventory
+    rather than read from the database. Nothing is done if the database
+    already matches the inventory file.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param inventory_file_path: ``str`` path of the inventory file
+    :param inventory: ``dict`` inventory saved in the inventory file
+    :param previous: ``tuple`` of the signature and the JSON of the
+                     inventory file replaced, if any
+    :returns: ``bol`` True if the inventory database was changed
+    """
+    signature = _inventory_signature(inventory_file_path)
+    if signature is None:
+        return False
+
+    conn = _connect_inventory_db(os.path.join(config_path, INVENTORY_DB_FILE))
+    try:
+        db_signature = _inventory_db_signature(conn)
+        if db_signature == signature:
+            return False
+
+        saved_rows = None
+        if previous is not None and previous[0] is not None and \
+                db_signature == previous[0]:
+            saved_rows = _inventory_db_rows(json.loads(previous[1]),
+                                            previous[0])
+
+        rows = _inventory_db_rows(inventory, signature)
+        changed = False
+        with conn:
+            for table, columns, key_size in INVENTORY_DB_TABLES:
+                if saved_rows is None:
+                    saved = set(conn.execute(
+                        'SELECT %s FROM %s' % (', '.join(columns), table)
+                    ))
+                else:
+                    saved = saved_rows[table]
+                removed = saved - rows[table]
+                added = rows[table] - saved
+                conn.executemany(
+                    'DELETE FROM %s WHERE %s' % (
+                        table,
+                        ' AND '.join('%s = ?' % c for c in columns[:key_size])
+                    ),
+                    [row[:key_size] for row in removed]
+                )
+                conn.executemany(
+                    'INSERT INTO %s VALUES (%s)' % (
+                        table, ', '.join('?' * len(columns))
+                    ),
+                    added
+                )
+                changed = changed or bool(removed or added)
+        return changed
+    finally:
+        conn.close()
+
+
+def open_inventory_db(config_path, inventory_file_path):
+    """Open the inventory database if it matches the inventory file.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param inventory_file_path: ``str`` path of the inventory file
+    :returns: ``object`` sqlite3 connection, or ``None`` if there is no
+              inventory database or it does not match the inventory file
+    """
+    db_file_path = os.path.join(config_path, INVENTORY_DB_FILE)
+    signature = _inventory_signature(inventory_file_path)
+    if signature is None or not os.path.isfile(db_file_path):
+        return None
+
+    conn = _connect_inventory_db(db_file_path)
+    if _inventory_db_signature(conn) != signature:
+        conn.close()
+        return None
+    return conn
+
+
+def load_inventory_db(conn, hostvar_keys=None):
+    """Build the inventory from the inventory database.
+
+    :param conn: ``object`` sqlite3 connection to the inventory database
+    :param hostvar_keys: ``list`` only load these hostvars, all of them are
+                         loaded by default
+    :returns: ``dict`` inventory
+    """
+    inventory = {'_meta': {'hostvars': dict()}}
+    for key, value in conn.execute('SELECT key, value FROM meta'):
+        if key.startswith('_meta.'):
+            inventory['_meta'][key[len('_meta.'):]] = json.loads(value)
+
+    groups = conn.execute(
+        'SELECT name, data, has_hosts, has_children FROM groups'
+    )
+    for name, data, has_hosts, has_children in groups:
+        group = inventory[name] = json.loads(data)
+        if has_hosts:
+            group['hosts'] = list()
+        if has_children:
+            group['children'] = list()
+
+    members = conn.execute(
+        'SELECT group_name, member_type, member FROM membership'
+        ' ORDER BY group_name, member_type, position'
+    )
+    for group_name, member_type, member in members:
+        inventory[group_name][member_type].append(member)
+
+    hostvars = inventory['_meta']['hostvars']
+    for name, in conn.execute('SELECT name FROM hosts'):
+        hostvars[name] = dict()
+
+    if hostvar_keys is None:
+        rows = conn.execute('SELECT host, key, value FROM hostvars')
+    else:
+        hostvar_keys = list(hostvar_keys)
+        rows = conn.execute(
+            'SELECT host, key, value FROM hostvars WHERE key IN (%s)'
+            % ', '.join('?' * len(hostvar_keys)),
+            hostvar_keys
+        )
+    for host, key, value in rows:
+        hostvars[host][key] = json.loads(value)
+    return inventory
+
+
+def _remove_inventory_items(data, items):
+    """Remove items from the mappings and lists held by a mapping.
+
+    :param data: ``dict`` mapping to remove the items from
+    :param items: ``set`` items to remove
+    :returns: ``bol`` True if anything was removed
+    """
+    removed = False
+    for value in data.values():
+        if isinstance(value, dict):
+            for item in items.intersection(value):
+                del value[item]
+                removed = True
+        elif isinstance(value, list):
+            kept = [v for v in value if v not in items]
+            removed = removed or len(kept) != len(value)
+            value[:] = kept
+    return removed
+
+
+def remove_inventory_db_items(conn, items):
+    """Remove hosts from the inventory database in a single transaction.
+
+    Like ``inventory-manage.py --remove-item`` on the inventory file, the
+    items are also removed from every group and variable mapping.
+
+    :param conn: ``object`` sqlite3 connection to the inventory database
+    :param items: ``list`` names of the hosts to remove
+    """
+    items = set(items)
+    with conn:
+        for item in items:
+            conn.execute('DELETE FROM hosts WHERE name = ?', (item,))
+            conn.execute('DELETE FROM hostvars WHERE host = ?', (item,))
+            conn.execute('DELETE FROM allocations WHERE host = ?', (item,))
+            conn.execute('DELETE FROM membership WHERE member = ?', (item,))
+
+        # Values of _meta and of the groups, such as the fingerprints or the
+        # group vars, are mappings or lists that can also name the items.
+        for key, value in conn.execute(
+                'SELECT key, value FROM meta').fetchall():
+            meta = {key: json.loads(value)}
+            if (key.startswith('_meta.') and
+                    _remove_inventory_items(meta, items)):
+                conn.execute(
+                    'UPDATE meta SET value = ? WHERE key = ?',
+                    (_db_value(meta[key]), key)
+                )
+
+        for name, data in conn.execute(
+                'SELECT name, data FROM groups').fetchall():
+            group = json.loads(data)
+            if _remove_inventory_items(group, items):
+                conn.execute(
+                    'UPDATE groups SET data = ? WHERE name = ?',
+                    (_db_value(group), name)
+                )
+
+
+def export_inventory_db(conn, inventory_file_path):
+    """Write the inventory file from the inventory database.
+
+    :param conn: ``object`` sqlite3 connection to the inventory database
+    :param inventory_file_path: ``str`` path of the inventory file
+    :returns: ``dict`` inventory written to the inventory file
+    """
+    inventory = load_inventory_db(conn)
+    _write_file(inventory_file_path, dump_json(inventory))
+    with conn:
+        conn.execute(
+            "UPDATE meta SET value = ? WHERE key = 'signature'",
+            (_db_value(list(_inventory_signature(inventory_file_path))),)
+        )
+    return inventory
+
+
+def _inventory_input_files(config_path):
+    """Return the paths of all of the inputs of the inventory.
+
+    This covers ``openstack_user_config.yml``, the ``conf.d``, ``env.d``
+    and ``group_vars`` files, the inventory file itself and this script.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    """
+    file_paths = [
+        os.path.join(config_path, 'openstack_user_config.yml'),
+        os.path.join(config_path, 'openstack_inventory.json')
+    ]
+    for extra_dir in ('conf.d', 'env.d'):
+        extra_files = list()
+        extra_path = os.path.join(config_path, extra_dir)
+        for root_dir, _, files in os.walk(extra_path):
+            for name in files:
+                if name.endswith(('.yml', '.yaml')):
+                    extra_files.append(os.path.join(root_dir, name))
+        file_paths.extend(sorted(extra_files))
+
+    # The output options depend on the group_vars files
+    file_paths.extend(
+        file_path for _, file_path in _group_vars_files(config_path)
+    )
+
+    script = os.path.abspath(__file__)
+    if script.endswith(('.pyc', '.pyo')):
+        script = script[:-1]
+    file_paths.append(script)
+    return file_paths
+
+
+def get_inventory_fingerprint(config_path):
+    """Return a fingerprint of the content of all inputs of the inventory.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    """
+    fingerprint = hashlib.sha1()
+    for file_path in _inventory_input_files(config_path):
+        fingerprint.update(
+            '%s\0%s\0' % (file_path, get_file_checksum(file_path))
+        )
+    return fingerprint.hexdigest()
+
+
+def get_inventory_stat_signature(config_path):
+    """Return a signature of the stat of all inputs of the inventory.
+
+    No input is read, so this is cheap whatever the size of the inventory.
+    Any write to an input changes its mtime, and the inventory file is
+    replaced by a rename so it also gets a new inode.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    """
+    signature = hashlib.sha1()
+    for file_path in _inventory_input_files(config_path):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            file_stat = ''
+        else:
+            file_stat = '%r\0%d\0%d' % (
+                stat.st_mtime, stat.st_size, stat.st_ino
+            )
+        signature.update('%s\0%s\0' % (file_path, file_stat))
+    return signature.hexdigest()
+
+
+def _load_json_backend(compact=False):
+    """Return the fastest available JSON module for an output format.
+
+    :param compact: ``bol`` return the module for compact output
+    """
+    backend = _JSON_BACKEND_MODULES.get(compact)
+    if backend is None:
+        for name in JSON_BACKENDS[compact]:
+            try:
+                backend = __import__(name)
+            except ImportError:
+                continue
+            break
+        _JSON_BACKEND_MODULES[compact] = backend
+    return backend
+
+
+def dump_json(data, compact=False):
+    """Serialize data to JSON with the fastest available JSON module.
+
+    :param data: data to serialize
+    :param compact: ``bol`` leave out all indentation and whitespace
+    :returns: ``str`` JSON
+    """
+    backend = _load_json_backend(compact)
+    if not compact:
+        return backend.dumps(
+            data, indent=4, sort_keys=True, separators=(', ', ': ')
+        )
+    elif backend.__name__ == 'ujson':
+        return backend.dumps(data, escape_forward_slashes=False)
+    else:
+        return backend.dumps(data, sort_keys=True, separators=(',', ':'))
+
+
+def _output_options(all_args):
+    """Return the output options that are turned on.
+
+    :param all_args: ``dict`` arguments from the command line
+    :returns: ``tuple`` of names from ``OUTPUT_OPTIONS``, as ``name=value``
+              for the options taking a value
+    """
+    options = list()
+    for option in OUTPUT_OPTIONS:
+        if option == 'limit_groups':
+            patterns = _parse_group_patterns(all_args.get(option))
+            if patterns:
+                options.append('%s=%s' % (option, ':'.join(patterns)))
+        elif option in OUTPUT_VALUE_OPTIONS:
+            if all_args.get(option):
+                options.append('%s=%s' % (option, all_args[option]))
+        elif all_args.get(option):
+            options.append(option)
+    return tuple(options)
+
+
+def _parse_output_options(options):
+    """Return the arguments set by a tuple of output options.
+
+    :param options: ``tuple`` output options, as from ``_output_options``
+    :returns: ``dict`` with a value for every option of ``OUTPUT_OPTIONS``
+    """
+    output_args = dict(
+        (o, None if o in OUTPUT_VALUE_OPTIONS else False)
+        for o in OUTPUT_OPTIONS
+    )
+    for option in options:
+        name, _, value = option.partition('=')
+        if name not in output_args:
+            raise ValueError('Unknown output option: %s' % name)
+        output_args[name] = value or True
+    return output_args
+
+
+def _cache_file(config_path, options=()):
+    """Return the path of the cached output for a set of output options.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param options: ``tuple`` output options, as from ``_output_options``
+    """
+    if options:
+        # Option values may hold any character, so they are hashed
+        names = list()
+        for option in options:
+            name, _, value = option.partition('=')
+            if value:
+                name = '%s-%s' % (name, hashlib.sha1(value).hexdigest()[:12])
+            names.append(name)
+        return os.path.join(
+            config_path, INVENTORY_OPTIONS_CACHE_FILE % '.'.join(names)
+        )
+    return os.path.join(config_path, INVENTORY_CACHE_FILE)
+
+
+def load_cached_inventory(config_path, fingerprint, options=()):
+    """Return the cached output of the last run if its inputs are unchanged.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param fingerprint: ``str`` fingerprint of the current inputs
+    :param options: ``tuple`` output options, as from ``_output_options``
+    :returns: ``str`` cached output or ``None``
+    """
+    cache_file = _cache_file(config_path, options)
+    try:
+        with open(cache_file, 'rb') as f:
+            if f.readline().rstrip('\n') == fingerprint:
+                return f.read()
+    except IOError:
+        pass
+    return None
+
+
+def save_cached_inventory(config_path, fingerprint, output, options=()):
+    """Save the output of a run along with the fingerprint of its inputs.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param fingerprint: ``str`` fingerprint of the inputs of the run
+    :param output: ``str`` output of the run
+    :param options: ``tuple`` output options the output was produced with
+    """
+    cache_file = _cache_file(config_path, options)
+    _write_file(cache_file, '%s\n%s' % (fingerprint, output))
+
+
+@contextlib.contextmanager
+def inventory_lock(config_path, exclusive=False):
+    """Hold a lock on the inventory files of a configuration directory.
+
+    Runs that only read the inventory share the lock, runs that generate and
+    write it hold it exclusively. If the lock file can not be opened, for
+    instance on a read-only configuration directory, no lock is taken.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param exclusive: ``bol`` take an exclusive instead of a shared lock
+    """
+    import fcntl
+
+    lock_file = os.path.join(config_path, INVENTORY_LOCK_FILE)
+    try:
+        f = open(lock_file, 'a')
+    except IOError:
+        try:
+            f = open(lock_file, 'r')
+        except IOError:
+            yield
+            return
+
+    with f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _read_file(file_path):
+    """Return the content of a file or ``None`` if it does not exist.
+
+    :param file_path: ``str`` path of the file to read
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def _write_file(file_path, content):
+    """Atomically replace a file, unless it already has the given content.
+
+    The content is written to a temporary file next to it, which is renamed
+    over the file, so readers never see a partially written file.
+
+    :param file_path: ``str`` path of the file to write
+    :param content: ``str`` new content of the file
+    :returns: ``bol`` True if the file was written
+    """
+    if _read_file(file_path) == content:
+        return False
+
+    temp_file = '%s.%d.tmp' % (file_path, os.getpid())
+    with open(temp_file, 'wb') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.isfile(file_path):
+        os.chmod(temp_file, os.stat(file_path).st_mode & 0o7777)
+    os.rename(temp_file, file_path)
+    return True
+
+
+def request_daemon_inventory(config_path, options=()):
+    """Return the inventory from a running ``--daemon``.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param options: ``tuple`` output options, as from ``_output_options``
+    :returns: ``str`` inventory or ``None`` if no daemon is running or it
+              does not answer within ``INVENTORY_DAEMON_TIMEOUT``
+    """
+    socket_file = os.path.join(config_path, INVENTORY_SOCKET_FILE)
+    if not os.path.exists(socket_file):
+        return None
+
+    import socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(INVENTORY_DAEMON_TIMEOUT)
+    try:
+        client.connect(socket_file)
+        client.sendall('%s\n' % ' '.join(('list',) + tuple(options)))
+        response = ''.join(iter(lambda: client.recv(65536), ''))
+    except (socket.timeout, socket.error):
+        return None
+    finally:
+        client.close()
+
+    status, _, output = response.partition('\n')
+    if status == 'ok':
+        return output
+    elif status == 'error':
+        raise SystemExit(output)
+    return None
+
+
+def _serve_inventory_request(conn, all_args, state):
+    """Answer a single request to the daemon.
+
+    :param conn: ``object`` accepted client socket
+    :param all_args: ``dict`` arguments the daemon was started with
+    :param state: ``dict`` with the current ``outputs``, keyed on the output
+                  options, and a ``changed`` flag
+    """
+    request_file = conn.makefile('rb')
+    try:
+        request = request_file.readline(4096).split()
+    finally:
+        request_file.close()
+    try:
+        if request[:1] != ['list']:
+            raise ValueError('Unknown request: %s' % ' '.join(request))
+        request_args = dict(all_args, **_parse_output_options(request[1:]))
+    except ValueError as e:
+        conn.sendall('error\n%s' % e)
+        return
+
+    if state['changed']:
+        state['changed'] = False
+        state['outputs'].clear()
+
+    options = _output_options(request_args)
+    if options not in state['outputs']:
+        try:
+            state['outputs'][options] = main(request_args)
+        except SystemExit as e:
+            state['changed'] = True
+            conn.sendall('error\n%s' % e.code)
+            return
+        except Exception:
+            # Keep running so the configuration can be fixed, the error is
+            # passed on to the client instead.
+            import traceback
+            state['changed'] = True
+            conn.sendall('error\n%s' % traceback.format_exc())
+            return
+    conn.sendall('ok\n%s' % state['outputs'][options])
+
+
+def run_daemon(all_args):
+    """Keep the inventory in memory and serve it on a unix socket.
+
+    Requests are answered with the inventory of the last run. It is only
+    regenerated once a change to the configuration has been seen. Where
+    inotify is not available, every request goes through ``main``, which
+    still returns the cached output when nothing has changed.
+
+    :param all_args: ``dict`` arguments from the command line
+    """
+    import select
+    import signal
+    import socket
+
+    config_path = find_config_path(
+        user_config_path=all_args.get('config')
+    )
+
+    state = {
+        'outputs': {_output_options(all_args): main(all_args)},
+        'changed': False
+    }
+
+    # The watch is only set up after the first run, so the files written by
+    # that run are not taken for a change. A change made in between is
+    # caught by the fingerprint of the inputs instead.
+    fingerprint = get_inventory_fingerprint(config_path)
+    try:
+        watch = InventoryWatch(config_path)
+    except (AttributeError, OSError):
+        watch = None
+    state['changed'] = (
+        watch is None or
+        get_inventory_fingerprint(config_path) != fingerprint
+    )
+
+    # The socket is only moved into place once it accepts connections, which
+    # also replaces the socket of a daemon that did not shut down cleanly.
+    socket_file = os.path.join(config_path, INVENTORY_SOCKET_FILE)
+    temp_socket_file = '%s.%d' % (socket_file, os.getpid())
+    if os.path.exists(temp_socket_file):
+        os.remove(temp_socket_file)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(temp_socket_file)
+    os.chmod(temp_socket_file, 0o600)
+    server.listen(16)
+    os.rename(temp_socket_file, socket_file)
+
+    # Make sure the socket file is removed when the daemon is stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            readers = [server]
+            if watch is not None:
+                readers.append(watch.fd)
+            ready = select.select(readers, [], [])[0]
+
+            if watch is not None and watch.fd in ready:
+                if watch.read():
+                    state['changed'] = True
+
+            if server in ready:
+                conn = server.accept()[0]
+                try:
+                    _serve_inventory_request(conn, all_args, state)
+                except socket.error:
+                    pass
+                finally:
+                    conn.close()
+                if watch is None:
+                    state['changed'] = True
+    finally:
+        server.close()
+        os.remove(socket_file)
+        if watch is not None:
+            watch.close()
+
+
+def _load_group_members(inventory):
+    """Convert the group lists of a loaded inventory to ``GroupMembers``.
+
+    :param inventory: ``dict``  Living dictionary of inventory
+    """
+    for key, value in inventory.iteritems():
+        if key == '_meta' or not isinstance(value, dict):
+            continue
+        for member_type in ('hosts', 'children'):
+            if isinstance(value.get(member_type), list):
+                value[member_type] = GroupMembers(value[member_type])
+
+
+def get_inventory(config_path, inventory_file_path):
+    if os.path.isfile(inventory_file_path):
+        with open(inventory_file_path, 'rb') as f:
+            dynamic_inventory = json.loads(f.read())
+
+        _load_group_members(dynamic_inventory)
+    else:
+        import copy
+        dynamic_inventory = copy.deepcopy(INVENTORY_SKEL)
 
     return dynamic_inventory
 
 
+def _load_served_inventory(config_path, all_args):
+    """Return the inventory from a daemon or the cache, if available.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param all_args: ``dict`` arguments from the command line
+    :returns: ``str`` inventory JSON or ``None``
+    """
+    options = _output_options(all_args)
+    if not all_args.get('daemon'):
+        daemon_inventory = request_daemon_inventory(config_path, options)
+        if daemon_inventory is not None:
+            return daemon_inventory
+
+    with inventory_lock(config_path):
+        return load_cached_inventory(
+            config_path, get_inventory_fingerprint(config_path), options
+        )
+
+
+def _generate_locked(config_path, all_args):
+    """Generate the inventory while holding the exclusive lock.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param all_args: ``dict`` arguments from the command line
+    :returns: ``tuple`` as returned by ``generate``
+    """
+    if all_args.get('capacity_report'):
+        # The capacity report writes nothing, so it only shares the lock
+        with inventory_lock(config_path):
+            return generate(config_path, all_args)
+
+    with inventory_lock(config_path, exclusive=True):
+        # Another run may have generated the inventory while this one was
+        # waiting for the lock.
+        cached_inventory = load_cached_inventory(
+            config_path,
+            get_inventory_fingerprint(config_path),
+            _output_options(all_args)
+        )
+        if cached_inventory is not None:
+            return json.loads(cached_inventory), cached_inventory
+
+        return generate(config_path, all_args)
+
+
+def load_generated_inventory(config_path):
+    """Return the inventory as a dictionary, generating it if needed.
+
+    This is the entry point for callers within the Ansible process, such as
+    the ``openstack_ansible`` inventory plugin.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    """
+    # Compact JSON is the quickest to produce and to parse again
+    all_args = {'compact': True}
+    served_inventory = _load_served_inventory(config_path, all_args)
+    if served_inventory is not None:
+        return json.loads(served_inventory)
+    return _generate_locked(config_path, all_args)[0]
+
+
 def main(all_args):
     """Run the main application."""
     # Get the path to the user configuration files
@@ -1088,9 +4468,42 @@ def main(all_args):
         user_config_path=all_args.get('config')
     )
 
-    user_defined_config = load_user_configuration(config_path)
+    if all_args.get('host'):
+        return get_host_vars(config_path, all_args['host'])
+
+    # Serve the inventory from a running daemon or, failing that, the output
+    # of the last run if none of its inputs have changed
+    if not all_args.get('capacity_report'):
+        served_inventory = _load_served_inventory(config_path, all_args)
+        if served_inventory is not None:
+            return served_inventory
+
+    return _generate_locked(config_path, all_args)[1]
+
+
+def generate(config_path, all_args):
+    """Generate the inventory from the configuration and save it.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param all_args: ``dict`` arguments from the command line
+    :returns: ``tuple`` of the inventory ``dict`` and its JSON, as
+              changed by the output options. With ``capacity_report`` set,
+              the network capacity is returned instead and nothing is saved.
+    """
+    compact = bool(all_args.get('compact'))
+    capacity_report = bool(all_args.get('capacity_report'))
 
-    environment = load_environment(config_path)
+    # Used addresses are tracked globally, so start each run from scratch
+    global USED_IPS
+    USED_IPS = IPRangeSet()
+
+    # YAML files are only parsed again when they have changed
+    parsed_cache = ParsedConfigCache(config_path)
+    user_defined_config = load_user_configuration(config_path, parsed_cache)
+
+    environment = load_environment(config_path, parsed_cache)
+    if not capacity_report:
+        parsed_cache.save()
 
     # Load existing inventory file if found
     dynamic_inventory_file = os.path.join(
@@ -1119,12 +4532,33 @@ def main(all_args):
         environment.get('container_skel')
     )
 
+    # Only physical hosts whose configuration or entries changed since the
+    # last run are processed again, the others are kept as they are.
+    config_fingerprints = _host_config_fingerprints(
+        user_defined_config,
+        environment
+    )
+    changed_hosts = _get_changed_hosts(dynamic_inventory, config_fingerprints)
+
     # Add the container_cidr into the all global ansible group_vars
     _parse_global_variables(user_cidr, dynamic_inventory, user_defined_config)
 
+    # Open the allocation bitmaps saved along with the inventory file that
+    # still match it. Missing or outdated bitmaps are only created after the
+    # capacity check, and the capacity report leaves them all alone.
+    if capacity_report:
+        ip_bitmaps = dict()
+    else:
+        ip_bitmaps = load_ip_bitmaps(
+            config_path,
+            cidr_networks,
+            get_file_checksum(dynamic_inventory_file),
+            valid_only=True
+        )
+
     # Load all of the IP addresses that we know are used and set the queue
-    _set_used_ips(user_defined_config, dynamic_inventory)
-    user_defined_setup(user_defined_config, dynamic_inventory)
+    _set_used_ips(user_defined_config, dynamic_inventory, ip_bitmaps)
+    user_defined_setup(user_defined_config, dynamic_inventory, changed_hosts)
     skel_setup(environment, dynamic_inventory)
     skel_load(
         environment.get('physical_skel'),
@@ -1137,49 +4571,174 @@ def main(all_args):
     container_skel_load(
         environment.get('container_skel'),
         dynamic_inventory,
-        user_defined_config
+        user_defined_config,
+        changed_hosts
+    )
+
+    # Make sure every network has room for the containers bound to it
+    # Group membership is final from here on, so the hosts of each group are
+    # resolved once and shared by every provider network.
+    group_hosts = dict()
+    capacity = network_capacity(
+        dynamic_inventory,
+        user_defined_config,
+        ip_bitmaps,
+        group_hosts
+    )
+    if capacity_report:
+        return capacity, dump_json(capacity, compact)
+
+    _check_network_capacity(capacity)
+
+    # The capacity check passed, so the bitmaps that did not match the
+    # inventory file are now created and rebuilt from the hostvars.
+    new_ip_bitmaps = load_ip_bitmaps(
+        config_path,
+        dict(
+            (net_name, cidr) for net_name, cidr in cidr_networks.items()
+            if net_name not in ip_bitmaps
+        ),
+        None
+    )
+    _rebuild_ip_bitmaps(dynamic_inventory, new_ip_bitmaps)
+    ip_bitmaps.update(new_ip_bitmaps)
+
+    provider_networks_load(
+        dynamic_inventory,
+        user_defined_config,
+        ip_bitmaps,
+        group_hosts,
+        changed_hosts
     )
 
     # Look at inventory and ensure all entries have all required values.
     _ensure_inventory_uptodate(
         inventory=dynamic_inventory,
         container_skel=environment.get('container_skel'),
+        changed_hosts=changed_hosts
     )
 
-    # Load the inventory json
-    dynamic_inventory_json = json.dumps(
+    # The fingerprints are only read by the next run, so they are only kept
+    # in the inventory file and left out of the output.
+    dynamic_inventory['_meta']['fingerprints'] = _host_fingerprints(
         dynamic_inventory,
-        indent=4,
-        sort_keys=True
+        config_fingerprints
     )
 
+    # Load the inventory json
+    dynamic_inventory_json = dump_json(dynamic_inventory)
+
     # Generate a list of all hosts and their used IP addresses
     hostnames_ips = {}
     for _host, _vars in dynamic_inventory['_meta']['hostvars'].iteritems():
-        host_hash = hostnames_ips[_host] = {}
-        for _key, _value in _vars.iteritems():
-            if _key.endswith('address') or _key == 'ansible_ssh_host':
-                host_hash[_key] = _value
+        hostnames_ips[_host] = _host_addresses(_vars)
 
     # Save a list of all hosts and their given IP addresses
     hostnames_ip_file = os.path.join(
         config_path, 'openstack_hostnames_ips.yml')
-    with open(hostnames_ip_file, 'wb') as f:
-        f.write(
-            json.dumps(
-                hostnames_ips,
-                indent=4,
-                sort_keys=True
+    _write_file(hostnames_ip_file, dump_json(hostnames_ips))
+
+    # Save new dynamic inventory. When it changed, the previous and the new
+    # one are added to the inventory history.
+    previous_inventory = (
+        _inventory_signature(dynamic_inventory_file),
+        _read_file(dynamic_inventory_file)
+    )
+    if previous_inventory[1] != dynamic_inventory_json:
+        backup_retention = (
+            user_defined_config.get(
+                'inventory_backup_count', INVENTORY_BACKUP_COUNT
+            ),
+            user_defined_config.get(
+                'inventory_backup_max_age', INVENTORY_BACKUP_MAX_AGE
+            )
+        )
+        backup = os.path.isfile(dynamic_inventory_file)
+        if backup:
+            make_backup(config_path, dynamic_inventory_file,
+                        *backup_retention)
+        _write_file(dynamic_inventory_file, dynamic_inventory_json)
+        if backup:
+            make_backup(config_path, dynamic_inventory_file,
+                        *backup_retention)
+
+    # Save the allocation bitmaps against the inventory just written
+    inventory_checksum = hashlib.sha1(dynamic_inventory_json).hexdigest()
+    for bitmap in ip_bitmaps.values():
+        bitmap.save(inventory_checksum)
+
+    fingerprint = get_inventory_fingerprint(config_path)
+    save_host_index(
+        config_path,
+        get_inventory_stat_signature(config_path),
+        fingerprint,
+        dynamic_inventory['_meta']['hostvars']
+    )
+
+    if user_defined_config.get('inventory_backend') == 'sqlite':
+        save_inventory_db(
+            config_path,
+            dynamic_inventory_file,
+            dynamic_inventory,
+            previous_inventory
+        )
+    del dynamic_inventory['_meta']['fingerprints']
+
+    shards = None
+    if user_defined_config.get('inventory_shard_key'):
+        shards = save_inventory_shards(
+            config_path,
+            dynamic_inventory,
+            user_defined_config['inventory_shard_key']
+        )
+    else:
+        remove_inventory_shards(config_path)
+
+    # The output options only change what is printed, the inventory file
+    # always has the complete hostvars.
+    shard = all_args.get('shard')
+    if shard:
+        if shards is None:
+            raise SystemExit(
+                "Can't print shard %s, inventory_shard_key isn't set in user"
+                " config" % shard
+            )
+        if shard not in shards:
+            raise SystemExit(
+                "Unknown inventory shard %s, the shards are: %s"
+                % (shard, ', '.join(sorted(shards)))
             )
+        dynamic_inventory = shards[shard]
+
+    group_patterns = _parse_group_patterns(all_args.get('limit_groups'))
+    if group_patterns:
+        _limit_groups(
+            dynamic_inventory,
+            group_patterns,
+            _group_vars_references(config_path)
         )
 
-    # Save new dynamic inventory
-    with open(dynamic_inventory_file, 'wb') as f:
-        f.write(dynamic_inventory_json)
+    if all_args.get('hoist_group_vars'):
+        _hoist_group_vars(
+            dynamic_inventory,
+            _group_vars_file_keys(config_path, parsed_cache)
+        )
+        parsed_cache.save()
 
-    return dynamic_inventory_json
+    output = dump_json(dynamic_inventory, compact)
+    save_cached_inventory(
+        config_path,
+        fingerprint,
+        output,
+        _output_options(all_args)
+    )
+
+    return dynamic_inventory, output
 
 if __name__ == '__main__':
     all_args = args(sys.argv[1:])
-    output = main(all_args)
-    print(output)
+    if all_args['daemon']:
+        run_daemon(all_args)
+    else:
+        output = main(all_args)
+        print(output)
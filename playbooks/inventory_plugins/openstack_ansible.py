@@ -0,0 +1,155 @@
+# Copyright 2016, Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Ansible inventory plugin built on the OpenStack-Ansible dynamic inventory.
+
+The inventory is generated in the Ansible process and loaded into it
+directly, without running ``dynamic_inventory.py`` as a script. Inventory
+plugins need Ansible 2.4 or later, so this plugin is not used with the
+Ansible version installed by ``scripts/bootstrap-ansible.sh``. See the
+inventory developer documentation for how to enable this plugin.
+"""
+
+import os
+import sys
+
+# Oldest Ansible release with inventory plugins
+ANSIBLE_MIN_VERSION = (2, 4)
+
+
+def _version_tuple(version):
+    """Return the leading numeric parts of a version string."""
+    parts = list()
+    for part in version.split('.'):
+        if not part.isdigit():
+            break
+        parts.append(int(part))
+    return tuple(parts)
+
+
+try:
+    from ansible import __version__ as ANSIBLE_VERSION
+    from ansible.errors import AnsibleParserError
+    from ansible.plugins.inventory import BaseInventoryPlugin
+except ImportError:
+    ANSIBLE_VERSION = None
+
+HAS_INVENTORY_PLUGINS = (
+    ANSIBLE_VERSION is not None and
+    _version_tuple(ANSIBLE_VERSION) >= ANSIBLE_MIN_VERSION
+)
+
+if not HAS_INVENTORY_PLUGINS:
+    AnsibleParserError = Exception
+
+    class BaseInventoryPlugin(object):
+        """Stand-in for the Ansible base class on older Ansible versions.
+
+        Ansible only loads the plugin from 2.4 on, this keeps the module
+        importable and testable without it.
+        """
+
+        def verify_file(self, path):
+            return os.path.exists(path) and os.access(path, os.R_OK)
+
+        def parse(self, inventory, loader, path, cache=True):
+            self.loader = loader
+            self.inventory = inventory
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'inventory')
+)
+
+import dynamic_inventory  # noqa
+
+
+DOCUMENTATION = '''
+    name: openstack_ansible
+    plugin_type: inventory
+    short_description: OpenStack-Ansible inventory
+    description:
+        - Generates the OpenStack-Ansible inventory from
+          openstack_user_config.yml, conf.d and env.d.
+    options:
+        plugin:
+            description: Name of the plugin
+            required: True
+            choices: ['openstack_ansible']
+        config:
+            description: Path containing the user defined configuration files
+            required: False
+            default: /etc/openstack_deploy
+'''
+
+EXAMPLES = '''
+# openstack_ansible.yml
+plugin: openstack_ansible
+config: /etc/openstack_deploy
+'''
+
+
+class InventoryModule(BaseInventoryPlugin):
+    NAME = 'openstack_ansible'
+
+    def verify_file(self, path):
+        """Only accept plugin configuration files named for this plugin."""
+        if not super(InventoryModule, self).verify_file(path):
+            return False
+        return os.path.basename(path) in ('openstack_ansible.yml',
+                                          'openstack_ansible.yaml')
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+
+        plugin_config = loader.load_from_file(path) or dict()
+        try:
+            config_path = dynamic_inventory.find_config_path(
+                user_config_path=plugin_config.get('config')
+            )
+            data = dynamic_inventory.load_generated_inventory(config_path)
+        except SystemExit as e:
+            raise AnsibleParserError(
+                'Unable to generate the inventory: %s' % e.code
+            )
+
+        self._populate(data)
+
+    def _populate(self, data):
+        """Add the groups, hosts and variables of an inventory.
+
+        :param data: ``dict`` inventory as generated by dynamic_inventory
+        """
+        groups = dict(
+            (name, group) for name, group in data.items()
+            if name != '_meta' and isinstance(group, dict)
+        )
+
+        for name in groups:
+            self.inventory.add_group(name)
+
+        for name, group in groups.items():
+            for host in group.get('hosts') or list():
+                self.inventory.add_host(host, group=name)
+            for child in group.get('children') or list():
+                self.inventory.add_group(child)
+                self.inventory.add_child(name, child)
+            for key, value in (group.get('vars') or dict()).items():
+                self.inventory.set_variable(name, key, value)
+
+        hostvars = data.get('_meta', dict()).get('hostvars', dict())
+        for host, host_vars in hostvars.items():
+            self.inventory.add_host(host)
+            for key, value in host_vars.items():
+                self.inventory.set_variable(host, key, value)
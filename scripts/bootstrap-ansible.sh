@@ -157,6 +157,18 @@ VAR1="\$(for i in \$(ls /etc/openstack_deploy/user_*.yml); do echo -ne "-e @\$i
 # Provide information on the discovered variables.
 info "Variable files: \"\${VAR1}\""
 
+# Provide information on a limited inventory, see --limit-groups of the
+# dynamic inventory.
+if [[ -n "\${OSA_INVENTORY_LIMIT_GROUPS}" ]]; then
+  info "Inventory groups: \"\${OSA_INVENTORY_LIMIT_GROUPS}\""
+fi
+
+# Provide information on the inventory shard, see --shard of the dynamic
+# inventory.
+if [[ -n "\${OSA_INVENTORY_SHARD}" ]]; then
+  info "Inventory shard: \"\${OSA_INVENTORY_SHARD}\""
+fi
+
 # Run the ansible playbook command.
 \$(which ansible-playbook) \${VAR1} \$@
 EOF
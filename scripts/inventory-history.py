@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#
+# Copyright 2016, Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Lists, shows and restores revisions of the inventory history."""
+import argparse
+import datetime
+import os
+import prettytable
+import sys
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        '..', 'playbooks', 'inventory'
+    )
+)
+
+import dynamic_inventory  # noqa
+
+
+def args():
+    """Setup argument Parsing."""
+    parser = argparse.ArgumentParser(
+        usage='%(prog)s',
+        description='OpenStack Inventory History',
+        epilog='Inventory History Licensed "Apache 2.0"')
+
+    parser.add_argument(
+        '--config',
+        help='Path containing the user defined configuration files',
+        required=False,
+        default=None
+    )
+
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.add_parser(
+        'list',
+        help='List the revisions of the inventory, oldest first'
+    )
+    show = subparsers.add_parser(
+        'show',
+        help='Print the JSON patch from the revision before to a revision'
+    )
+    show.add_argument(
+        'revision',
+        help='Number of the revision, as listed, or the start of its checksum'
+    )
+    restore = subparsers.add_parser(
+        'restore',
+        help='Restore openstack_inventory.json to a revision'
+    )
+    restore.add_argument(
+        'revision',
+        help='Number of the revision, as listed, or the start of its checksum'
+    )
+
+    return vars(parser.parse_args())
+
+
+def find_revision(snapshots, revision):
+    """Return the index of a revision in the list of snapshots.
+
+    Keyword arguments:
+    snapshots -- list of (time, checksum) of the snapshots, oldest first
+    revision -- number of the revision, counting from 1, or the start of its
+                checksum
+    """
+    if revision.isdigit() and 0 < int(revision) <= len(snapshots):
+        return int(revision) - 1
+
+    matches = [
+        index for index, (_, checksum) in enumerate(snapshots)
+        if checksum.startswith(revision.lower())
+    ]
+    if len(set(snapshots[index][1] for index in matches)) != 1:
+        raise SystemExit('No single revision matches: %s' % revision)
+    return matches[-1]
+
+
+def print_revisions(store, snapshots):
+    """Return a table of the revisions of the inventory.
+
+    Keyword arguments:
+    store -- inventory backup store
+    snapshots -- list of (time, checksum) of the snapshots, oldest first
+    """
+    table = prettytable.PrettyTable(
+        ['revision', 'time (UTC)', 'checksum', 'stored as']
+    )
+    for index, (timestamp, checksum) in enumerate(snapshots):
+        table.add_row([
+            index + 1,
+            datetime.datetime.utcfromtimestamp(timestamp).strftime(
+                '%Y-%m-%d %H:%M:%S'
+            ),
+            checksum,
+            'checkpoint' if store.is_checkpoint(checksum) else 'delta'
+        ])
+    for tbl in table.align.keys():
+        table.align[tbl] = 'l'
+    return table
+
+
+def show_revision(store, snapshots, index):
+    """Return the JSON patch from the revision before to a revision.
+
+    The first revision is shown as a patch from an empty inventory.
+
+    Keyword arguments:
+    store -- inventory backup store
+    snapshots -- list of (time, checksum) of the snapshots, oldest first
+    index -- index of the revision in the list of snapshots
+    """
+    previous = dict()
+    if index > 0:
+        previous = store.load(snapshots[index - 1][1])
+    return dynamic_inventory.dump_json(
+        dynamic_inventory.json_diff(previous, store.load(snapshots[index][1]))
+    )
+
+
+def restore_revision(config_path, store, checksum):
+    """Write a revision to the inventory file.
+
+    Keyword arguments:
+    config_path -- path where the configuration files are kept
+    store -- inventory backup store
+    checksum -- SHA1 checksum of the revision
+    """
+    inventory_file_path = os.path.join(
+        config_path, 'openstack_inventory.json'
+    )
+    with dynamic_inventory.inventory_lock(config_path, exclusive=True):
+        store.restore(checksum, inventory_file_path)
+
+
+def main():
+    """Run the main application."""
+    # Parse user args
+    user_args = args()
+
+    config_path = dynamic_inventory.find_config_path(
+        user_config_path=user_args['config']
+    )
+    store = dynamic_inventory.InventoryBackupStore(config_path)
+    snapshots = store.snapshots()
+
+    if user_args['action'] == 'list':
+        print(print_revisions(store, snapshots))
+        return
+
+    index = find_revision(snapshots, user_args['revision'])
+    if user_args['action'] == 'show':
+        print(show_revision(store, snapshots, index))
+    else:
+        # Keep the retention of the user configuration
+        user_defined_config = dynamic_inventory.load_user_configuration(
+            config_path
+        )
+        store.max_count = user_defined_config.get(
+            'inventory_backup_count', store.max_count
+        )
+        store.max_age = user_defined_config.get(
+            'inventory_backup_max_age', store.max_age
+        )
+        restore_revision(config_path, store, snapshots[index][1])
+        print('Restored revision %d. . .' % (index + 1))
+
+if __name__ == "__main__":
+    main()
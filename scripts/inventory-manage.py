@@ -22,6 +22,29 @@ import argparse
 import json
 import os
 import prettytable
+import sys
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        '..', 'playbooks', 'inventory'
+    )
+)
+
+import dynamic_inventory  # noqa
+
+
+# Hostvars shown for each host by --list-host
+HOST_TABLE_COLUMNS = [
+    'container_name',
+    'is_metal',
+    'component',
+    'physical_host',
+    'tunnel_address',
+    'ansible_ssh_host',
+    'container_types'
+]
 
 
 def file_find(filename, user_file=None, pass_exception=False):
@@ -266,15 +289,7 @@ def print_inventory(inventory, sort_key):
     inventory -- inventory dictionary
     """
     _meta_data = inventory['_meta']['hostvars']
-    required_list = [
-        'container_name',
-        'is_metal',
-        'component',
-        'physical_host',
-        'tunnel_address',
-        'ansible_ssh_host',
-        'container_types'
-    ]
+    required_list = HOST_TABLE_COLUMNS
     table = prettytable.PrettyTable(required_list)
     for key, values in _meta_data.iteritems():
         for rl in required_list:
@@ -296,6 +311,61 @@ def print_inventory(inventory, sort_key):
     return table
 
 
+def load_inventory(environment_file, hostvar_keys=None):
+    """Return the inventory, read from the inventory database if possible.
+
+    Keyword arguments:
+    environment_file -- path of the inventory file
+    hostvar_keys -- hostvars needed, all of them are loaded by default
+    """
+    inventory_db = dynamic_inventory.open_inventory_db(
+        os.path.dirname(environment_file), environment_file
+    )
+    if inventory_db is None:
+        with open(environment_file, 'rb') as f_handle:
+            return json.loads(f_handle.read())
+
+    try:
+        return dynamic_inventory.load_inventory_db(inventory_db, hostvar_keys)
+    finally:
+        inventory_db.close()
+
+
+def remove_items(environment_file, purge_list):
+    """Remove items from the inventory and save it.
+
+    When the inventory database matches the inventory file, the items are
+    removed from it in a single transaction and the inventory file is
+    exported from it.
+
+    Keyword arguments:
+    environment_file -- path of the inventory file
+    purge_list -- list of items to remove
+    """
+    config_path = os.path.dirname(environment_file)
+    with dynamic_inventory.inventory_lock(config_path, exclusive=True):
+        inventory_db = dynamic_inventory.open_inventory_db(
+            config_path, environment_file
+        )
+        if inventory_db is None:
+            with open(environment_file, 'rb') as f_handle:
+                inventory = json.loads(f_handle.read())
+            recursive_dict_removal(inventory, purge_list)
+            with open(environment_file, 'wb') as f_handle:
+                f_handle.write(dynamic_inventory.dump_json(inventory))
+            return
+
+        try:
+            dynamic_inventory.remove_inventory_db_items(
+                inventory_db, purge_list
+            )
+            dynamic_inventory.export_inventory_db(
+                inventory_db, environment_file
+            )
+        finally:
+            inventory_db.close()
+
+
 def main():
     """Run the main application."""
     # Parse user args
@@ -303,25 +373,24 @@ def main():
 
     # Get the contents of the system environment json
     environment_file = file_find(filename=user_args['file'])
-    with open(environment_file, 'rb') as f_handle:
-        inventory = json.loads(f_handle.read())
 
     # Make a table with hosts in the left column and details about each in the
     # columns to the right
     if user_args['list_host'] is True:
+        inventory = load_inventory(environment_file, HOST_TABLE_COLUMNS)
         print(print_inventory(inventory, user_args['sort']))
 
     # Groups in first column, containers in each group on the right
     elif user_args['list_groups'] is True:
+        inventory = load_inventory(environment_file, [])
         print(print_groups_per_container(inventory))
 
     # Containers in the first column, groups for each container on the right
     elif user_args['list_containers'] is True:
+        inventory = load_inventory(environment_file, [])
         print(print_containers_per_group(inventory))
     else:
-        recursive_dict_removal(inventory, user_args['remove_item'])
-        with open(environment_file, 'wb') as f_handle:
-            f_handle.write(json.dumps(inventory, indent=2))
+        remove_items(environment_file, user_args['remove_item'])
         print('Success. . .')
 
 if __name__ == "__main__":
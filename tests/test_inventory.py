@@ -2,12 +2,22 @@
 
 import collections
 import copy
+import datetime
+import glob
+import hashlib
+import imp
 import json
 import mock
+import netaddr
 import os
 from os import path
-import Queue
+import pickle
+import shutil
+import socket
+import subprocess
 import sys
+import tempfile
+import time
 import unittest
 import yaml
 
@@ -16,8 +26,17 @@ SCRIPT_FILENAME = 'dynamic_inventory.py'
 INV_SCRIPT = path.join(os.getcwd(), INV_DIR, SCRIPT_FILENAME)
 
 sys.path.append(path.join(os.getcwd(), INV_DIR))
+sys.path.append(path.join(os.getcwd(), 'playbooks', 'inventory_plugins'))
 
 import dynamic_inventory as di
+import openstack_ansible
+
+HISTORY_SCRIPT = path.join(os.getcwd(), 'scripts', 'inventory-history.py')
+try:
+    inventory_history = imp.load_source('inventory_history', HISTORY_SCRIPT)
+except ImportError:
+    # prettytable, from requirements.txt, is not installed
+    inventory_history = None
 
 TARGET_DIR = path.join(os.getcwd(), 'tests', 'inventory')
 USER_CONFIG_FILE = path.join(TARGET_DIR, "openstack_user_config.yml")
@@ -27,7 +46,13 @@ USER_CONFIG_FILE = path.join(TARGET_DIR, "openstack_user_config.yml")
 CLEANUP = [
     'openstack_inventory.json',
     'openstack_hostnames_ips.yml',
-    'backup_openstack_inventory.tar'
+    'openstack_config.cache',
+    'openstack_inventory.cache',
+    'openstack_inventory.db',
+    'openstack_inventory.hosts',
+    'openstack_inventory.lock',
+    'openstack_inventory.sock',
+    'openstack_inventory_shards.json'
 ]
 
 
@@ -37,6 +62,21 @@ def cleanup():
         if os.path.exists(f_file):
             os.remove(f_file)
 
+    backup_dir = path.join(TARGET_DIR, 'backup_openstack_inventory')
+    if os.path.exists(backup_dir):
+        shutil.rmtree(backup_dir)
+
+    for f_file in glob.glob(path.join(TARGET_DIR, '*.bitmap')):
+        os.remove(f_file)
+
+    cache_files = path.join(TARGET_DIR, 'openstack_inventory.*.cache')
+    for f_file in glob.glob(cache_files):
+        os.remove(f_file)
+
+    shard_files = path.join(TARGET_DIR, 'openstack_inventory.*.json')
+    for f_file in glob.glob(shard_files):
+        os.remove(f_file)
+
 
 def get_inventory(clean=True):
     "Return the inventory mapping in a dict."
@@ -65,6 +105,55 @@ class TestArgParser(unittest.TestCase):
         arg_dict = di.args(['--config', '/etc/openstack_deploy'])
         self.assertEqual(arg_dict['config'], '/etc/openstack_deploy')
 
+    def test_capacity_report_arg(self):
+        arg_dict = di.args(['--capacity-report'])
+        self.assertEqual(arg_dict['capacity_report'], True)
+
+    def test_daemon_arg(self):
+        arg_dict = di.args(['--daemon'])
+        self.assertEqual(arg_dict['daemon'], True)
+
+    def test_host_arg(self):
+        arg_dict = di.args(['--host', 'aio1'])
+        self.assertEqual(arg_dict['host'], 'aio1')
+
+    def test_compact_arg(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(di.args([])['compact'], False)
+            self.assertEqual(di.args(['--compact'])['compact'], True)
+
+    def test_compact_env_default(self):
+        env = {di.OUTPUT_OPTION_ENVS['compact']: 'true'}
+        with mock.patch.dict(os.environ, env):
+            self.assertEqual(di.args([])['compact'], True)
+
+    def test_limit_groups_arg(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(di.args([])['limit_groups'], None)
+            arg_dict = di.args(['--limit-groups', 'swift_all'])
+            self.assertEqual(arg_dict['limit_groups'], 'swift_all')
+
+    def test_limit_groups_env_default(self):
+        env = {di.OUTPUT_OPTION_ENVS['limit_groups']: 'swift_*'}
+        with mock.patch.dict(os.environ, env):
+            self.assertEqual(di.args([])['limit_groups'], 'swift_*')
+
+    def test_shard_arg(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(di.args([])['shard'], None)
+            self.assertEqual(di.args(['--shard', 'r1'])['shard'], 'r1')
+
+    def test_shard_env_default(self):
+        env = {di.OUTPUT_OPTION_ENVS['shard']: 'r2'}
+        with mock.patch.dict(os.environ, env):
+            self.assertEqual(di.args([])['shard'], 'r2')
+
+    def test_hoist_group_vars_arg(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(di.args([])['hoist_group_vars'], False)
+            arg_dict = di.args(['--hoist-group-vars'])
+            self.assertEqual(arg_dict['hoist_group_vars'], True)
+
 
 class TestAnsibleInventoryFormatConstraints(unittest.TestCase):
     inventory = None
@@ -288,6 +377,9 @@ class TestUserConfiguration(unittest.TestCase):
         """Test that the user configuration can be loaded"""
         self.assertIsInstance(self.loaded_user_configuration, dict)
 
+    def tearDown(self):
+        cleanup()
+
 
 class TestEnvironments(unittest.TestCase):
     def setUp(self):
@@ -308,6 +400,9 @@ class TestEnvironments(unittest.TestCase):
         for key in expected_keys:
             self.assertIn(key, self.loaded_environment)
 
+    def tearDown(self):
+        cleanup()
+
 
 class TestIps(unittest.TestCase):
     def setUp(self):
@@ -321,7 +416,7 @@ class TestIps(unittest.TestCase):
             # tearDown is ineffective for this loop, so clean the USED_IPs
             # on each run
             inventory = None
-            di.USED_IPS = []
+            di.USED_IPS = di.IPRangeSet()
             inventory = get_inventory()
             ips = collections.defaultdict(int)
             hostvars = inventory['_meta']['hostvars']
@@ -338,7 +433,9 @@ class TestIps(unittest.TestCase):
                                          msg="IP %s duplicated." % addr)
 
     def test_empty_ip_queue(self):
-        q = Queue.Queue()
+        q = di._load_ip_q('192.168.0.0/30')
+        di.get_ip_address('test', q)
+        di.get_ip_address('test', q)
         with self.assertRaises(SystemExit) as context:
             di.get_ip_address('test', q)
         expectedLog = ("Cannot retrieve requested amount of IP addresses. "
@@ -346,10 +443,224 @@ class TestIps(unittest.TestCase):
                        "openstack_user_config.yml.")
         self.assertEqual(context.exception.message, expectedLog)
 
+    def test_ip_queue_visits_every_address_once(self):
+        q = di._load_ip_q('10.0.0.0/24')
+        ips = [di.get_ip_address('test', q) for _ in range(254)]
+        expected = [str(i) for i in netaddr.IPNetwork('10.0.0.0/24')][1:-1]
+        self.assertEqual(sorted(ips, key=netaddr.IPAddress), expected)
+        self.assertIsNone(q.get())
+
+    def test_ip_queue_skips_used_ips(self):
+        di.USED_IPS.add_range('10.0.0.1', '10.0.0.250')
+        q = di._load_ip_q('10.0.0.0/24')
+        ips = set(di.get_ip_address('test', q) for _ in range(4))
+        self.assertEqual(ips, set(['10.0.0.251', '10.0.0.252',
+                                   '10.0.0.253', '10.0.0.254']))
+
+    def test_ip_queue_is_lazy(self):
+        q = di._load_ip_q('10.0.0.0/8')
+        ip = di.get_ip_address('test', q)
+        self.assertIn(netaddr.IPAddress(ip),
+                      netaddr.IPNetwork('10.0.0.0/8'))
+        self.assertIn(ip, di.USED_IPS)
+
     def tearDown(self):
         # Since the get_ip_address function touches USED_IPS,
         # and USED_IPS is currently a global var, make sure we clean it out
-        di.USED_IPS = []
+        di.USED_IPS = di.IPRangeSet()
+
+
+class TestCIDRNetwork(unittest.TestCase):
+    def test_matches_netaddr(self):
+        for cidr in ('172.29.236.0/22', '10.0.0.5/24', '10.0.0.0/31',
+                     'fd00:29:244::/64', '10.0.0.0/255.255.0.0'):
+            network = di.CIDRNetwork(cidr)
+            expected = netaddr.IPNetwork(cidr)
+            self.assertEqual(str(network), str(expected))
+            self.assertEqual(network.version, expected.version)
+            self.assertEqual(network.first, expected.first)
+            self.assertEqual(network.last, expected.last)
+            self.assertEqual(network.size, expected.size)
+            self.assertEqual(network.network, str(expected.network))
+            self.assertEqual(network.netmask, str(expected.netmask))
+
+    def test_broadcast(self):
+        self.assertEqual(di.CIDRNetwork('10.0.0.0/30').broadcast, '10.0.0.3')
+        self.assertIsNone(di.CIDRNetwork('10.0.0.0/31').broadcast)
+
+    def test_invalid_network(self):
+        with self.assertRaises(netaddr.AddrFormatError):
+            di.CIDRNetwork('10.0.0.0/33')
+
+    def test_address_conversion(self):
+        for ip in ('172.29.236.100', 'fd00:29:244::5', '::ffff:10.0.0.1'):
+            version, value = di._ip_to_int(ip)
+            self.assertEqual(value, int(netaddr.IPAddress(ip)))
+            self.assertEqual(di._int_to_ip(value, version),
+                             str(netaddr.IPAddress(ip)))
+
+    def test_invalid_address(self):
+        with self.assertRaises(ValueError):
+            di._ip_to_int('172.29.236.300')
+
+
+class TestIPRangeSet(unittest.TestCase):
+    def setUp(self):
+        self.ips = di.IPRangeSet()
+
+    def test_single_address(self):
+        self.ips.add('172.29.236.10')
+        self.assertIn('172.29.236.10', self.ips)
+        self.assertNotIn('172.29.236.11', self.ips)
+
+    def test_range_is_not_expanded(self):
+        self.ips.add_range('10.0.0.0', '10.255.255.255')
+        self.assertIn('10.128.4.1', self.ips)
+        self.assertNotIn('11.0.0.0', self.ips)
+        self.assertEqual(self.ips.size(), 2 ** 24)
+
+    def test_adjacent_and_overlapping_ranges_merge(self):
+        self.ips.add_range('172.29.236.1', '172.29.236.50')
+        self.ips.add_range('172.29.236.40', '172.29.236.60')
+        self.ips.add('172.29.236.61')
+        self.ips.add_range('172.29.236.100', '172.29.236.110')
+        self.assertEqual(self.ips._starts[4], [
+            int(netaddr.IPAddress('172.29.236.1')),
+            int(netaddr.IPAddress('172.29.236.100')),
+        ])
+        self.assertEqual(self.ips.size(), 72)
+
+    def test_truth_value_without_len(self):
+        self.assertFalse(self.ips)
+        self.ips.add_range('fd00::', 'fd00::ffff:ffff:ffff:ffff')
+        self.assertTrue(self.ips)
+        self.assertRaises(TypeError, len, self.ips)
+
+    def test_address_families_are_separate(self):
+        self.ips.add('0.0.0.1')
+        self.assertNotIn('::1', self.ips)
+
+    def test_ipv6_size(self):
+        self.ips.add('172.29.236.10')
+        self.ips.add_range('fd00::', 'fd00::ffff:ffff:ffff:ffff')
+        self.assertEqual(self.ips.size(), 2 ** 64 + 1)
+        self.assertEqual(self.ips.size(6), 2 ** 64)
+        self.assertEqual(self.ips.size(4), 1)
+        self.assertEqual(
+            self.ips.size(6, int(netaddr.IPAddress('fd00::ff')),
+                          int(netaddr.IPAddress('fd00::1:0'))),
+            2 ** 16 - 254
+        )
+        self.assertIsInstance(self.ips.size(4), long)
+
+    def test_invalid_address_is_not_member(self):
+        self.ips.add('172.29.236.10')
+        self.assertNotIn('not-an-ip', self.ips)
+        self.assertNotIn(None, self.ips)
+
+
+class TestIPBitmap(unittest.TestCase):
+    def setUp(self):
+        self.bitmap_file = path.join(TARGET_DIR, 'test.bitmap')
+
+    def test_new_bitmap_is_empty_and_invalid(self):
+        bitmap = di.IPBitmap(self.bitmap_file, '10.0.0.0/24', 'abc')
+        self.assertFalse(bitmap.valid)
+        self.assertFalse(any(bitmap.is_set(i) for i in range(256)))
+        bitmap.save('abc')
+
+    def test_saved_bitmap_is_reloaded(self):
+        bitmap = di.IPBitmap(self.bitmap_file, '10.0.0.0/24')
+        bitmap.set(bitmap.offset('10.0.0.9'))
+        bitmap.save('abc')
+
+        bitmap = di.IPBitmap(self.bitmap_file, '10.0.0.0/24', 'abc')
+        self.assertTrue(bitmap.valid)
+        self.assertTrue(bitmap.is_set(9))
+        self.assertFalse(bitmap.is_set(10))
+        bitmap.save('abc')
+
+    def test_checksum_mismatch_is_invalid(self):
+        di.IPBitmap(self.bitmap_file, '10.0.0.0/24').save('abc')
+        bitmap = di.IPBitmap(self.bitmap_file, '10.0.0.0/24', 'def')
+        self.assertFalse(bitmap.valid)
+        bitmap.save('def')
+
+    def test_unsaved_bitmap_is_invalid(self):
+        di.IPBitmap(self.bitmap_file, '10.0.0.0/24').save('abc')
+        di.IPBitmap(self.bitmap_file, '10.0.0.0/24', 'abc').set(1)
+        bitmap = di.IPBitmap(self.bitmap_file, '10.0.0.0/24', 'abc')
+        self.assertFalse(bitmap.valid)
+        bitmap.save('abc')
+
+    def test_unchanged_bitmap_is_not_written(self):
+        di.IPBitmap(self.bitmap_file, '10.0.0.0/24').save('abc')
+        with open(self.bitmap_file, 'rb') as f:
+            saved = f.read()
+
+        bitmap = di.IPBitmap(self.bitmap_file, '10.0.0.0/24', 'abc')
+        di.IPBitmap(self.bitmap_file, '10.0.0.0/24', 'abc').save('abc')
+        self.assertTrue(bitmap.valid)
+        bitmap.save('abc')
+        with open(self.bitmap_file, 'rb') as f:
+            self.assertEqual(f.read(), saved)
+
+    def test_network_change_resets_bitmap(self):
+        bitmap = di.IPBitmap(self.bitmap_file, '10.0.0.0/24')
+        bitmap.set(5)
+        bitmap.save('abc')
+
+        bitmap = di.IPBitmap(self.bitmap_file, '10.0.1.0/24', 'abc')
+        self.assertFalse(bitmap.valid)
+        self.assertFalse(bitmap.is_set(5))
+        bitmap.save('abc')
+
+    def test_offset_outside_network(self):
+        bitmap = di.IPBitmap(self.bitmap_file, '10.0.0.0/24')
+        self.assertIsNone(bitmap.offset('10.0.1.1'))
+        self.assertEqual(bitmap.offset('10.0.0.1'), 1)
+        bitmap.save('abc')
+
+    def test_bitmaps_match_inventory(self):
+        inventory = get_inventory(clean=False)
+        bitmap = di.IPBitmap(
+            path.join(TARGET_DIR, 'openstack_inventory.container.bitmap'),
+            '172.29.236.0/22',
+            di.get_file_checksum(
+                path.join(TARGET_DIR, 'openstack_inventory.json')
+            )
+        )
+        self.assertTrue(bitmap.valid)
+        for hostvars in inventory['_meta']['hostvars'].values():
+            network = hostvars['container_networks']['container_address']
+            if 'address' in network and 'container_types' not in hostvars:
+                offset = bitmap.offset(network['address'])
+                self.assertTrue(bitmap.is_set(offset))
+        bitmap.save('')
+
+    def test_valid_bitmaps_skip_hostvars_scan(self):
+        get_inventory(clean=False)
+        di.USED_IPS = di.IPRangeSet()
+        with mock.patch('dynamic_inventory.IPRangeSet.add') as add_mock:
+            di._set_used_ips(
+                {'cidr_networks': {'container': '172.29.236.0/22'}},
+                di.get_inventory(TARGET_DIR, path.join(
+                    TARGET_DIR, 'openstack_inventory.json')),
+                di.load_ip_bitmaps(
+                    TARGET_DIR,
+                    {'container': '172.29.236.0/22'},
+                    di.get_file_checksum(
+                        path.join(TARGET_DIR, 'openstack_inventory.json')
+                    )
+                )
+            )
+        self.assertFalse(add_mock.called)
+
+    def tearDown(self):
+        if os.path.exists(self.bitmap_file):
+            os.remove(self.bitmap_file)
+        cleanup()
+        di.USED_IPS = di.IPRangeSet()
 
 
 class TestConfigChecks(unittest.TestCase):
@@ -616,6 +927,495 @@ class TestStaticRouteConfig(TestConfigChecks):
         self.assertEqual(exception.message, self.expectedMsg)
 
 
+class TestIPv6Networks(TestConfigChecks):
+    def add_ipv6_network(self, q_name, cidr):
+        ipv6_q_name = '%s_v6' % q_name
+        self.user_defined_config['cidr_networks'][ipv6_q_name] = cidr
+        pn = self.user_defined_config['global_overrides']['provider_networks']
+        for net in pn:
+            if net['network'].get('ip_from_q') == q_name:
+                net['network']['ipv6_from_q'] = ipv6_q_name
+        self.write_config()
+
+    def test_ip_queue_on_large_prefix(self):
+        q = di._load_ip_q('fd00:29:244::/64')
+        ips = set(di.get_ip_address('test', q) for _ in range(100))
+        self.assertEqual(len(ips), 100)
+        for ip in ips:
+            self.assertIn(netaddr.IPAddress(ip),
+                          netaddr.IPNetwork('fd00:29:244::/64'))
+        di.USED_IPS = di.IPRangeSet()
+
+    def test_dual_stack_addresses(self):
+        self.add_ipv6_network('container', 'fd00:29:236::/64')
+        inventory = get_inventory()
+
+        ipv6_addresses = []
+        for hostvars in inventory['_meta']['hostvars'].values():
+            networks = hostvars['container_networks']
+            network = networks['container_address']
+            if hostvars['properties'].get('is_metal'):
+                self.assertNotIn('ipv6_address', network)
+                continue
+
+            self.assertIn(netaddr.IPAddress(network['address']),
+                          netaddr.IPNetwork('172.29.236.0/22'))
+            self.assertIn(netaddr.IPAddress(network['ipv6_address']),
+                          netaddr.IPNetwork('fd00:29:236::/64'))
+            self.assertEqual(network['ipv6_netmask'], 'ffff:ffff:ffff:ffff::')
+            ipv6_addresses.append(network['ipv6_address'])
+
+        self.assertTrue(ipv6_addresses)
+        self.assertEqual(len(ipv6_addresses), len(set(ipv6_addresses)))
+
+    def test_ipv6_from_q_must_be_ipv6(self):
+        self.add_ipv6_network('storage', '172.29.252.0/22')
+        with self.assertRaises(SystemExit) as context:
+            get_inventory()
+        expectedLog = "storage_v6 in cidr_networks is not an IPv6 network"
+        self.assertEqual(context.exception.message, expectedLog)
+
+    def tearDown(self):
+        super(TestIPv6Networks, self).tearDown()
+        di.USED_IPS = di.IPRangeSet()
+
+
+class TestHashAllocation(TestConfigChecks):
+    def test_stable_queue_is_reproducible(self):
+        q = di._load_ip_q('10.0.0.0/16', stable=True)
+        first = di.get_ip_address('container', q, key='host1')
+        di.USED_IPS = di.IPRangeSet()
+
+        q = di._load_ip_q('10.0.0.0/16', stable=True)
+        self.assertEqual(di.get_ip_address('container', q, key='host1'),
+                         first)
+
+    def test_stable_queue_probes_on_collision(self):
+        q = di._load_ip_q('10.0.0.0/16', stable=True)
+        first = di.get_ip_address('container', q, key='host1')
+        di.USED_IPS = di.IPRangeSet()
+
+        di.USED_IPS.add(first)
+        q = di._load_ip_q('10.0.0.0/16', stable=True)
+        second = di.get_ip_address('container', q, key='host1')
+        self.assertEqual(netaddr.IPAddress(second),
+                         netaddr.IPAddress(first) + 1)
+
+    def test_rebuilt_inventory_keeps_addresses(self):
+        self.user_defined_config['ip_allocation_mode'] = 'hash'
+        self.write_config()
+
+        first = get_inventory()
+        di.USED_IPS = di.IPRangeSet()
+        second = get_inventory()
+
+        self.assertEqual(first['_meta']['hostvars'],
+                         second['_meta']['hostvars'])
+
+    def test_invalid_allocation_mode(self):
+        self.user_defined_config['ip_allocation_mode'] = 'sequential'
+        self.write_config()
+        with self.assertRaises(SystemExit) as context:
+            get_inventory()
+        expectedLog = "ip_allocation_mode must be one of: random, hash"
+        self.assertEqual(context.exception.message, expectedLog)
+
+    def tearDown(self):
+        super(TestHashAllocation, self).tearDown()
+        di.USED_IPS = di.IPRangeSet()
+
+
+class TestNetworkCapacity(TestConfigChecks):
+    def get_capacity_without_cleanup(self):
+        return dict(
+            (net['network'], net)
+            for net in json.loads(di.main({'config': TARGET_DIR,
+                                           'capacity_report': True}))
+        )
+
+    def get_capacity(self):
+        try:
+            return self.get_capacity_without_cleanup()
+        finally:
+            cleanup()
+            di.USED_IPS = di.IPRangeSet()
+
+    def test_capacity_report(self):
+        capacity = self.get_capacity()
+        self.assertEqual(set(capacity), set(['container', 'storage',
+                                             'tunnel']))
+
+        container = capacity['container']
+        self.assertEqual(container['cidr'], '172.29.236.0/22')
+        self.assertTrue(container['needed'] > 0)
+        # 1024 addresses less the network, broadcast, the 50 addresses of
+        # used_ips and the address of aio1.
+        self.assertEqual(container['available'], 1024 - 2 - 50 - 1)
+        self.assertEqual(container['headroom'],
+                         container['available'] - container['needed'])
+
+    def test_capacity_report_writes_nothing(self):
+        self.get_capacity()
+        self.assertFalse(os.path.exists(
+            path.join(TARGET_DIR, 'openstack_inventory.json')))
+
+    def test_capacity_report_leaves_files_alone(self):
+        get_inventory(clean=False)
+        di.USED_IPS = di.IPRangeSet()
+        os.remove(path.join(TARGET_DIR, di.CONFIG_CACHE_FILE))
+        files = [
+            path.join(TARGET_DIR, name) for name in os.listdir(TARGET_DIR)
+            if name.startswith('openstack_inventory') and
+            name != di.INVENTORY_LOCK_FILE
+        ]
+        for file_path in files:
+            os.utime(file_path, (0, 0))
+
+        self.get_capacity_without_cleanup()
+        try:
+            self.assertFalse(os.path.exists(
+                path.join(TARGET_DIR, di.CONFIG_CACHE_FILE)))
+            for file_path in files:
+                self.assertEqual(os.stat(file_path).st_mtime, 0)
+        finally:
+            cleanup()
+
+    def test_network_shared_by_provider_networks(self):
+        needed = self.get_capacity()['container']['needed']
+        self.assertTrue(needed > 0)
+        provider_networks = (
+            self.user_defined_config['global_overrides']['provider_networks']
+        )
+        provider_networks.append({'network': {
+            'container_bridge': 'br-mgmt2',
+            'container_type': 'veth',
+            'container_interface': 'eth20',
+            'ip_from_q': 'container',
+            'type': 'raw',
+            'group_binds': ['all_containers']
+        }})
+        self.write_config()
+
+        self.assertEqual(self.get_capacity()['container']['needed'], needed)
+
+    def test_existing_addresses_are_not_needed(self):
+        get_inventory(clean=False)
+        di.USED_IPS = di.IPRangeSet()
+        capacity = self.get_capacity()
+        self.assertEqual(capacity['container']['needed'], 0)
+        self.assertEqual(capacity['storage']['needed'], 0)
+
+    def test_small_network_fails_fast(self):
+        self.user_defined_config['cidr_networks']['container'] = (
+            '172.29.236.0/28'
+        )
+        self.write_config()
+        with self.assertRaises(SystemExit) as context:
+            get_inventory()
+        message = context.exception.message
+        self.assertIn('Increase the container range', message)
+        self.assertIn('network    cidr', message)
+        self.assertIn('container  172.29.236.0/28', message)
+
+    def test_failed_check_leaves_no_bitmaps(self):
+        self.user_defined_config['cidr_networks']['container'] = (
+            '172.29.236.0/29'
+        )
+        self.write_config()
+        self.addCleanup(cleanup)
+        with self.assertRaises(SystemExit):
+            get_inventory(clean=False)
+        self.assertEqual(
+            glob.glob(path.join(TARGET_DIR, 'openstack_inventory.*.bitmap')),
+            []
+        )
+
+    def test_ipv6_used_ips_count(self):
+        di.USED_IPS.add_range('fd00::1', 'fd00::7fff:ffff:ffff:ffff')
+        try:
+            used = di._count_used_ips(di.CIDRNetwork('fd00::/64'))
+        finally:
+            di.USED_IPS = di.IPRangeSet()
+        # The range and the network address
+        self.assertEqual(used, 2 ** 63)
+
+    def test_bitmap_count(self):
+        bitmap_file = path.join(TARGET_DIR, 'test.bitmap')
+        bitmap = di.IPBitmap(bitmap_file, '10.0.0.0/24')
+        for offset in (1, 7, 8, 9, 200):
+            bitmap.set(offset)
+        self.assertEqual(bitmap.count(), 5)
+        self.assertEqual(bitmap.count(7, 9), 3)
+        self.assertEqual(bitmap.count(2, 6), 0)
+        self.assertEqual(bitmap.count(8, 8), 1)
+        bitmap.save('')
+        os.remove(bitmap_file)
+
+
+class TestHostvarsIndex(TestConfigChecks):
+    def test_index_hostvars(self):
+        inventory = {'_meta': {'hostvars': {
+            'aio1': {},
+            'aio1_keystone_container-0123abcd': {'physical_host': 'aio1'},
+            'aio1_keystone_container-4567abcd': {'physical_host': 'aio1'},
+            'aio10': {'physical_host': None},
+        }}}
+        index = di._index_hostvars(inventory)
+
+        self.assertEqual(sorted(index['physical_host']['aio1']),
+                         ['aio1', 'aio1_keystone_container-0123abcd',
+                          'aio1_keystone_container-4567abcd'])
+        self.assertEqual(index['physical_host']['aio10'], ['aio10'])
+        self.assertEqual(
+            len(index['type_and_name']['aio1_keystone_container']), 2
+        )
+
+    def test_prefixed_host_names(self):
+        for group in ('identity_hosts', 'compute_hosts'):
+            self.user_defined_config[group]['aio10'] = {
+                'ip': '172.29.236.101'
+            }
+        self.write_config()
+
+        inventory = get_inventory()
+        hostvars = inventory['_meta']['hostvars']
+
+        self.assertEqual(hostvars['aio10']['physical_host'], 'aio10')
+        for hname, hdata in hostvars.items():
+            if hdata['physical_host'] == 'aio1':
+                self.assertFalse(hname.startswith('aio10'))
+
+        aio10_keystone = [
+            hname for hname in inventory['keystone_container']['hosts']
+            if hname.startswith('aio10_')
+        ]
+        self.assertEqual(len(aio10_keystone), 1)
+
+
+class TestContainerVars(TestConfigChecks):
+    def test_limit_container_types(self):
+        container_vars = {
+            'cinder_backends': {
+                'limit_container_types': 'cinder_volume',
+                'lvm': {'volume_group': 'cinder-volumes'}
+            },
+            'shared_var': 'shared'
+        }
+        compiled = di._compile_container_vars(container_vars)
+
+        cinder = di._resolve_container_vars(compiled, 'cinder_volume')
+        self.assertEqual(cinder['cinder_backends'],
+                         {'lvm': {'volume_group': 'cinder-volumes'}})
+        self.assertEqual(cinder['shared_var'], 'shared')
+
+        nova = di._resolve_container_vars(compiled, 'nova_compute')
+        self.assertEqual(nova, {'shared_var': 'shared'})
+        self.assertIn('limit_container_types',
+                      container_vars['cinder_backends'])
+
+    def test_components_are_resolved_once(self):
+        compiled = di._compile_container_vars({'shared_var': 'shared'})
+        self.assertIs(di._resolve_container_vars(compiled, 'a'),
+                      di._resolve_container_vars(compiled, 'a'))
+
+    def test_container_vars_in_inventory(self):
+        self.user_defined_config['identity_hosts']['aio1'][
+            'container_vars'] = {
+                'keystone_var': {'limit_container_types': 'keystone',
+                                 'enabled': True},
+                'shared_var': 'shared'
+        }
+        self.write_config()
+
+        inventory = get_inventory()
+        hostvars = inventory['_meta']['hostvars']
+        self.assertEqual(hostvars['aio1']['shared_var'], 'shared')
+
+        keystone = inventory['keystone_container']['hosts']
+        self.assertTrue(keystone)
+        for hname, hdata in hostvars.items():
+            if hname in keystone:
+                self.assertEqual(hdata['shared_var'], 'shared')
+                self.assertEqual(hdata['keystone_var'], {'enabled': True})
+            else:
+                self.assertNotIn('keystone_var', hdata)
+
+    def test_container_vars_not_shared(self):
+        self.user_defined_config['identity_hosts']['aio1'][
+            'container_vars'] = {'shared_var': {'enabled': True}}
+        self.write_config()
+
+        try:
+            inventory = di.generate(TARGET_DIR, dict())[0]
+        finally:
+            cleanup()
+        hostvars = inventory['_meta']['hostvars']
+        keystone = inventory['keystone_container']['hosts'][0]
+        hostvars[keystone]['shared_var']['enabled'] = False
+        self.assertTrue(hostvars['aio1']['shared_var']['enabled'])
+
+    def test_container_vars_applied_once_per_container(self):
+        def count_resolves():
+            resolve = 'dynamic_inventory._resolve_container_vars'
+            try:
+                with mock.patch(resolve,
+                                wraps=di._resolve_container_vars) as resolved:
+                    di.generate(TARGET_DIR, dict())
+            finally:
+                cleanup()
+            return resolved.call_count
+
+        resolves = count_resolves()
+        self.user_defined_config['identity_hosts']['aio1']['affinity'] = {
+            'keystone_container': 10
+        }
+        self.write_config()
+
+        # One more resolve for each of the nine added containers
+        self.assertEqual(count_resolves(), resolves + 9)
+
+    def test_container_vars_of_every_metal_component(self):
+        ip = self.user_defined_config['identity_hosts']['aio1']['ip']
+        self.user_defined_config['swift_hosts'] = {
+            'aio1': {
+                'ip': ip,
+                'container_vars': {
+                    'obj_var': {'limit_container_types': 'swift_obj',
+                                'value': 1},
+                    'acc_var': {'limit_container_types': 'swift_acc',
+                                'value': 2},
+                    'cont_var': {'limit_container_types': 'swift_cont',
+                                 'value': 3},
+                }
+            }
+        }
+        self.write_config()
+
+        hostvars = get_inventory()['_meta']['hostvars']
+        for key in ('obj_var', 'acc_var', 'cont_var'):
+            self.assertIn(key, hostvars['aio1'])
+
+
+class TestGroupMembers(unittest.TestCase):
+    def test_append_if(self):
+        members = di.GroupMembers(['aio1', 'aio2'])
+        di.append_if(array=members, item='aio1')
+        di.append_if(array=members, item='aio3')
+        self.assertEqual(members, ['aio1', 'aio2', 'aio3'])
+        self.assertIn('aio3', members)
+
+    def test_remove(self):
+        members = di.GroupMembers(['aio1', 'aio2'])
+        members.remove('aio1')
+        self.assertNotIn('aio1', members)
+        self.assertEqual(members, ['aio2'])
+
+    def test_remove_duplicate(self):
+        members = di.GroupMembers(['aio1', 'aio1'])
+        members.remove('aio1')
+        self.assertIn('aio1', members)
+
+    def test_insert_and_pop(self):
+        members = di.GroupMembers(['aio1'])
+        members.insert(0, 'aio2')
+        self.assertIn('aio2', members)
+        self.assertEqual(members.pop(), 'aio1')
+        self.assertNotIn('aio1', members)
+        self.assertEqual(members.pop(0), 'aio2')
+        self.assertNotIn('aio2', members)
+
+    def test_setitem_and_delitem(self):
+        members = di.GroupMembers(['aio1', 'aio2', 'aio3', 'aio4'])
+        members[0] = 'aio5'
+        self.assertNotIn('aio1', members)
+        self.assertIn('aio5', members)
+        del members[1]
+        self.assertNotIn('aio2', members)
+        self.assertEqual(members, ['aio5', 'aio3', 'aio4'])
+
+    def test_slices(self):
+        members = di.GroupMembers(['aio1', 'aio2', 'aio3', 'aio4'])
+        members[1:3] = ['aio5']
+        self.assertEqual(members, ['aio1', 'aio5', 'aio4'])
+        self.assertNotIn('aio2', members)
+        self.assertIn('aio5', members)
+        members[::2] = ['aio6', 'aio7']
+        self.assertNotIn('aio1', members)
+        self.assertIn('aio7', members)
+        del members[:2]
+        self.assertNotIn('aio6', members)
+        del members[::1]
+        self.assertNotIn('aio7', members)
+        self.assertEqual(members, [])
+
+    def test_augmented_assignment(self):
+        members = di.GroupMembers(['aio1'])
+        members += ['aio2']
+        self.assertIsInstance(members, di.GroupMembers)
+        self.assertIn('aio2', members)
+        members *= 0
+        self.assertNotIn('aio1', members)
+        self.assertEqual(members, [])
+
+    def test_serializes_as_list(self):
+        members = di.GroupMembers(['aio2', 'aio1'])
+        self.assertEqual(json.dumps({'hosts': members}),
+                         '{"hosts": ["aio2", "aio1"]}')
+
+    def test_loaded_inventory_groups(self):
+        get_inventory(clean=False)
+        try:
+            inventory = di.get_inventory(
+                TARGET_DIR, path.join(TARGET_DIR, 'openstack_inventory.json')
+            )
+        finally:
+            cleanup()
+        for key, value in inventory.items():
+            if key == '_meta':
+                continue
+            for member_type in ('hosts', 'children'):
+                if member_type in value:
+                    self.assertIsInstance(value[member_type],
+                                          di.GroupMembers)
+
+
+class TestGroupHosts(unittest.TestCase):
+    def setUp(self):
+        self.inventory = {
+            'all_containers': {'children': ['a_containers', 'b_containers'],
+                               'hosts': []},
+            'a_containers': {'children': ['b_containers'],
+                             'hosts': ['a1', 'b1']},
+            'b_containers': {'hosts': ['b1', 'b2']},
+            'loop': {'children': ['loop'], 'hosts': ['l1']},
+        }
+
+    def test_children_first_without_duplicates(self):
+        hosts = di._get_group_hosts(self.inventory, 'all_containers', {})
+        self.assertEqual(hosts, ['b1', 'b2', 'a1'])
+
+    def test_groups_are_resolved_once(self):
+        group_hosts = {}
+        di._get_group_hosts(self.inventory, 'all_containers', group_hosts)
+        self.assertEqual(sorted(group_hosts), ['a_containers',
+                                               'all_containers',
+                                               'b_containers'])
+
+        self.inventory['b_containers']['hosts'].append('b3')
+        hosts = di._get_group_hosts(self.inventory, 'b_containers',
+                                    group_hosts)
+        self.assertNotIn('b3', hosts)
+
+    def test_cyclic_children(self):
+        self.assertEqual(di._get_group_hosts(self.inventory, 'loop', {}),
+                         ['l1'])
+
+    def test_bound_hosts(self):
+        p_net = {'group_binds': ['b_containers', 'a_containers', 'missing']}
+        hosts = di._get_bound_hosts(self.inventory, p_net, {})
+        self.assertEqual(hosts, ['b1', 'b2', 'a1'])
+
+
 class TestNetAddressSearch(unittest.TestCase):
     def test_net_address_search_key_not_found(self):
         pns = [
@@ -643,32 +1443,945 @@ class TestNetAddressSearch(unittest.TestCase):
         self.assertEqual(pns, new_pns)
 
 
-class TestMultipleRuns(unittest.TestCase):
-    def test_creating_backup_file(self):
-        inventory_file_path = os.path.join(TARGET_DIR,
-                                           'openstack_inventory.json')
-        get_backup_name_path = 'dynamic_inventory.get_backup_name'
-        backup_name = 'openstack_inventory.json-20160531_171804.json'
+class TestJSONOutput(unittest.TestCase):
+    def setUp(self):
+        self.data = {'b': [1, 2], 'a': {'url': 'http://host/'}}
+
+    def test_pretty_output_matches_json(self):
+        self.assertEqual(di.dump_json(self.data),
+                         json.dumps(self.data, indent=4, sort_keys=True))
+
+    def test_compact_output(self):
+        output = di.dump_json(self.data, compact=True)
+        self.assertNotIn(' ', output)
+        self.assertEqual(json.loads(output), self.data)
+
+    def test_fastest_backend_used(self):
+        backend = mock.MagicMock(__name__='simplejson')
+        with mock.patch.dict(sys.modules, {'simplejson': backend}):
+            with mock.patch.dict(di._JSON_BACKEND_MODULES, clear=True):
+                di.dump_json(self.data)
+
+        backend.dumps.assert_called_with(self.data, indent=4, sort_keys=True,
+                                         separators=(', ', ': '))
+
+    def test_compact_inventory(self):
+        inventory = get_inventory(clean=False)
+        output = di.main({'config': TARGET_DIR, 'compact': True})
+        self.assertNotIn('\n', output)
+        self.assertEqual(json.loads(output), inventory)
+
+        # Each output format is cached on its own
+        load_config_path = 'dynamic_inventory.load_user_configuration'
+        with mock.patch(load_config_path) as load_config:
+            self.assertEqual(
+                di.main({'config': TARGET_DIR, 'compact': True}), output
+            )
+            self.assertEqual(get_inventory(clean=False), inventory)
+        self.assertFalse(load_config.called)
+
+    def tearDown(self):
+        cleanup()
+
+
+class TestHoistGroupVars(unittest.TestCase):
+    def setUp(self):
+        self.inventory = {
+            '_meta': {'hostvars': {
+                'a': {'x': 1, 'y': 1, 'z': {'k': 1}},
+                'b': {'x': 1, 'y': 2, 'z': {'k': 1}},
+                'c': {'x': 1, 'y': 3, 'z': {'k': 2}}
+            }},
+            'all': {'vars': {'x': 0}},
+            'ab': {'hosts': ['a', 'b']},
+            'abc': {'hosts': ['c'], 'children': ['ab']},
+            'c_only': {'hosts': ['c']}
+        }
+
+    def test_shared_vars_hoisted(self):
+        di._hoist_group_vars(self.inventory)
+
+        self.assertEqual(self.inventory['abc']['vars'], {'x': 1})
+        self.assertEqual(self.inventory['ab']['vars'], {'z': {'k': 1}})
+        self.assertEqual(self.inventory['_meta']['hostvars'], {
+            'a': {'y': 1}, 'b': {'y': 2}, 'c': {'y': 3, 'z': {'k': 2}}
+        })
+        self.assertEqual(self.inventory['all']['vars'], {'x': 0})
+        self.assertNotIn('vars', self.inventory['c_only'])
+
+    def test_excluded_keys_kept(self):
+        di._hoist_group_vars(self.inventory, excluded_keys=set(['x']))
+
+        self.assertNotIn('vars', self.inventory['abc'])
+        self.assertEqual(self.inventory['_meta']['hostvars']['a']['x'], 1)
+
+    def test_existing_group_vars_kept(self):
+        self.inventory['c_only']['vars'] = {'z': None}
+        di._hoist_group_vars(self.inventory)
+
+        self.assertNotIn('vars', self.inventory['ab'])
+        self.assertEqual(self.inventory['_meta']['hostvars']['a']['z'],
+                         {'k': 1})
+
+    def test_effective_vars_unchanged(self):
+        inventory = get_inventory(clean=False)
+        file_keys = di._group_vars_file_keys(
+            TARGET_DIR, di.ParsedConfigCache(TARGET_DIR)
+        )
+        output = di.main({'config': TARGET_DIR, 'hoist_group_vars': True})
+        hoisted = json.loads(output)
+
+        self.assertLess(len(output), len(json.dumps(inventory, indent=4)))
+        group_hosts = dict()
+        for host, host_vars in inventory['_meta']['hostvars'].items():
+            effective_vars = dict()
+            for group, group_data in hoisted.items():
+                if group in ('_meta', 'all'):
+                    continue
+                hosts = di._get_group_hosts(hoisted, group, group_hosts)
+                if host in hosts:
+                    for key, value in group_data.get('vars', {}).items():
+                        self.assertEqual(effective_vars.setdefault(key, value),
+                                         value)
+            self.assertFalse(set(effective_vars) & file_keys)
+            effective_vars.update(hoisted['_meta']['hostvars'][host])
+            self.assertEqual(effective_vars, host_vars)
+
+        # The inventory file keeps the complete hostvars
+        with open(path.join(TARGET_DIR, 'openstack_inventory.json')) as f:
+            saved_inventory = json.loads(f.read())
+        del saved_inventory['_meta']['fingerprints']
+        self.assertEqual(saved_inventory, inventory)
+
+    def tearDown(self):
+        cleanup()
 
-        tar_file = mock.MagicMock()
-        tar_file.__enter__.return_value = tar_file
 
-        # run make backup with faked tarfiles and date
-        with mock.patch('dynamic_inventory.tarfile.open') as tar_open:
-            tar_open.return_value = tar_file
-            with mock.patch(get_backup_name_path) as backup_mock:
-                backup_mock.return_value = backup_name
-                di.make_backup(TARGET_DIR, inventory_file_path)
+class TestLimitGroups(unittest.TestCase):
+    def setUp(self):
+        self.inventory = {
+            '_meta': {'hostvars': {'a': {}, 'b': {}, 'c': {}, 'd': {}}},
+            'all': {'vars': {'x': 1}},
+            'infra': {'children': ['swift_all', 'nova_all'], 'hosts': ['d']},
+            'swift_all': {'children': ['swift_proxy'], 'hosts': []},
+            'swift_proxy': {'hosts': ['a']},
+            'nova_all': {'hosts': ['b']},
+            'memcached': {'hosts': ['c']}
+        }
+        self.references = {'swift_all': set(['memcached', 'missing'])}
+
+    def test_groups_limited(self):
+        di._limit_groups(self.inventory, ['swift_all'], self.references)
+
+        self.assertEqual(
+            sorted(self.inventory),
+            ['_meta', 'all', 'infra', 'memcached', 'swift_all', 'swift_proxy']
+        )
+        self.assertEqual(self.inventory['infra'],
+                         {'children': ['swift_all'], 'hosts': []})
+        self.assertEqual(self.inventory['all'], {'vars': {'x': 1}})
+        self.assertEqual(sorted(self.inventory['_meta']['hostvars']),
+                         ['a', 'c'])
+
+    def test_patterns(self):
+        patterns = di._parse_group_patterns('swift_*:nova_all, memcached')
+        self.assertEqual(patterns, ['swift_*', 'nova_all', 'memcached'])
+
+        di._limit_groups(self.inventory, patterns, dict())
+        self.assertEqual(sorted(self.inventory['_meta']['hostvars']),
+                         ['a', 'b', 'c'])
+
+    def test_no_matching_groups(self):
+        with self.assertRaises(SystemExit):
+            di._limit_groups(self.inventory, ['glance_*'], self.references)
+
+    def test_group_vars_references(self):
+        references = di._group_vars_references(TARGET_DIR)
+        self.assertIn('memcached', references['all'])
+        self.assertIn('rabbitmq_all', references['all'])
+
+    def test_options_cached_separately(self):
+        first = di._cache_file(TARGET_DIR, di._output_options(
+            {'compact': True, 'limit_groups': 'swift_all'}
+        ))
+        second = di._cache_file(TARGET_DIR, di._output_options(
+            {'compact': True, 'limit_groups': 'nova_all'}
+        ))
+        self.assertNotEqual(first, second)
+        self.assertEqual(
+            di._parse_output_options(('compact', 'limit_groups=nova_all')),
+            {'compact': True, 'hoist_group_vars': False,
+             'limit_groups': 'nova_all', 'shard': None}
+        )
+
+    def test_limited_inventory(self):
+        inventory = get_inventory(clean=False)
+        limited = json.loads(
+            di.main({'config': TARGET_DIR, 'limit_groups': 'galera_all'})
+        )
+
+        self.assertIn('memcached', limited)
+        self.assertNotIn('nova_all', limited)
+        galera_hosts = di._get_group_hosts(inventory, 'galera_all', dict())
+        for host in galera_hosts:
+            self.assertEqual(limited['_meta']['hostvars'][host],
+                             inventory['_meta']['hostvars'][host])
+        self.assertLess(len(limited['_meta']['hostvars']),
+                        len(inventory['_meta']['hostvars']))
 
-        backup_path = path.join(TARGET_DIR, 'backup_openstack_inventory.tar')
+    def tearDown(self):
+        cleanup()
 
-        tar_open.assert_called_with(backup_path, 'a')
 
-        # This chain is present because of how tarfile.open is called to
-        # make a context manager inside the make_backup function.
+class TestHostIndex(unittest.TestCase):
+    def setUp(self):
+        self.config_path = tempfile.mkdtemp()
+        self.inventory_file_path = path.join(self.config_path,
+                                             'openstack_inventory.json')
+        with open(self.inventory_file_path, 'w') as f:
+            f.write('{}')
+        self.hostvars = dict(
+            ('host%d' % i, {'container_address': '10.0.%d.%d' % (i // 250,
+                                                                 i % 250)})
+            for i in range(1000)
+        )
+
+    def save(self):
+        return di.save_host_index(
+            self.config_path,
+            di.get_inventory_stat_signature(self.config_path),
+            di.get_inventory_fingerprint(self.config_path),
+            self.hostvars
+        )
+
+    def load(self, host, verify=False):
+        return di.load_host_vars(self.config_path, host, verify)
+
+    def rewrite_inventory(self, content):
+        os.remove(self.inventory_file_path)
+        with open(self.inventory_file_path, 'w') as f:
+            f.write(content)
+
+    def test_lookup(self):
+        self.assertTrue(self.save())
+        for host, host_vars in self.hostvars.items():
+            self.assertEqual(json.loads(self.load(host)), host_vars)
+        self.assertEqual(self.load('missing'), '{}')
+
+    def test_lookup_reads_no_input(self):
+        self.save()
+        with mock.patch('dynamic_inventory.get_file_checksum') as checksum:
+            self.assertIsNotNone(self.load('host1', verify=True))
+        self.assertFalse(checksum.called)
+
+    def test_unchanged_inventory_not_written(self):
+        self.save()
+        self.assertFalse(self.save())
+
+    def test_changed_inventory_invalidates(self):
+        self.save()
+        self.rewrite_inventory('{ }')
+
+        self.assertIsNone(self.load('host1'))
+        self.assertIsNone(self.load('host1', verify=True))
+
+    def test_same_content_is_verified(self):
+        self.save()
+        self.rewrite_inventory('{}')
+
+        self.assertIsNone(self.load('host1'))
+        self.assertIsNotNone(self.load('host1', verify=True))
+        # The new stat signature is kept, so the inputs are not hashed again
+        with mock.patch('dynamic_inventory.get_file_checksum') as checksum:
+            self.assertIsNotNone(self.load('host1'))
+        self.assertFalse(checksum.called)
+
+    def test_missing_index(self):
+        self.assertIsNone(self.load('host1'))
+
+    def tearDown(self):
+        shutil.rmtree(self.config_path)
+
+
+class TestInventoryShards(TestConfigChecks):
+    def setUp(self):
+        super(TestInventoryShards, self).setUp()
+        self.inventory = {
+            '_meta': {
+                'hostvars': {
+                    'infra1': {'physical_host': 'infra1', 'region': 'r1',
+                               'ansible_ssh_host': '10.0.0.1'},
+                    'infra1_c1': {'physical_host': 'infra1',
+                                  'container_address': '10.0.0.11'},
+                    'infra2': {'physical_host': 'infra2', 'region': 'r2',
+                               'ansible_ssh_host': '10.0.0.2'},
+                    'deploy1': {'physical_host': 'deploy1'}
+                }
+            },
+            'all': {'vars': {'external_lb_vip_address': '10.0.0.100'}},
+            'hosts': {'hosts': ['infra1', 'infra2', 'deploy1']},
+            'c1': {'hosts': ['infra1_c1'], 'children': []}
+        }
 
-        tar_file.add.assert_called_with(inventory_file_path,
-                                        arcname=backup_name)
+    def test_host_shards(self):
+        self.assertEqual(
+            di._host_shards(self.inventory, 'region'),
+            {'infra1': 'r1', 'infra1_c1': 'r1', 'infra2': 'r2',
+             'deploy1': None}
+        )
+
+    def test_container_in_shard_of_physical_host(self):
+        hostvars = self.inventory['_meta']['hostvars']
+        for host in ('infra1', 'infra2'):
+            hostvars[host]['physical_host_group'] = 'infra_hosts'
+        hostvars['infra1_c1']['physical_host_group'] = 'c1_hosts'
+        hostvars['infra1_c1']['region'] = 'r2'
+
+        self.assertEqual(
+            di._host_shards(self.inventory, 'physical_host_group')[
+                'infra1_c1'],
+            'infra_hosts'
+        )
+        self.assertEqual(
+            di._host_shards(self.inventory, 'region')['infra1_c1'], 'r1'
+        )
+
+    def test_host_under_several_groups_refused(self):
+        self.inventory['infra_hosts'] = {'hosts': ['infra1', 'infra2']}
+        self.inventory['other_hosts'] = {'hosts': ['infra2']}
+        with self.assertRaises(SystemExit) as context:
+            di._host_shards(self.inventory, 'physical_host_group')
+        self.assertIn('infra2', context.exception.message)
+
+    def test_invalid_shard_name(self):
+        self.inventory['_meta']['hostvars']['infra2']['region'] = '../r2'
+        with self.assertRaises(SystemExit):
+            di._host_shards(self.inventory, 'region')
+
+    def test_shard_inventories(self):
+        shards, manifest = di._shard_inventories(self.inventory, 'region')
+
+        self.assertEqual(sorted(shards), ['r1', 'r2'])
+        r2 = shards['r2']
+        self.assertEqual(sorted(r2['_meta']['hostvars']),
+                         ['deploy1', 'infra2'])
+        self.assertEqual(r2['hosts']['hosts'], ['infra2', 'deploy1'])
+        self.assertEqual(r2['c1'], {'hosts': [], 'children': []})
+        self.assertEqual(r2['all']['vars']['external_lb_vip_address'],
+                         '10.0.0.100')
+        self.assertEqual(r2['all']['vars']['inventory_shard'], 'r2')
+
+        self.assertEqual(manifest['shards'],
+                         {'r1': 'openstack_inventory.r1.json',
+                          'r2': 'openstack_inventory.r2.json'})
+        self.assertEqual(manifest['groups'],
+                         {'hosts': ['infra1', 'infra2', 'deploy1']})
+        self.assertEqual(
+            manifest['hosts'],
+            {'infra1': {'ansible_ssh_host': '10.0.0.1',
+                        'inventory_shard': 'r1'},
+             'infra2': {'ansible_ssh_host': '10.0.0.2',
+                        'inventory_shard': 'r2'}}
+        )
+        self.assertEqual(
+            r2['all']['vars']['inventory_shard_manifest'],
+            {'groups': manifest['groups'], 'hosts': manifest['hosts']}
+        )
+
+    def test_inventory_unchanged(self):
+        expected = copy.deepcopy(self.inventory)
+        di._shard_inventories(self.inventory, 'region')
+        self.assertEqual(self.inventory, expected)
+
+    def test_removed_shard_files(self):
+        config_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_path)
+        di.save_inventory_shards(config_path, self.inventory, 'region')
+        self.assertTrue(
+            path.exists(path.join(config_path, 'openstack_inventory.r2.json'))
+        )
+
+        self.inventory['_meta']['hostvars']['infra2']['region'] = 'r1'
+        di.save_inventory_shards(config_path, self.inventory, 'region')
+        self.assertEqual(
+            sorted(os.listdir(config_path)),
+            ['openstack_inventory.r1.json', 'openstack_inventory_shards.json']
+        )
+
+    def set_region(self):
+        self.user_defined_config['identity_hosts']['aio1']['host_vars'] = {
+            'region': 'r1'
+        }
+        self.user_defined_config['inventory_shard_key'] = 'region'
+        self.write_config()
+
+    def test_generated_shards(self):
+        self.set_region()
+        try:
+            inventory = get_inventory(clean=False)
+            shard = json.loads(
+                di.main({'config': TARGET_DIR, 'shard': 'r1'})
+            )
+            with open(path.join(TARGET_DIR,
+                                'openstack_inventory_shards.json')) as f:
+                manifest = json.load(f)
+        finally:
+            cleanup()
+
+        self.assertEqual(manifest['shards'],
+                         {'r1': 'openstack_inventory.r1.json'})
+        # Every container is in the shard of its physical host
+        self.assertEqual(sorted(shard['_meta']['hostvars']),
+                         sorted(inventory['_meta']['hostvars']))
+
+    def test_physical_host_group_of_aio_refused(self):
+        self.user_defined_config['inventory_shard_key'] = 'physical_host_group'
+        self.write_config()
+        with self.assertRaises(SystemExit):
+            get_inventory()
+
+    def test_shard_files_removed_without_key(self):
+        self.set_region()
+        try:
+            get_inventory(clean=False)
+            os.remove(USER_CONFIG_FILE)
+            os.rename(USER_CONFIG_FILE + ".tmp", USER_CONFIG_FILE)
+            self.config_changed = False
+            get_inventory(clean=False)
+
+            for file_name in ('openstack_inventory.r1.json',
+                              'openstack_inventory_shards.json'):
+                self.assertFalse(path.exists(path.join(TARGET_DIR,
+                                                       file_name)))
+        finally:
+            cleanup()
+
+    def test_unknown_shard(self):
+        self.set_region()
+        with self.assertRaises(SystemExit):
+            di.main({'config': TARGET_DIR, 'shard': 'missing'})
+        cleanup()
+
+    def test_shard_without_key(self):
+        with self.assertRaises(SystemExit):
+            di.main({'config': TARGET_DIR, 'shard': 'r1'})
+        cleanup()
+
+
+class TestInventoryDB(TestConfigChecks):
+    def setUp(self):
+        super(TestInventoryDB, self).setUp()
+        self.config_path = tempfile.mkdtemp()
+        self.inventory_file_path = path.join(self.config_path,
+                                             'openstack_inventory.json')
+        self.inventory = {
+            '_meta': {
+                'hostvars': {
+                    'aio1': {'physical_host': 'aio1'},
+                    'aio1_c1': {
+                        'physical_host': 'aio1',
+                        'container_networks': {
+                            'container_address': {
+                                'address': '172.29.236.10',
+                                'ipv6_address': 'fd00::10'
+                            }
+                        }
+                    }
+                },
+                'fingerprints': {'aio1': 'abc'}
+            },
+            'all': {'vars': {'container_cidr': '172.29.236.0/22'}},
+            'hosts': {'hosts': ['aio1'], 'children': []},
+            'c1_containers': {'hosts': ['aio1_c1', 'aio1']},
+        }
+        self.save()
+
+    def save(self):
+        with open(self.inventory_file_path, 'w') as f:
+            f.write(di.dump_json(self.inventory))
+        return di.save_inventory_db(self.config_path,
+                                    self.inventory_file_path, self.inventory)
+
+    def open_db(self):
+        conn = di.open_inventory_db(self.config_path,
+                                    self.inventory_file_path)
+        self.addCleanup(conn.close)
+        return conn
+
+    def test_round_trip(self):
+        self.assertEqual(di.load_inventory_db(self.open_db()),
+                         self.inventory)
+
+    def test_selected_hostvars(self):
+        inventory = di.load_inventory_db(self.open_db(), [])
+        self.assertEqual(inventory['_meta']['hostvars'],
+                         {'aio1': {}, 'aio1_c1': {}})
+
+    def test_indexed_lookups(self):
+        conn = self.open_db()
+        self.assertEqual(
+            conn.execute('SELECT host FROM allocations WHERE address = ?',
+                         ('fd00::10',)).fetchall(),
+            [('aio1_c1',)]
+        )
+        self.assertEqual(
+            sorted(conn.execute('SELECT name FROM hosts'
+                                ' WHERE physical_host = ?', ('aio1',))),
+            [('aio1',), ('aio1_c1',)]
+        )
+
+    def hostvar_rowids(self):
+        conn = self.open_db()
+        return dict(
+            ((host, key), rowid) for rowid, host, key in
+            conn.execute('SELECT rowid, host, key FROM hostvars')
+        )
+
+    def test_only_changed_rows_written(self):
+        before = self.hostvar_rowids()
+        self.inventory['_meta']['hostvars']['aio1']['physical_host'] = 'x'
+        # A new file gets a new signature even with the same mtime
+        os.remove(self.inventory_file_path)
+        self.assertTrue(self.save())
+        after = self.hostvar_rowids()
+
+        self.assertEqual(di.load_inventory_db(self.open_db()),
+                         self.inventory)
+        self.assertNotEqual(before.pop(('aio1', 'physical_host')),
+                            after.pop(('aio1', 'physical_host')))
+        self.assertEqual(before, after)
+
+    def test_unchanged_inventory_not_written(self):
+        self.assertFalse(di.save_inventory_db(
+            self.config_path, self.inventory_file_path, self.inventory
+        ))
+
+    def save_replacing(self):
+        previous = (di._inventory_signature(self.inventory_file_path),
+                    di.dump_json(self.inventory))
+        conn = di._connect_inventory_db(
+            path.join(self.config_path, 'openstack_inventory.db')
+        )
+        with conn:
+            conn.execute('INSERT INTO hostvars VALUES (?, ?, ?)',
+                         ('aio1', 'stray', '1'))
+        conn.close()
+        self.inventory['_meta']['hostvars']['aio1']['physical_host'] = 'x'
+        os.remove(self.inventory_file_path)
+        with open(self.inventory_file_path, 'w') as f:
+            f.write(di.dump_json(self.inventory))
+        return di.save_inventory_db(self.config_path,
+                                    self.inventory_file_path, self.inventory,
+                                    previous)
+
+    def stray_rows(self):
+        return self.open_db().execute(
+            "SELECT * FROM hostvars WHERE key = 'stray'"
+        ).fetchall()
+
+    def test_diffed_against_previous_inventory(self):
+        self.assertTrue(self.save_replacing())
+        # The rows are not read back, so a row added behind its back stays
+        self.assertEqual(len(self.stray_rows()), 1)
+        self.assertEqual(
+            self.open_db().execute(
+                "SELECT value FROM hostvars"
+                " WHERE host = 'aio1' AND key = 'physical_host'"
+            ).fetchall(),
+            [('"x"',)]
+        )
+
+    def test_previous_inventory_not_matching_database(self):
+        os.remove(self.inventory_file_path)
+        with open(self.inventory_file_path, 'w') as f:
+            f.write(di.dump_json(self.inventory))
+        self.assertTrue(self.save_replacing())
+        self.assertEqual(self.stray_rows(), [])
+        self.inventory['_meta']['hostvars']['aio1'].pop('stray', None)
+        self.assertEqual(di.load_inventory_db(self.open_db()),
+                         self.inventory)
+
+    def test_changed_inventory_invalidates(self):
+        os.remove(self.inventory_file_path)
+        with open(self.inventory_file_path, 'w') as f:
+            f.write('{ }')
+        self.assertIsNone(di.open_inventory_db(self.config_path,
+                                               self.inventory_file_path))
+
+    def test_remove_and_export(self):
+        conn = self.open_db()
+        di.remove_inventory_db_items(conn, ['aio1'])
+        inventory = di.export_inventory_db(conn, self.inventory_file_path)
+
+        self.assertNotIn('aio1', inventory['_meta']['hostvars'])
+        self.assertNotIn('aio1', inventory['_meta']['fingerprints'])
+        self.assertEqual(inventory['c1_containers']['hosts'], ['aio1_c1'])
+        with open(self.inventory_file_path) as f:
+            self.assertEqual(json.load(f), inventory)
+        self.assertIsNotNone(di.open_inventory_db(self.config_path,
+                                                  self.inventory_file_path))
+
+    def test_generated_with_sqlite_backend(self):
+        self.user_defined_config['inventory_backend'] = 'sqlite'
+        self.write_config()
+        try:
+            inventory = get_inventory(clean=False)
+            conn = di.open_inventory_db(
+                TARGET_DIR, path.join(TARGET_DIR, 'openstack_inventory.json')
+            )
+            saved_inventory = di.load_inventory_db(conn)
+            conn.close()
+            del saved_inventory['_meta']['fingerprints']
+            self.assertEqual(saved_inventory, inventory)
+        finally:
+            cleanup()
+
+    def test_no_database_with_json_backend(self):
+        get_inventory(clean=False)
+        try:
+            self.assertFalse(
+                path.exists(path.join(TARGET_DIR, 'openstack_inventory.db'))
+            )
+        finally:
+            cleanup()
+
+    def test_invalid_backend(self):
+        self.user_defined_config['inventory_backend'] = 'mysql'
+        self.write_config()
+        with self.assertRaises(SystemExit) as context:
+            get_inventory()
+        expectedLog = "inventory_backend must be one of: json, sqlite"
+        self.assertEqual(context.exception.message, expectedLog)
+
+    def tearDown(self):
+        super(TestInventoryDB, self).tearDown()
+        shutil.rmtree(self.config_path)
+
+
+class TestHostArg(TestConfigChecks):
+    def setUp(self):
+        super(TestHostArg, self).setUp()
+        self.inventory = get_inventory(clean=False)
+
+    def test_host_from_index(self):
+        with mock.patch('dynamic_inventory.generate') as generate:
+            with mock.patch('dynamic_inventory.get_inventory_fingerprint',
+                            wraps=di.get_inventory_fingerprint) as hashed:
+                host_vars = di.main({'config': TARGET_DIR, 'host': 'aio1'})
+
+        self.assertFalse(generate.called)
+        self.assertFalse(hashed.called)
+        self.assertEqual(json.loads(host_vars),
+                         self.inventory['_meta']['hostvars']['aio1'])
+
+    def test_changed_inventory(self):
+        inventory_file_path = path.join(TARGET_DIR, 'openstack_inventory.json')
+        self.inventory['_meta']['hostvars']['aio1']['host_test'] = True
+        with open(inventory_file_path, 'wb') as f:
+            f.write(json.dumps(self.inventory))
+
+        host_vars = json.loads(
+            di.main({'config': TARGET_DIR, 'host': 'aio1'})
+        )
+        self.assertTrue(host_vars['host_test'])
+
+    def test_changed_config(self):
+        self.user_defined_config['identity_hosts']['aio1']['host_vars'] = {
+            'host_test': True
+        }
+        self.write_config()
+
+        host_vars = json.loads(
+            di.main({'config': TARGET_DIR, 'host': 'aio1'})
+        )
+        self.assertTrue(host_vars['host_test'])
+
+    def tearDown(self):
+        super(TestHostArg, self).tearDown()
+        cleanup()
+
+
+class TestInventoryBackupStore(TestConfigChecks):
+    def setUp(self):
+        super(TestInventoryBackupStore, self).setUp()
+        self.config_path = tempfile.mkdtemp()
+        self.store = di.InventoryBackupStore(self.config_path, max_count=3,
+                                             max_age=1)
+        self.backup_dir = path.join(self.config_path,
+                                    'backup_openstack_inventory')
+
+    def object_files(self):
+        return sorted(f for f in os.listdir(self.backup_dir)
+                      if f.endswith('.gz'))
+
+    def add_inventories(self, count):
+        inventories = list()
+        for i in range(count):
+            inventory = {'_meta': {'hostvars': {}},
+                         'hosts': {'hosts': ['host%d' % h for h in range(i)]}}
+            inventory['_meta']['hostvars']['host%d' % i] = {'index': i}
+            self.store.add(di.dump_json(inventory), 1000.0 + i)
+            inventories.append(inventory)
+        return inventories
+
+    def test_same_as_last_snapshot_skipped(self):
+        self.assertTrue(self.store.add('{"a": 1}', 1000.0))
+        self.assertFalse(self.store.add('{"a": 1}', 1001.0))
+        self.assertEqual(len(self.store.snapshots()), 1)
+
+    def test_content_stored_once(self):
+        self.store.add('{"a": 1}', 1000.0)
+        self.store.add('{"a": 2}', 1001.0)
+        self.store.add('{"a": 1}', 1002.0)
+
+        snapshots = self.store.snapshots()
+        self.assertEqual([t for t, _ in snapshots], [1000.0, 1001.0, 1002.0])
+        self.assertEqual(snapshots[0][1], snapshots[2][1])
+        self.assertEqual(len(self.object_files()), 2)
+        self.assertEqual(self.store.read(snapshots[1][1]), '{"a": 2}')
+
+    def test_snapshots_compressed(self):
+        self.store.add('{"a": 1}', 1000.0)
+        with open(path.join(self.backup_dir, self.object_files()[0]),
+                  'rb') as f:
+            self.assertEqual(f.read(2), '\x1f\x8b')
+
+    def test_count_retention(self):
+        for i in range(5):
+            self.store.add('{"a": %d}' % i, 1000.0 + i)
+
+        snapshots = self.store.snapshots()
+        self.assertEqual([t for t, _ in snapshots], [1002.0, 1003.0, 1004.0])
+        self.assertEqual(len(self.object_files()), 3)
+        self.assertEqual(self.store.read(snapshots[0][1]), '{"a": 2}')
+
+    def test_pruned_in_batches(self):
+        for i in range(4):
+            self.store.add('{"a": %d}' % i, 1000.0 + i)
+        self.assertEqual(len(self.store.snapshots()), 4)
+
+        with mock.patch.object(self.store, 'prune') as prune:
+            self.store.add('{"a": 4}', 1004.0)
+        prune.assert_called_once_with(1004.0)
+
+    def test_age_retention_keeps_last(self):
+        self.store.add('{"a": 1}', 1000.0)
+        self.store.add('{"a": 2}', 2000.0)
+        self.store.prune(1000.0 + 86400 * 2)
+
+        snapshots = self.store.snapshots()
+        self.assertEqual([t for t, _ in snapshots], [2000.0])
+        self.assertEqual(len(self.object_files()), 1)
+
+    def test_age_retention_on_add(self):
+        self.store.add('{"a": 1}', 1000.0)
+        self.store.add('{"a": 2}', 1000.0 + 86400 * 1.1)
+        self.assertEqual(len(self.store.snapshots()), 2)
+        self.store.add('{"a": 3}', 1000.0 + 86400 * 2.2)
+        self.assertEqual(len(self.store.snapshots()), 1)
+
+    def test_deltas_between_checkpoints(self):
+        self.store.max_count = 100
+        self.store.checkpoint = 4
+        inventories = self.add_inventories(9)
+
+        snapshots = self.store.snapshots()
+        self.assertEqual(
+            [self.store.is_checkpoint(c) for _, c in snapshots],
+            [True, False, False, False, True, False, False, False, True]
+        )
+        for (_, checksum), inventory in zip(snapshots, inventories):
+            content = self.store.read(checksum)
+            self.assertEqual(content, di.dump_json(inventory))
+            self.assertEqual(hashlib.sha1(content).hexdigest(), checksum)
+            self.assertEqual(self.store.load(checksum), inventory)
+
+    def test_content_not_rebuilt_stored_in_full(self):
+        self.store.add(di.dump_json({'a': 1}), 1000.0)
+        self.store.add(json.dumps({'a': 2}, indent=2), 1001.0)
+        self.assertTrue(all(self.store.is_checkpoint(c)
+                            for _, c in self.store.snapshots()))
+
+    def test_pruning_keeps_patched_snapshots(self):
+        self.store.checkpoint = 4
+        inventories = self.add_inventories(6)
+
+        snapshots = self.store.snapshots()
+        self.assertEqual(len(snapshots), 4)
+        for (_, checksum), inventory in zip(snapshots, inventories[2:]):
+            self.assertEqual(self.store.load(checksum), inventory)
+        # The first kept snapshots are patched from the two before them
+        self.assertEqual(len(self.object_files()), 6)
+
+        self.store.max_count = 1
+        with mock.patch.object(self.store, '_read_object') as read_object:
+            self.store.prune(1005.0)
+        self.assertFalse(read_object.called)
+        snapshots = self.store.snapshots()
+        self.assertEqual(len(snapshots), 1)
+        self.assertEqual(self.store.load(snapshots[0][1]), inventories[5])
+        # The last snapshot is patched from the checkpoint before it
+        self.assertEqual(len(self.object_files()), 2)
+
+    def test_restore(self):
+        inventories = self.add_inventories(3)
+        inventory_file_path = path.join(self.config_path,
+                                        'openstack_inventory.json')
+        with open(inventory_file_path, 'wb') as f:
+            f.write('{"edited": true}')
+
+        self.store.restore(self.store.snapshots()[1][1], inventory_file_path)
+
+        with open(inventory_file_path, 'rb') as f:
+            self.assertEqual(f.read(), di.dump_json(inventories[1]))
+        snapshots = self.store.snapshots()
+        self.assertEqual(self.store.read(snapshots[-2][1]), '{"edited": true}')
+        self.assertEqual(self.store.load(snapshots[-1][1]), inventories[1])
+
+    def test_incomplete_record_dropped(self):
+        self.store.add('{"a": 1}', 1000.0)
+        with open(path.join(self.backup_dir, 'index'), 'ab') as f:
+            f.write('\0' * 5)
+
+        self.assertEqual(len(self.store.snapshots()), 1)
+        self.store.add('{"a": 2}', 1001.0)
+        self.assertEqual([t for t, _ in self.store.snapshots()],
+                         [1000.0, 1001.0])
+
+    def test_invalid_backup_count(self):
+        self.user_defined_config['inventory_backup_count'] = 0
+        self.write_config()
+        with self.assertRaises(SystemExit) as context:
+            get_inventory()
+        expectedLog = "inventory_backup_count must be an integer of at least 1"
+        self.assertEqual(context.exception.message, expectedLog)
+
+    def tearDown(self):
+        super(TestInventoryBackupStore, self).tearDown()
+        shutil.rmtree(self.config_path)
+
+
+class TestJSONPatch(unittest.TestCase):
+    def check(self, old, new):
+        patch = di.json_diff(copy.deepcopy(old), new)
+        patched = di.json_patch(copy.deepcopy(old), patch)
+        self.assertEqual(json.dumps(patched, sort_keys=True),
+                         json.dumps(new, sort_keys=True))
+        return patch
+
+    def test_changed_keys(self):
+        patch = self.check({'a': 1, 'b': {'c': 2}, 'd/e~': 3},
+                           {'a': 1, 'b': {'c': 4, 'f': 5}})
+        self.assertEqual(patch, [
+            {'op': 'remove', 'path': '/d~1e~0'},
+            {'op': 'replace', 'path': '/b/c', 'value': 4},
+            {'op': 'add', 'path': '/b/f', 'value': 5},
+        ])
+
+    def test_appended_items(self):
+        patch = self.check({'hosts': ['a']}, {'hosts': ['a', 'b', 'c']})
+        self.assertEqual(patch, [
+            {'op': 'add', 'path': '/hosts/-', 'value': 'b'},
+            {'op': 'add', 'path': '/hosts/-', 'value': 'c'},
+        ])
+
+    def test_changed_list_replaced(self):
+        patch = self.check({'hosts': ['a', 'b']}, {'hosts': ['b']})
+        self.assertEqual(patch, [
+            {'op': 'replace', 'path': '/hosts', 'value': ['b']}
+        ])
+
+    def test_changed_type(self):
+        self.check({'a': 1}, {'a': True})
+        self.check({'a': 1}, [1])
+
+    def test_changed_type_in_list(self):
+        self.check({'a': [1]}, {'a': [True]})
+        self.check({'a': [1]}, {'a': [True, 2]})
+        self.check({'a': [1.0]}, {'a': [1, 2]})
+        self.check({'a': [{'b': 1}]}, {'a': [{'b': True}, 2]})
+
+    def test_unchanged(self):
+        self.assertEqual(self.check({'a': [1, {'b': 2}]},
+                                    {'a': [1, {'b': 2}]}), [])
+        self.assertEqual(self.check({'a': ['b', 1]}, {'a': [u'b', 1L]}), [])
+
+
+@unittest.skipIf(inventory_history is None,
+                 'inventory-history.py needs prettytable')
+class TestInventoryHistory(unittest.TestCase):
+    def setUp(self):
+        self.config_path = tempfile.mkdtemp()
+        self.inventory_file_path = path.join(self.config_path,
+                                             'openstack_inventory.json')
+        self.store = di.InventoryBackupStore(self.config_path, max_age=0)
+        self.snapshots = [(1000.0, 'abc1'), (1001.0, 'abd2'),
+                          (1002.0, 'abc1')]
+
+    def test_find_revision_by_number(self):
+        find_revision = inventory_history.find_revision
+        self.assertEqual(find_revision(self.snapshots, '1'), 0)
+        self.assertEqual(find_revision(self.snapshots, '3'), 2)
+
+    def test_find_revision_by_checksum(self):
+        find_revision = inventory_history.find_revision
+        self.assertEqual(find_revision(self.snapshots, 'abd'), 1)
+        self.assertEqual(find_revision(self.snapshots, 'ABD2'), 1)
+        # The same content at several revisions is found at the last one
+        self.assertEqual(find_revision(self.snapshots, 'abc'), 2)
+
+    def test_find_revision_not_found(self):
+        for revision in ('ab', 'ff', '0', '4'):
+            with self.assertRaises(SystemExit) as context:
+                inventory_history.find_revision(self.snapshots, revision)
+            self.assertEqual(context.exception.message,
+                             'No single revision matches: %s' % revision)
+
+    def test_restore_revision(self):
+        import fcntl
+
+        self.store.add('{"a": 1}', 1000.0)
+        self.store.add('{"a": 2}', 1001.0)
+        with open(self.inventory_file_path, 'wb') as f:
+            f.write('{"a": 3}')
+        checksum = self.store.snapshots()[0][1]
+
+        with mock.patch('fcntl.flock') as flock:
+            inventory_history.restore_revision(self.config_path, self.store,
+                                               checksum)
+
+        with open(self.inventory_file_path, 'rb') as f:
+            self.assertEqual(f.read(), '{"a": 1}')
+        # The replaced inventory and the restored one are both kept
+        self.assertEqual(
+            [self.store.read(c) for _, c in self.store.snapshots()],
+            ['{"a": 1}', '{"a": 2}', '{"a": 3}', '{"a": 1}']
+        )
+        self.assertIn(mock.call(mock.ANY, fcntl.LOCK_EX),
+                      flock.call_args_list)
+
+    def tearDown(self):
+        shutil.rmtree(self.config_path)
+
+
+class TestMultipleRuns(unittest.TestCase):
+    def test_creating_backup_file(self):
+        get_inventory(clean=False)
+        inventory_file_path = os.path.join(TARGET_DIR,
+                                           'openstack_inventory.json')
+        with open(inventory_file_path, 'rb') as f:
+            content = f.read()
+
+        try:
+            self.assertTrue(di.make_backup(TARGET_DIR, inventory_file_path))
+            self.assertFalse(di.make_backup(TARGET_DIR, inventory_file_path))
+
+            store = di.InventoryBackupStore(TARGET_DIR)
+            snapshots = store.snapshots()
+            self.assertEqual(len(snapshots), 1)
+            self.assertEqual(store.read(snapshots[0][1]), content)
+        finally:
+            cleanup()
 
     def test_recreating_files(self):
         # Deleting the files after the first run should cause the files to be
@@ -677,7 +2390,7 @@ class TestMultipleRuns(unittest.TestCase):
 
         get_inventory()
 
-        backup_path = path.join(TARGET_DIR, 'backup_openstack_inventory.tar')
+        backup_path = path.join(TARGET_DIR, 'backup_openstack_inventory')
 
         self.assertFalse(os.path.exists(backup_path))
 
@@ -695,12 +2408,462 @@ class TestMultipleRuns(unittest.TestCase):
         # INVENTORY_SKEL populated, so we're not going to do deep testing
         self.assertIn('log_hosts', inv)
 
+    def test_cached_inventory(self):
+        first = get_inventory(clean=False)
+        inventory_file_path = os.path.join(TARGET_DIR,
+                                           'openstack_inventory.json')
+        backup_path = path.join(TARGET_DIR, 'backup_openstack_inventory')
+        inventory_mtime = os.stat(inventory_file_path).st_mtime
+
+        load_config_path = 'dynamic_inventory.load_user_configuration'
+        with mock.patch(load_config_path) as load_config:
+            second = get_inventory(clean=False)
+
+        self.assertFalse(load_config.called)
+        self.assertEqual(first, second)
+        self.assertFalse(os.path.exists(backup_path))
+        self.assertEqual(os.stat(inventory_file_path).st_mtime,
+                         inventory_mtime)
+
+    def test_changed_inventory_is_not_cached(self):
+        get_inventory(clean=False)
+        inventory_file_path = os.path.join(TARGET_DIR,
+                                           'openstack_inventory.json')
+        with open(inventory_file_path, 'rb') as f:
+            inventory = json.loads(f.read())
+        inventory['_meta']['hostvars']['aio1']['cached'] = False
+        with open(inventory_file_path, 'wb') as f:
+            f.write(json.dumps(inventory))
+
+        inventory = get_inventory(clean=False)
+        self.assertFalse(inventory['_meta']['hostvars']['aio1']['cached'])
+
+    def test_cached_inventory_skips_imports(self):
+        get_inventory(clean=False)
+        script = (
+            'import sys; sys.path.insert(0, %r); '
+            'import dynamic_inventory; '
+            'dynamic_inventory.main({"config": %r}); '
+            'print(" ".join(sorted(set(["netaddr", "yaml"]) & '
+            'set(sys.modules))))' % (path.join(os.getcwd(), INV_DIR),
+                                     TARGET_DIR)
+        )
+        output = subprocess.check_output([sys.executable, '-c', script])
+        self.assertEqual(output.strip(), '')
+
+    def test_unchanged_inventory_is_not_rewritten(self):
+        get_inventory(clean=False)
+        inventory_file_path = os.path.join(TARGET_DIR,
+                                           'openstack_inventory.json')
+        backup_path = path.join(TARGET_DIR, 'backup_openstack_inventory')
+        inventory_inode = os.stat(inventory_file_path).st_ino
+
+        # Force a regeneration from the saved inventory
+        os.remove(path.join(TARGET_DIR, 'openstack_inventory.cache'))
+        get_inventory(clean=False)
+
+        self.assertEqual(os.stat(inventory_file_path).st_ino, inventory_inode)
+        self.assertFalse(os.path.exists(backup_path))
+
+    def test_changed_inventory_is_backed_up(self):
+        get_inventory(clean=False)
+        inventory_file_path = os.path.join(TARGET_DIR,
+                                           'openstack_inventory.json')
+        backup_path = path.join(TARGET_DIR, 'backup_openstack_inventory')
+        with open(inventory_file_path, 'rb') as f:
+            inventory = json.loads(f.read())
+        inventory['_meta']['hostvars']['aio1']['cached'] = False
+        with open(inventory_file_path, 'wb') as f:
+            f.write(json.dumps(inventory))
+        inventory_inode = os.stat(inventory_file_path).st_ino
+
+        get_inventory(clean=False)
+
+        self.assertTrue(os.path.exists(backup_path))
+        store = di.InventoryBackupStore(TARGET_DIR)
+        snapshots = store.snapshots()
+        self.assertEqual(len(snapshots), 2)
+        self.assertEqual(store.load(snapshots[0][1]), inventory)
+        with open(inventory_file_path, 'rb') as f:
+            self.assertEqual(store.read(snapshots[1][1]), f.read())
+        self.assertNotEqual(os.stat(inventory_file_path).st_ino,
+                            inventory_inode)
+
+    def test_generation_holds_exclusive_lock(self):
+        import fcntl
+
+        with mock.patch('fcntl.flock') as flock:
+            get_inventory(clean=False)
+
+        operations = [c[0][1] for c in flock.call_args_list]
+        self.assertEqual(operations, [fcntl.LOCK_SH, fcntl.LOCK_UN,
+                                      fcntl.LOCK_EX, fcntl.LOCK_UN])
+
+    def test_cached_inventory_holds_shared_lock(self):
+        import fcntl
+
+        get_inventory(clean=False)
+        with mock.patch('fcntl.flock') as flock:
+            get_inventory(clean=False)
+
+        operations = [c[0][1] for c in flock.call_args_list]
+        self.assertEqual(operations, [fcntl.LOCK_SH, fcntl.LOCK_UN])
+
+    def test_stale_daemon_socket(self):
+        with open(path.join(TARGET_DIR, 'openstack_inventory.sock'), 'w'):
+            pass
+        inventory = get_inventory(clean=False)
+        self.assertIn('_meta', inventory)
+
+    def test_daemon_ignores_its_own_writes(self):
+        import socket
+
+        inventory_watch = di.InventoryWatch
+        watches = list()
+
+        def start_watch(config_path):
+            watches.append(inventory_watch(config_path))
+            return watches[-1]
+
+        # Stop the daemon once the first inventory has been generated
+        with mock.patch('dynamic_inventory.InventoryWatch', start_watch):
+            with mock.patch('socket.socket', side_effect=socket.error):
+                with self.assertRaises(socket.error):
+                    di.run_daemon({'config': TARGET_DIR, 'daemon': True})
+
+        try:
+            self.assertFalse(watches[0].read())
+        finally:
+            watches[0].close()
+
     def tearDown(self):
         # Clean up here since get_inventory will not do it by design in
         # this test.
         cleanup()
 
 
+class TestParsedConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.config_path = tempfile.mkdtemp()
+        self.config_file = path.join(self.config_path, 'config.yml')
+        with open(self.config_file, 'wb') as f:
+            f.write('drives:\n  - sdb\n  - sdc\n')
+
+    def load(self):
+        parsed_cache = di.ParsedConfigCache(self.config_path)
+        data = parsed_cache.load(self.config_file)
+        parsed_cache.save()
+        return data
+
+    def test_parsed_once(self):
+        first = self.load()
+        with mock.patch('dynamic_inventory._parse_yaml') as parse_yaml:
+            second = self.load()
+
+        self.assertFalse(parse_yaml.called)
+        self.assertEqual(first, {'drives': ['sdb', 'sdc']})
+        self.assertEqual(second, first)
+
+    def test_changed_file_is_parsed(self):
+        self.load()
+        with open(self.config_file, 'wb') as f:
+            f.write('drives:\n  - sdd\n')
+
+        self.assertEqual(self.load(), {'drives': ['sdd']})
+
+    def test_loads_return_copies(self):
+        self.load()['drives'].append('sde')
+        self.assertEqual(self.load(), {'drives': ['sdb', 'sdc']})
+
+    def test_corrupt_cache_is_ignored(self):
+        with open(path.join(self.config_path, 'openstack_config.cache'),
+                  'wb') as f:
+            f.write('not a cache')
+
+        self.assertEqual(self.load(), {'drives': ['sdb', 'sdc']})
+
+    def test_cache_is_never_unpickled(self):
+        marker_file = path.join(self.config_path, 'marker')
+        with open(marker_file, 'wb') as f:
+            f.write('')
+
+        class RemoveMarker(object):
+            def __reduce__(self):
+                return os.remove, (marker_file,)
+
+        with open(path.join(self.config_path, 'openstack_config.cache'),
+                  'wb') as f:
+            f.write(pickle.dumps({'version': 1, 'entries': RemoveMarker()}))
+
+        self.assertEqual(self.load(), {'drives': ['sdb', 'sdc']})
+        self.assertTrue(path.exists(marker_file))
+
+    def test_changed_cache_is_ignored(self):
+        self.load()
+        cache_file = path.join(self.config_path, 'openstack_config.cache')
+        with open(cache_file, 'rb') as f:
+            content = f.read()
+        with open(cache_file, 'wb') as f:
+            f.write(content.replace('sdc', 'sdx'))
+
+        self.assertEqual(self.load(), {'drives': ['sdb', 'sdc']})
+
+    def test_unmarshallable_content_not_cached(self):
+        with open(self.config_file, 'wb') as f:
+            f.write('installed: 2016-01-01\n')
+
+        self.assertEqual(self.load(), {'installed': datetime.date(2016, 1, 1)})
+        self.assertEqual(
+            di.ParsedConfigCache(self.config_path).entries, dict()
+        )
+
+    def test_removed_files_are_dropped(self):
+        self.load()
+        os.remove(self.config_file)
+        parsed_cache = di.ParsedConfigCache(self.config_path)
+        parsed_cache.save()
+
+        self.assertEqual(
+            di.ParsedConfigCache(self.config_path).entries, dict()
+        )
+
+    def test_same_result_as_safe_load(self):
+        with open(path.join(TARGET_DIR, 'openstack_user_config.yml')) as f:
+            content = f.read()
+        self.assertEqual(di._parse_yaml(content), yaml.safe_load(content))
+
+    def tearDown(self):
+        shutil.rmtree(self.config_path)
+
+
+class TestIncrementalGeneration(unittest.TestCase):
+    def setUp(self):
+        self.inventory_file_path = path.join(TARGET_DIR,
+                                             'openstack_inventory.json')
+        self.inventory = get_inventory(clean=False)
+        # Force the next run to generate the inventory again
+        os.remove(path.join(TARGET_DIR, 'openstack_inventory.cache'))
+
+    def test_fingerprints_saved(self):
+        with open(self.inventory_file_path) as f:
+            fingerprints = json.load(f)['_meta']['fingerprints']
+        self.assertEqual(sorted(fingerprints), ['aio1'])
+
+    def test_fingerprints_not_printed(self):
+        self.assertNotIn('fingerprints', self.inventory['_meta'])
+        for all_args in ({}, {'limit_groups': 'galera_all'}):
+            all_args['config'] = TARGET_DIR
+            inventory = json.loads(di.main(all_args))
+            self.assertNotIn('fingerprints', inventory['_meta'])
+            # Served from the cached output
+            inventory = json.loads(di.main(all_args))
+            self.assertNotIn('fingerprints', inventory['_meta'])
+
+    def test_unchanged_hosts_are_skipped(self):
+        build_path = 'dynamic_inventory._build_container_hosts'
+        with mock.patch(build_path, wraps=di._build_container_hosts) as build:
+            inventory = get_inventory(clean=False)
+
+        self.assertFalse(build.called)
+        self.assertEqual(inventory, self.inventory)
+
+    def test_changed_host_entries_are_processed(self):
+        hostvars = self.inventory['_meta']['hostvars']
+        container = [h for h in self.inventory['galera_container']['hosts']
+                     if h in hostvars][0]
+        del hostvars[container]['container_networks']
+        with open(self.inventory_file_path, 'wb') as f:
+            f.write(json.dumps(self.inventory))
+
+        build_path = 'dynamic_inventory._build_container_hosts'
+        with mock.patch(build_path, wraps=di._build_container_hosts) as build:
+            inventory = get_inventory(clean=False)
+
+        self.assertTrue(build.called)
+        networks = inventory['_meta']['hostvars'][container][
+            'container_networks']
+        self.assertTrue(networks['container_address']['address'])
+
+    def test_changed_config_marks_host(self):
+        user_config = di.load_user_configuration(TARGET_DIR)
+        environment = di.load_environment(TARGET_DIR)
+        config_fingerprints = di._host_config_fingerprints(user_config,
+                                                           environment)
+        self.inventory = di.get_inventory(TARGET_DIR,
+                                          self.inventory_file_path)
+        self.assertEqual(
+            di._get_changed_hosts(self.inventory, config_fingerprints), set()
+        )
+
+        user_config['compute_hosts']['aio1']['affinity'] = {'foo': 2}
+        config_fingerprints = di._host_config_fingerprints(user_config,
+                                                           environment)
+        self.assertEqual(
+            di._get_changed_hosts(self.inventory, config_fingerprints),
+            set(['aio1'])
+        )
+
+    def tearDown(self):
+        cleanup()
+
+
+class TestStartup(unittest.TestCase):
+    # Budget for importing the inventory script, in seconds. It is far above
+    # the usual import time so that it only fails on a real regression.
+    IMPORT_BUDGET = 0.25
+
+    def test_import_budget(self):
+        script = (
+            'import json, sys, time; sys.path.insert(0, %r); '
+            'start = time.time(); import dynamic_inventory; '
+            'print(json.dumps([time.time() - start, sys.modules.keys()]))'
+            % path.join(os.getcwd(), INV_DIR)
+        )
+        elapsed, modules = json.loads(
+            subprocess.check_output([sys.executable, '-c', script])
+        )
+        self.assertLess(elapsed, self.IMPORT_BUDGET)
+        for module in ('copy', 'netaddr', 'random', 'tarfile', 'uuid',
+                       'yaml'):
+            self.assertNotIn(module, modules)
+
+
+class TestInventoryDaemon(unittest.TestCase):
+    def setUp(self):
+        self.socket_file = path.join(TARGET_DIR, 'openstack_inventory.sock')
+        self.daemon = subprocess.Popen(
+            [sys.executable, INV_SCRIPT, '--config', TARGET_DIR, '--daemon']
+        )
+        for _ in range(100):
+            if os.path.exists(self.socket_file):
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('The inventory daemon did not start')
+
+    def test_list_served_by_daemon(self):
+        load_config_path = 'dynamic_inventory.load_user_configuration'
+        with mock.patch(load_config_path) as load_config:
+            inventory = get_inventory(clean=False)
+
+        self.assertFalse(load_config.called)
+        self.assertIn('aio1', inventory['_meta']['hostvars'])
+
+    def test_regenerates_on_change(self):
+        inventory_file_path = path.join(TARGET_DIR, 'openstack_inventory.json')
+        with open(inventory_file_path, 'rb') as f:
+            inventory = json.loads(f.read())
+        inventory['_meta']['hostvars']['aio1']['daemon_test'] = True
+        with open(inventory_file_path, 'wb') as f:
+            f.write(json.dumps(inventory))
+
+        for _ in range(50):
+            inventory = json.loads(di.request_daemon_inventory(TARGET_DIR))
+            if 'daemon_test' in inventory['_meta']['hostvars']['aio1']:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('The inventory daemon did not regenerate')
+
+    def test_compact_served_by_daemon(self):
+        inventory = json.loads(di.request_daemon_inventory(TARGET_DIR))
+        output = di.request_daemon_inventory(TARGET_DIR, ('compact',))
+        self.assertNotIn('\n', output)
+        self.assertEqual(json.loads(output), inventory)
+
+    def test_socket_removed_on_exit(self):
+        self.daemon.terminate()
+        self.daemon.wait()
+        self.assertFalse(os.path.exists(self.socket_file))
+        self.assertIsNone(di.request_daemon_inventory(TARGET_DIR))
+
+    def test_unresponsive_daemon(self):
+        self.daemon.terminate()
+        self.daemon.wait()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(self.socket_file)
+        server.listen(1)
+
+        with mock.patch.object(di, 'INVENTORY_DAEMON_TIMEOUT', 0.1):
+            self.assertIsNone(di.request_daemon_inventory(TARGET_DIR))
+
+    def tearDown(self):
+        if self.daemon.poll() is None:
+            self.daemon.terminate()
+            self.daemon.wait()
+        cleanup()
+
+
+class TestInventoryPlugin(unittest.TestCase):
+    def setUp(self):
+        self.plugin = openstack_ansible.InventoryModule()
+        self.plugin.inventory = mock.MagicMock()
+
+    def test_load_generated_inventory(self):
+        try:
+            generated = di.load_generated_inventory(TARGET_DIR)
+            cached = di.load_generated_inventory(TARGET_DIR)
+        finally:
+            cleanup()
+        self.assertIn('aio1', generated['_meta']['hostvars'])
+        self.assertEqual(generated, cached)
+
+    def test_populate(self):
+        data = {
+            '_meta': {'hostvars': {'aio1': {'ansible_ssh_host': '10.0.0.1'}}},
+            'all': {'vars': {'container_cidr': '10.0.0.0/24'}},
+            'hosts': {'children': ['log_hosts'], 'hosts': []},
+            'log_hosts': {'hosts': ['aio1']},
+        }
+        self.plugin._populate(data)
+        inventory = self.plugin.inventory
+
+        inventory.add_host.assert_any_call('aio1', group='log_hosts')
+        inventory.add_child.assert_called_once_with('hosts', 'log_hosts')
+        inventory.set_variable.assert_any_call('all', 'container_cidr',
+                                               '10.0.0.0/24')
+        inventory.set_variable.assert_any_call('aio1', 'ansible_ssh_host',
+                                               '10.0.0.1')
+
+    def test_verify_file(self):
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        for name in ('openstack_ansible.yml', 'hosts.yml'):
+            open(path.join(config_dir, name), 'w').close()
+
+        self.assertTrue(self.plugin.verify_file(
+            path.join(config_dir, 'openstack_ansible.yml')
+        ))
+        self.assertFalse(self.plugin.verify_file(
+            path.join(config_dir, 'hosts.yml')
+        ))
+        self.assertFalse(self.plugin.verify_file(
+            path.join(config_dir, 'openstack_ansible.yaml')
+        ))
+
+    def test_version_tuple(self):
+        self.assertEqual(openstack_ansible._version_tuple('2.4.0.0'),
+                         (2, 4, 0, 0))
+        self.assertEqual(openstack_ansible._version_tuple('2.10.0rc1'),
+                         (2, 10))
+        self.assertLess(openstack_ansible._version_tuple('2.1.6.0'),
+                        openstack_ansible.ANSIBLE_MIN_VERSION)
+
+    def test_parse(self):
+        loader = mock.MagicMock()
+        loader.load_from_file.return_value = {
+            'plugin': 'openstack_ansible',
+            'config': TARGET_DIR
+        }
+        try:
+            self.plugin.parse(mock.MagicMock(), loader,
+                              path.join(TARGET_DIR, 'openstack_ansible.yml'))
+        finally:
+            cleanup()
+        self.assertTrue(self.plugin.inventory.add_group.called)
+
+
 class TestEnsureInventoryUptoDate(unittest.TestCase):
     def setUp(self):
         self.env = di.load_environment(TARGET_DIR)
@@ -756,6 +2919,7 @@ class TestEnsureInventoryUptoDate(unittest.TestCase):
         self.env = None
         self.host_vars = None
         self.inv = None
+        cleanup()
 
 
 if __name__ == '__main__':